@@ -42,6 +42,16 @@ def add_args(parser):
     parser.add_argument('--sync_bn', type=eval,
                         default=False, choices=[True, False])
     parser.add_argument('--bn_lag', type=float, default=0)
+    parser.add_argument('--shared_cond_proj', action='store_true',
+                        help='Whether to compute the condition part of the first SegFlow subnet conv once per level.')
+    parser.add_argument('--bf16', action='store_true',
+                        help='Run the coupling subnets under bfloat16 autocast (couplings and log-dets stay float32).')
+    parser.add_argument('--channels_last', action='store_true',
+                        help='Keep the conditions, the SegFlow input and the conv weights in channels-last memory format.')
+    parser.add_argument('--model_mode', type=str, default='mask', choices=['mask', 'boundary'],
+                        help='Model a dense mask (SegFlow + PriorFlow) or N ordered object boundary points (BoundaryFlow).')
+    parser.add_argument('--num_boundary_points', type=int, default=64,
+                        help='Number of boundary points in the boundary model mode.')
 
     # training options
     parser.add_argument('--root_dir', type=str, default=None)
@@ -59,6 +69,8 @@ def add_args(parser):
                         help='Learning rate for the Adam optimizer.')
     parser.add_argument('--seg_lr', type=float, default=1e-2,
                         help='Learning rate for the Adam optimizer.')
+    parser.add_argument('--boundary_lr', type=float, default=1e-3,
+                        help='Learning rate of the BoundaryFlow (boundary model mode).')
     parser.add_argument('--beta1', type=float, default=0.9,
                         help='Beta1 for Adam.')
     parser.add_argument('--beta2', type=float, default=0.999,
@@ -122,6 +134,8 @@ def add_args(parser):
     parser.add_argument('--viz_freq', type=int, default=10)
     parser.add_argument('--val_freq', type=int, default=10)
     parser.add_argument('--log_freq', type=int, default=10)
+    parser.add_argument('--monitor_freq', type=int, default=10,
+                        help='Decode the training sample mean every N steps (0 to disable).')
     parser.add_argument('--save_freq', type=int, default=10)
     parser.add_argument('--timeit', type=eval,
                         default=False, choices=[True, False])
@@ -166,6 +180,12 @@ def add_args(parser):
                         help='node rank for distributed training')
     parser.add_argument('--gpu', default=None, type=int,
                         help='GPU id to use. None means using all available GPUs.')
+    parser.add_argument('--device', default='cuda', type=str,
+                        help='Device the models are built and run on, e.g. cuda, cuda:1 or cpu.')
+    parser.add_argument('--cpu_threads', default=None, type=int,
+                        help='Intra-op threads for CPU inference. None keeps the torch default.')
+    parser.add_argument('--cpu_interop_threads', default=None, type=int,
+                        help='Inter-op threads for CPU inference. None keeps the torch default.')
 
     # Evaluation options
     parser.add_argument('--evaluate_recon', default=False, action='store_true',
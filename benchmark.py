@@ -0,0 +1,604 @@
+"""
+Decoding benchmarks and reports for CondINNWrapper on the COCO val split.
+
+    python benchmark.py --bench fast --resume_checkpoint <ckpt> \\
+        --data_dir <cocostuff/dataset> --num_classes 80 --batch_size 16
+
+CPU inference host (thread settings of set_cpu_inference_profile):
+
+    python benchmark.py --bench throughput --device cpu --cpu_threads 8 ...
+"""
+import copy
+import json
+import time
+
+import tqdm
+import torch
+import torch.nn.functional as F
+
+from args import get_parser
+from dataset_coco import SamplePointData
+from models.cond_inn import CondINNWrapper
+import models.modules as modules
+import models.reshapes as reshapes
+import models.quantization as quantization
+from utils import AverageValueMeter, AllocationCounter, mask_iou, synchronize, set_cpu_inference_profile
+
+
+def timed(fn, *args, **kwargs):
+    """runs fn and returns (output, seconds), synchronizing the device"""
+    synchronize()
+    start = time.time()
+    out = fn(*args, **kwargs)
+    synchronize()
+    return out, time.time() - start
+
+
+def bench_fast(args, model, loader):
+    """
+    Single-pass MAP decoding (decode_map) vs. the nr_sample mean
+    (decode_and_average): IoU against the ground truth and latency.
+    """
+    meters = {name: AverageValueMeter() for name in
+              ['iou_mean', 'iou_fast', 'iou_agreement', 'time_mean', 'time_fast']}
+
+    for input_tensor, gt_mask_tensor, class_condition, _, _ in tqdm.tqdm(loader):
+        gt = gt_mask_tensor.to(args.device)
+
+        sample_mean, t_mean = timed(model.decode_and_average, input_tensor,
+                                    class_condition, args.nr_sample, pick=0)
+        fast, t_fast = timed(model.decode_map, input_tensor, class_condition)
+
+        meters['iou_mean'].update(mask_iou(sample_mean, gt).mean().item())
+        meters['iou_fast'].update(mask_iou(fast[0], gt).mean().item())
+        meters['iou_agreement'].update(
+            mask_iou(fast[0], sample_mean).mean().item())
+        meters['time_mean'].update(t_mean)
+        meters['time_fast'].update(t_fast)
+
+    report = {name: meter.avg for name, meter in meters.items()}
+    report['speedup'] = report['time_mean'] / report['time_fast']
+
+    print("%d-sample mean: IoU %.4f  %.2f ms/img" %
+          (args.nr_sample, report['iou_mean'], 1000 * report['time_mean']))
+    print("fast (MAP)    : IoU %.4f  %.2f ms/img" %
+          (report['iou_fast'], 1000 * report['time_fast']))
+    print("IoU(fast, mean) %.4f  speedup x%.2f" %
+          (report['iou_agreement'], report['speedup']))
+    return report
+
+
+def bench_adaptive(args, model, loader):
+    """
+    Adaptive sample-count decoding (decode_adaptive) vs. the fixed
+    nr_sample mean: IoU, samples used per image and latency.
+    """
+    meters = {name: AverageValueMeter() for name in
+              ['iou_mean', 'iou_adaptive', 'nr_used', 'time_mean', 'time_adaptive']}
+
+    for input_tensor, gt_mask_tensor, class_condition, _, _ in tqdm.tqdm(loader):
+        gt = gt_mask_tensor.to(args.device)
+
+        sample_mean, t_mean = timed(model.decode_and_average, input_tensor,
+                                    class_condition, args.nr_sample, pick=0)
+        (adaptive, _, nr_used), t_adaptive = timed(
+            model.decode_adaptive, input_tensor, class_condition,
+            round_size=args.round_size, max_samples=args.nr_sample, tol=args.adaptive_tol)
+
+        meters['iou_mean'].update(mask_iou(sample_mean, gt).mean().item())
+        meters['iou_adaptive'].update(mask_iou(adaptive[0], gt).mean().item())
+        meters['nr_used'].update(nr_used.float().mean().item())
+        meters['time_mean'].update(t_mean)
+        meters['time_adaptive'].update(t_adaptive)
+
+    report = {name: meter.avg for name, meter in meters.items()}
+
+    print("%d-sample mean: IoU %.4f  %.2f ms/img" %
+          (args.nr_sample, report['iou_mean'], 1000 * report['time_mean']))
+    print("adaptive      : IoU %.4f  %.2f ms/img  %.1f samples/img" %
+          (report['iou_adaptive'], 1000 * report['time_adaptive'], report['nr_used']))
+    return report
+
+
+def bench_samplers(args, model, loader):
+    """
+    Mean mask error vs. sample count for every latent sampler. The
+    reference is an i.i.d. mean over nr_reference samples, the error the
+    mean absolute difference to it (mask range 0-255). Both sampling paths
+    are timed (ms per image): decode_using_learned_sampler on the first
+    image of a batch with the largest sample count, and the chunked
+    decode_streaming over the whole batch with nr_sample samples.
+    """
+    counts = [2 ** k for k in range(args.nr_sample.bit_length())]
+    meters = {(sampler, n): AverageValueMeter()
+              for sampler in modules.SAMPLERS for n in counts}
+    times = {(sampler, path): AverageValueMeter()
+             for sampler in modules.SAMPLERS for path in ['single', 'streaming']}
+
+    for input_tensor, _, class_condition, _, _ in tqdm.tqdm(loader):
+        conditions = model.make_conditions(input_tensor, class_condition)
+
+        reference = 0.
+        for _ in range(args.nr_reference // 16):
+            reference += model.decode_using_learned_sampler(
+                conditions, 16, pick=0).mean(dim=0) / (args.nr_reference // 16)
+
+        for sampler in modules.SAMPLERS:
+            for n in counts:
+                samples, t = timed(model.decode_using_learned_sampler,
+                                   conditions, n, pick=0, sampler=sampler)
+                meters[sampler, n].update(
+                    (samples.mean(dim=0) - reference).abs().mean().item())
+            times[sampler, 'single'].update(t)
+
+            _, t = timed(model.decode_streaming, input_tensor, class_condition,
+                         args.nr_sample, sampler=sampler)
+            times[sampler, 'streaming'].update(t / input_tensor.size(0))
+
+    print("samples " + " ".join("%10s" % sampler for sampler in modules.SAMPLERS))
+    for n in counts:
+        print("%7d " % n + " ".join("%10.4f" % meters[sampler, n].avg
+                                    for sampler in modules.SAMPLERS))
+    for path in ['single', 'streaming']:
+        print("%-9s " % path + " ".join("%8.2fms" % (1000 * times[sampler, path].avg)
+                                        for sampler in modules.SAMPLERS))
+
+    report = {sampler: {n: meters[sampler, n].avg for n in counts}
+              for sampler in modules.SAMPLERS}
+    report['time'] = {sampler: {path: times[sampler, path].avg
+                                for path in ['single', 'streaming']}
+                      for sampler in modules.SAMPLERS}
+    return report
+
+
+def bench_throughput(args, model, loader):
+    """
+    decode_and_average throughput with nr_sample samples per image on
+    args.device, the first args.warmup images are not timed.
+    """
+    meter = AverageValueMeter()
+
+    for bidx, (input_tensor, _, class_condition, _, _) in enumerate(tqdm.tqdm(loader)):
+        _, t = timed(model.decode_and_average, input_tensor,
+                     class_condition, args.nr_sample, pick=0)
+        if bidx >= args.warmup:
+            meter.update(t)
+
+    report = {'device': args.device,
+              'threads': torch.get_num_threads(),
+              'interop_threads': torch.get_num_interop_threads(),
+              'nr_sample': args.nr_sample,
+              'time': meter.avg,
+              'throughput': 1. / meter.avg}
+
+    print("%s (%d/%d threads), %d samples: %.2f ms/img  %.2f img/s" %
+          (args.device, report['threads'], report['interop_threads'], args.nr_sample,
+           1000 * report['time'], report['throughput']))
+    return report
+
+
+def bench_bf16(args, model, loader):
+    """
+    bf16 autocast subnets (--bf16) against the float32 model with the same
+    weights: NLL and nr_sample mean mask (same latent noise) differences,
+    IoU and latency. Run without --bf16, the loaded model is the reference.
+    """
+    bf16_args = copy.copy(args)
+    bf16_args.bf16 = True
+    bf16_model = CondINNWrapper(bf16_args, img_dims=(256, 256)).to(args.device)
+    bf16_model.load_state_dict(model.state_dict())
+    bf16_model.eval()
+
+    meters = {name: AverageValueMeter() for name in
+              ['nll_fp32', 'nll_bf16', 'nll_diff', 'mask_diff', 'iou_fp32', 'iou_bf16',
+               'iou_agreement', 'time_fp32', 'time_bf16']}
+
+    for bidx, (input_tensor, gt_mask_tensor, class_condition, _, _) in enumerate(tqdm.tqdm(loader)):
+        gt = gt_mask_tensor.to(args.device)
+
+        nll_fp32 = model.nll(input_tensor, gt_mask_tensor, class_condition)
+        nll_bf16 = bf16_model.nll(input_tensor, gt_mask_tensor, class_condition)
+
+        torch.manual_seed(bidx)
+        mean_fp32, t_fp32 = timed(model.decode_and_average, input_tensor,
+                                  class_condition, args.nr_sample, pick=0)
+        torch.manual_seed(bidx)
+        mean_bf16, t_bf16 = timed(bf16_model.decode_and_average, input_tensor,
+                                  class_condition, args.nr_sample, pick=0)
+
+        meters['nll_fp32'].update(nll_fp32.mean().item())
+        meters['nll_bf16'].update(nll_bf16.mean().item())
+        meters['nll_diff'].update((nll_bf16 - nll_fp32).abs().mean().item())
+        meters['mask_diff'].update((mean_bf16 - mean_fp32).abs().mean().item())
+        meters['iou_fp32'].update(mask_iou(mean_fp32, gt).mean().item())
+        meters['iou_bf16'].update(mask_iou(mean_bf16, gt).mean().item())
+        meters['iou_agreement'].update(mask_iou(mean_bf16, mean_fp32).mean().item())
+        meters['time_fp32'].update(t_fp32)
+        meters['time_bf16'].update(t_bf16)
+
+    report = {name: meter.avg for name, meter in meters.items()}
+    report['speedup'] = report['time_fp32'] / report['time_bf16']
+
+    print("fp32: NLL %.4f  IoU %.4f  %.2f ms/img" %
+          (report['nll_fp32'], report['iou_fp32'], 1000 * report['time_fp32']))
+    print("bf16: NLL %.4f  IoU %.4f  %.2f ms/img" %
+          (report['nll_bf16'], report['iou_bf16'], 1000 * report['time_bf16']))
+    print("|NLL diff| %.5f  |mask diff| %.4f  IoU(bf16, fp32) %.4f  speedup x%.2f" %
+          (report['nll_diff'], report['mask_diff'], report['iou_agreement'], report['speedup']))
+    return report
+
+
+def bench_int8(args, model, loader):
+    """
+    INT8 coupling subnets (models/quantization.py) against the float model
+    with the same weights. The first calib_images val images calibrate the
+    quantization, the rest are used for the report: IoU against the ground
+    truth and the float mean masks (same latent noise), latency, and the
+    number of subnets that were quantized and that stayed float. Run
+    with --device cpu to compare both on the CPU. With --quantized_output
+    the quantized checkpoint is written there, it loads through
+    --resume_checkpoint like a float one.
+    """
+    int8_model = CondINNWrapper(args, img_dims=(256, 256)).to(args.device)
+    int8_model.load_state_dict(model.state_dict())
+
+    batches = iter(loader)
+    calib = [batch for _, batch in zip(range(args.calib_images), batches)]
+
+    def calibrate(m):
+        for input_tensor, _, class_condition, _, _ in calib:
+            m.decode_and_average(input_tensor, class_condition, args.nr_sample, pick=0)
+
+    quantization.quantize_subnets(int8_model, calibrate)
+    if args.quantized_output is not None:
+        quantization.save_quantized(int8_model, 0, args.quantized_output)
+
+    meters = {name: AverageValueMeter() for name in
+              ['iou_float', 'iou_int8', 'iou_agreement', 'mask_diff', 'time_float', 'time_int8']}
+
+    for bidx, (input_tensor, gt_mask_tensor, class_condition, _, _) in enumerate(tqdm.tqdm(batches)):
+        gt = gt_mask_tensor.to(args.device)
+
+        torch.manual_seed(bidx)
+        mean_float, t_float = timed(model.decode_and_average, input_tensor,
+                                    class_condition, args.nr_sample, pick=0)
+        torch.manual_seed(bidx)
+        mean_int8, t_int8 = timed(int8_model.decode_and_average, input_tensor,
+                                  class_condition, args.nr_sample, pick=0)
+        mean_int8 = mean_int8.to(args.device)
+
+        meters['iou_float'].update(mask_iou(mean_float, gt).mean().item())
+        meters['iou_int8'].update(mask_iou(mean_int8, gt).mean().item())
+        meters['iou_agreement'].update(mask_iou(mean_int8, mean_float).mean().item())
+        meters['mask_diff'].update((mean_int8 - mean_float).abs().mean().item())
+        meters['time_float'].update(t_float)
+        meters['time_int8'].update(t_int8)
+
+    report = {name: meter.avg for name, meter in meters.items()}
+    report['speedup'] = report['time_float'] / report['time_int8']
+    report['quantized'], report['float_subnets'] = int8_model.quantized_subnets
+
+    print("float: IoU %.4f  %.2f ms/img (%s)" %
+          (report['iou_float'], 1000 * report['time_float'], args.device))
+    print("int8 : IoU %.4f  %.2f ms/img (cpu, %d subnets int8, %d float)" %
+          (report['iou_int8'], 1000 * report['time_int8'],
+           report['quantized'], report['float_subnets']))
+    print("|mask diff| %.4f  IoU(int8, float) %.4f  speedup x%.2f" %
+          (report['mask_diff'], report['iou_agreement'], report['speedup']))
+    return report
+
+
+def bench_folded(args, model, loader):
+    """
+    Inference rewrite (CondINNWrapper.fold_for_inference: permutations
+    folded into the coupling blocks, Haar as reshape arithmetic) against
+    the GraphINN: max differences of the SegFlow latents and log dets
+    (forward), of the SegFlow reverse of the same latents, the
+    forward-reverse reconstruction error of both, and decoding latency.
+    """
+    folded_model = copy.deepcopy(model)
+    folded_model.fold_for_inference()
+
+    meters = {name: AverageValueMeter() for name in
+              ['z_diff', 'jac_diff', 'rev_diff', 'recons_graph', 'recons_folded',
+               'time_graph', 'time_folded']}
+    exact = 0
+
+    for bidx, (input_tensor, gt_mask_tensor, class_condition, _, _) in enumerate(tqdm.tqdm(loader)):
+        conditions = model.make_conditions(input_tensor, class_condition)
+        y = gt_mask_tensor.float().to(args.device).unsqueeze(1)
+
+        z_graph, jac_graph = model.segflow(y, c=conditions)
+        z_folded, jac_folded = folded_model.segflow(y, c=conditions)
+        y_graph, _ = model.segflow(z_graph, c=conditions, rev=True)
+        y_folded, _ = folded_model.segflow(z_graph, c=conditions, rev=True)
+        y_recons, _ = folded_model.segflow(z_folded, c=conditions, rev=True)
+        exact += int(torch.equal(z_graph, z_folded) and torch.equal(y_graph, y_folded))
+
+        torch.manual_seed(bidx)
+        _, t_graph = timed(model.decode_and_average, input_tensor,
+                           class_condition, args.nr_sample, pick=0)
+        torch.manual_seed(bidx)
+        _, t_folded = timed(folded_model.decode_and_average, input_tensor,
+                            class_condition, args.nr_sample, pick=0)
+
+        meters['z_diff'].update((z_folded - z_graph).abs().max().item())
+        meters['jac_diff'].update((jac_folded - jac_graph).abs().max().item())
+        meters['rev_diff'].update((y_folded - y_graph).abs().max().item())
+        meters['recons_graph'].update((y_graph - y).abs().max().item())
+        meters['recons_folded'].update((y_recons - y).abs().max().item())
+        meters['time_graph'].update(t_graph)
+        meters['time_folded'].update(t_folded)
+
+    report = {name: meter.avg for name, meter in meters.items()}
+    report['speedup'] = report['time_graph'] / report['time_folded']
+    report['exact_batches'] = exact
+
+    print("max |folded - graph|: z %.2e  log det %.2e  reverse %.2e  (%d/%d batches bit-exact)" %
+          (report['z_diff'], report['jac_diff'], report['rev_diff'], exact, len(loader)))
+    print("max reconstruction error: graph %.2e  folded %.2e" %
+          (report['recons_graph'], report['recons_folded']))
+    print("graph %.2f ms/img  folded %.2f ms/img  speedup x%.2f" %
+          (1000 * report['time_graph'], 1000 * report['time_folded'], report['speedup']))
+    return report
+
+
+def bench_channels_last(args, model, loader):
+    """
+    Channels-last mode (--channels_last) against the default NCHW layout,
+    same weights: training step and nr_sample decoding throughput
+    (images/s) and the max difference of the decoded mean masks (same
+    latent noise). The training steps run on copies of the models.
+    """
+    cl_args = copy.copy(args)
+    cl_args.channels_last = True
+    layouts = {'nchw': model,
+               'channels_last': CondINNWrapper(cl_args, img_dims=(256, 256)).to(args.device)}
+    layouts['channels_last'].load_state_dict(model.state_dict())
+    layouts['channels_last'].eval()
+
+    meters = {name: AverageValueMeter() for name in
+              ['train_nchw', 'train_channels_last', 'decode_nchw',
+               'decode_channels_last', 'mask_diff']}
+    with torch.inference_mode(False):
+        trainees = {name: copy.deepcopy(m).train() for name, m in layouts.items()}
+
+    for bidx, (input_tensor, gt_mask_tensor, class_condition, _, _) in enumerate(tqdm.tqdm(loader)):
+        batch_size = input_tensor.size(0)
+        means = {}
+        for name in layouts:
+            with torch.inference_mode(False), torch.enable_grad():
+                _, t_train = timed(trainees[name], input_tensor.clone(),
+                                   gt_mask_tensor.clone(), class_condition.clone())
+            torch.manual_seed(bidx)
+            means[name], t_decode = timed(layouts[name].decode_and_average, input_tensor,
+                                          class_condition, args.nr_sample, pick=0)
+            meters['train_' + name].update(batch_size / t_train)
+            meters['decode_' + name].update(batch_size / t_decode)
+        meters['mask_diff'].update((means['channels_last'] - means['nchw']).abs().max().item())
+
+    report = {name: meter.avg for name, meter in meters.items()}
+    for name in ['nchw', 'channels_last']:
+        print("%-13s train %.2f img/s  decode %.2f img/s" %
+              (name, report['train_' + name], report['decode_' + name]))
+    print("speedup train x%.2f  decode x%.2f  max |mask diff| %.2e" %
+          (report['train_channels_last'] / report['train_nchw'],
+           report['decode_channels_last'] / report['decode_nchw'], report['mask_diff']))
+    return report
+
+
+def bench_noise(args, model, loader):
+    """
+    Allocations of the sampling noise sites, the previous torch.normal
+    construction (zeros_like / ones_like temporaries, dequantization noise
+    made on the CPU and moved) against the in-place NoiseBuffers draws of
+    the model, for nr_sample latents of the first batch and its training
+    dequantization noise. Counted with utils.AllocationCounter, over
+    --warmup + 1 calls with the first ones discarded (buffer creation).
+    """
+    input_tensor, gt_mask_tensor, class_condition, _, _ = next(iter(loader))
+    conditions = model.make_conditions(input_tensor[:1], class_condition[:1])
+    mean, logs = model.prior(conditions[2].repeat(args.nr_sample, 1))
+    y = gt_mask_tensor.float()
+    device = model.device
+
+    def latent_before():
+        eps = torch.normal(mean=torch.zeros_like(mean),
+                           std=torch.ones_like(logs) * 0.1)
+        return mean + torch.exp(logs) * eps
+
+    def latent_after():
+        eps = model.noise.sample('iid', mean.size(0), mean.shape[1:], device=device)
+        return modules.GaussianDiag.sample(mean, logs, eps_std=0.1, eps=eps)
+
+    def dequantization_before():
+        return y.to(device) + 1.0/256 * torch.normal(mean=torch.zeros_like(y),
+                                                     std=torch.ones_like(y)).to(device)
+
+    def dequantization_after():
+        y_device = y.to(device)
+        return y_device + model.noise.normal('dequantization', y_device.shape,
+                                             std=1.0/256, device=device)
+
+    report = {}
+    for name, fn in [('latent_before', latent_before), ('latent_after', latent_after),
+                     ('dequantization_before', dequantization_before),
+                     ('dequantization_after', dequantization_after)]:
+        for _ in range(args.warmup):
+            fn()
+        with AllocationCounter() as counter:
+            _, seconds = timed(fn)
+        report[name] = (counter.count, counter.bytes, seconds)
+
+    for site in ['latent', 'dequantization']:
+        print("%-15s allocations %d -> %d  bytes %d -> %d  %.3f -> %.3f ms" %
+              (site, report[site + '_before'][0], report[site + '_after'][0],
+               report[site + '_before'][1], report[site + '_after'][1],
+               1000 * report[site + '_before'][2], 1000 * report[site + '_after'][2]))
+    return report
+
+
+def reference_haar(x, order_by_wavelet=False, rev=False):
+    """the previous haar_multiplex_layer: grouped conv + permutation gather"""
+    C = x.size(1) // 4 if rev else x.size(1)
+    weights = torch.ones(4, 1, 2, 2, device=x.device)
+    weights[1, 0, :, 1] = -1
+    weights[2, 0, 1, :] = -1
+    weights[3, 0, 1, 0] = weights[3, 0, 0, 1] = -1
+    weights = torch.cat([weights * 0.5] * C, 0)
+    perm = torch.arange(4 * C, device=x.device).view(C, 4).t().reshape(-1)
+    if not rev:
+        out = F.conv2d(x, weights, stride=2, groups=C)
+        return out[:, perm] if order_by_wavelet else out
+    if order_by_wavelet:
+        x = x[:, torch.argsort(perm)]
+    return F.conv_transpose2d(x, weights, stride=2, groups=C)
+
+
+def reference_i_revnet(x, rev=False):
+    """the previous i_revnet_downsampling: split / stack / permute"""
+    if not rev:
+        output = x.permute(0, 2, 3, 1)
+        (batch_size, s_height, s_width, s_depth) = output.size()
+        t_1 = output.split(2, 2)
+        stack = [t_t.contiguous().view(batch_size, s_height // 2, s_depth * 4)
+                 for t_t in t_1]
+        output = torch.stack(stack, 1).permute(0, 2, 1, 3).permute(0, 3, 1, 2)
+        return output.contiguous()
+    output = x.permute(0, 2, 3, 1)
+    (batch_size, d_height, d_width, d_depth) = output.size()
+    t_1 = output.contiguous().view(batch_size, d_height, d_width, 4, d_depth // 4)
+    stack = [t_t.contiguous().view(batch_size, d_height, d_width * 2, d_depth // 4)
+             for t_t in t_1.split(2, 3)]
+    output = torch.stack(stack, 0).transpose(0, 1).permute(0, 2, 1, 3, 4).contiguous()
+    output = output.view(batch_size, d_height * 2, d_width * 2, d_depth // 4)
+    return output.permute(0, 3, 1, 2).contiguous()
+
+
+def bench_reshapes(args, model, loader, repeat=20):
+    """
+    Micro-benchmark of the closed-form invertible downsamplings of
+    models/reshapes.py against the previous implementations (conv + gather
+    Haar, split / stack / permute i-RevNet), on the SegFlow Haar input
+    [batch_size, 4, 64, 64] and the cond-0 sized [batch_size, 48, 64, 64]:
+    max forward / inverse difference to the reference, round trip error,
+    tensors allocated per call and latency. Does not use the model.
+    """
+    transforms = {
+        'haar': (lambda x: reshapes.haar_split(x, 0.5), lambda y: reshapes.haar_merge(y, 0.5),
+                 lambda x: reference_haar(x), lambda y: reference_haar(y, rev=True)),
+        'haar_by_wavelet': (lambda x: reshapes.haar_split(x, 0.5, order_by_wavelet=True),
+                            lambda y: reshapes.haar_merge(y, 0.5, order_by_wavelet=True),
+                            lambda x: reference_haar(x, order_by_wavelet=True),
+                            lambda y: reference_haar(y, order_by_wavelet=True, rev=True)),
+        'i_revnet': (reshapes.i_revnet_split, reshapes.i_revnet_merge,
+                     reference_i_revnet, lambda y: reference_i_revnet(y, rev=True)),
+    }
+
+    def measure(fn, x):
+        fn(x)
+        with AllocationCounter() as counter:
+            fn(x)
+        synchronize()
+        start = time.time()
+        for _ in range(repeat):
+            fn(x)
+        synchronize()
+        return counter.count, 1000 * (time.time() - start) / repeat
+
+    report = {}
+    for channels in [4, 48]:
+        x = torch.randn(args.batch_size, channels, 64, 64, device=args.device)
+        for name, (split, merge, ref_split, ref_merge) in transforms.items():
+            y = split(x)
+            entry = {'forward_diff': (y - ref_split(x)).abs().max().item(),
+                     'inverse_diff': (merge(y) - ref_merge(y)).abs().max().item(),
+                     'round_trip': (merge(y) - x).abs().max().item()}
+            for direction, fn, ref in [('split', split, ref_split), ('merge', merge, ref_merge)]:
+                inp = x if direction == 'split' else y
+                entry[direction] = measure(fn, inp)
+                entry[direction + '_reference'] = measure(ref, inp)
+            report['%s_%d' % (name, channels)] = entry
+
+            print("%-16s C=%-2d |fwd - ref| %.1e  |inv - ref| %.1e  round trip %.1e" %
+                  (name, channels, entry['forward_diff'], entry['inverse_diff'], entry['round_trip']))
+            for direction in ['split', 'merge']:
+                (count, ms), (ref_count, ref_ms) = entry[direction], entry[direction + '_reference']
+                print("    %-5s allocations %d -> %d  %.3f -> %.3f ms  x%.2f" %
+                      (direction, ref_count, count, ref_ms, ms, ref_ms / ms))
+    return report
+
+
+BENCHMARKS = {
+    'fast': bench_fast,
+    'adaptive': bench_adaptive,
+    'samplers': bench_samplers,
+    'throughput': bench_throughput,
+    'bf16': bench_bf16,
+    'int8': bench_int8,
+    'folded': bench_folded,
+    'channels_last': bench_channels_last,
+    'noise': bench_noise,
+    'reshapes': bench_reshapes,
+}
+
+# benchmarks on synthetic inputs, run without building the model or loading
+# the val split
+STANDALONE = {'reshapes'}
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument('--bench', type=str, default='fast',
+                        choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--nr_sample', type=int, default=16,
+                        help='Number of samples of the reference sample mean.')
+    parser.add_argument('--nr_reference', type=int, default=64,
+                        help='Number of i.i.d. samples of the reference mean mask.')
+    parser.add_argument('--round_size', type=int, default=4,
+                        help='Samples per round of the adaptive decoding.')
+    parser.add_argument('--adaptive_tol', type=float, default=1.0,
+                        help='Mean mask change (0-255) under which adaptive decoding stops.')
+    parser.add_argument('--warmup', type=int, default=2,
+                        help='Number of untimed images of the throughput benchmark.')
+    parser.add_argument('--calib_images', type=int, default=16,
+                        help='Number of val images calibrating the INT8 quantization.')
+    parser.add_argument('--quantized_output', type=str, default=None,
+                        help='Path to write the INT8 quantized checkpoint to.')
+    parser.add_argument('--max_images', type=int, default=None,
+                        help='Max number of val images to benchmark on.')
+    parser.add_argument('--bench_output', type=str, default=None,
+                        help='Path of a json file to write the report to.')
+    args = parser.parse_args()
+
+    on_cpu = torch.device(args.device).type == 'cpu'
+    if on_cpu:
+        set_cpu_inference_profile(args.cpu_threads, args.cpu_interop_threads)
+
+    model, test_loader = None, None
+    if args.bench not in STANDALONE:
+        model = CondINNWrapper(args, img_dims=(256, 256)).to(args.device)
+        if args.resume_checkpoint is not None:
+            model.resume(args.resume_checkpoint,
+                         strict=(not args.resume_non_strict))
+        model.eval()
+
+        test_set = SamplePointData(args,
+                                   split='val2017', root=args.data_dir, width=256, height=256)
+        if args.max_images is not None:
+            test_set.dataset.rgbs = test_set.dataset.rgbs[:args.max_images]
+            test_set.dataset.annos = test_set.dataset.annos[:args.max_images]
+        test_loader = torch.utils.data.DataLoader(
+            dataset=test_set, batch_size=1, shuffle=False,
+            num_workers=0, pin_memory=not on_cpu)
+
+    with torch.inference_mode():
+        report = BENCHMARKS[args.bench](args, model, test_loader)
+
+    if args.bench_output is not None:
+        with open(args.bench_output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -26,13 +26,22 @@ def decode_img(file_path, width=None, height=None):
 
 def decode_mask(file_path, num_classes=80, nr_samples_from_mask=500):
     """
-        Read the float file containing the object information
+        Read the float file containing the object information. Besides the
+        mask of one randomly chosen class, returns the multi-hot presence
+        vector [num_classes + 1] of all the classes covering more than the
+        30000 px of the mask rule (index 0, "unlabeled", if there is none).
     """
     segim = cv2.imread(file_path)
     h, w, c = segim.shape
-    cls_ids = np.unique(segim)
+    cls_ids, counts = np.unique(segim, return_counts=True)
+    present = cls_ids[(cls_ids < num_classes) & (counts > 30000)]
     cls_ids = cls_ids[cls_ids < num_classes]
 
+    presence = np.zeros(num_classes + 1, dtype=np.float32)
+    presence[present + 1] = 1
+    if len(present) == 0:
+        presence[0] = 1
+
     binary_mask = np.zeros((h, w, c), dtype=np.float32)
 
     if len(cls_ids) != 0:
@@ -52,7 +61,39 @@ def decode_mask(file_path, num_classes=80, nr_samples_from_mask=500):
 
     binary_mask = cv2.resize(binary_mask, (128, 128))[:, :, 0]
 
-    return binary_mask, class_label_id
+    return binary_mask, class_label_id, presence
+
+
+def mask_to_boundary(mask, num_points=64):
+    """
+        Outer contour of the largest object region of a mask, resampled to
+        num_points points equally spaced along the contour. The points are
+        ordered along the contour starting from its topmost point and are
+        normalized (x, y) coordinates in [0, 1].
+        An empty mask gives num_points copies of the mask center.
+    """
+    h, w = mask.shape[:2]
+    binary = (mask > 127).astype(np.uint8)
+    contours, _ = cv2.findContours(
+        binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    if len(contours) == 0:
+        return np.full((num_points, 2), 0.5, dtype=np.float32)
+
+    contour = max(contours, key=cv2.contourArea)[:, 0, :].astype(np.float32)
+    # topmost (then leftmost) point first
+    start = np.lexsort((contour[:, 0], contour[:, 1]))[0]
+    contour = np.roll(contour, -start, axis=0)
+
+    # resample by arc length along the closed contour
+    closed = np.concatenate([contour, contour[:1]], axis=0)
+    arc = np.concatenate(
+        [[0.], np.cumsum(np.linalg.norm(np.diff(closed, axis=0), axis=1))])
+    targets = np.linspace(0., arc[-1], num_points, endpoint=False)
+    points = np.stack([np.interp(targets, arc, closed[:, 0]),
+                       np.interp(targets, arc, closed[:, 1])], axis=1)
+
+    points /= np.array([w, h], dtype=np.float32)
+    return points.astype(np.float32)
 
 
 class DataLoader():
@@ -112,6 +153,9 @@ class SamplePointData(Dataset):
         self.split = 'train' if split == 'train2017' else 'val'
         self.test_id = test_id
         self.num_classes = args.num_classes
+        # boundary mode: the target is the boundary points instead of the mask
+        self.boundary_points = args.num_boundary_points \
+            if args.model_mode == 'boundary' else None
 
     def __len__(self):
         return len(self.dataset.rgbs)
@@ -127,10 +171,12 @@ class SamplePointData(Dataset):
             anno_path = self.dataset.annos[idx]
 
         color_img = decode_img(img_path, width=self.width, height=self.height)
-        mask_img, class_label = decode_mask(
+        mask_img, class_label, presence = decode_mask(
             anno_path, num_classes=self.num_classes)
         # onehot_class_condition = get_onehot_tensor(self.class_size, self.width,
         #                                 self.height, class_label)  # class id
+        if self.boundary_points is not None:
+            mask_img = mask_to_boundary(mask_img, self.boundary_points)
         onehot_class_condition = np.eye(self.class_size, dtype=np.float32)[
             class_label]
 
@@ -149,7 +195,7 @@ class SamplePointData(Dataset):
                 input = np.flip(input, 1).copy()  # vertically
                 output[0] = 1.0 - output[0]
         """
-        return input, output, label_id, label_str
+        return input, output, label_id, label_str, presence
 
 
 def get_onehot_tensor(class_size, width, height, class_id):
@@ -0,0 +1,132 @@
+"""
+Exports the reverse sampler of a trained CondINNWrapper (models/sampler.py)
+as a standalone artifact and checks it against the eager model.
+
+    python export.py --resume_checkpoint <ckpt> --export_output sampler.pt \\
+        --num_classes 80 --batch_size 16 --device cpu
+    python export.py --resume_checkpoint <ckpt> --export_format onnx \\
+        --export_output sampler.onnx --num_classes 80 --batch_size 16 --device cpu
+
+Both artifacts run without FrEIA or this repository:
+
+    sampler = torch.jit.load('sampler.pt')
+    mask = sampler(img, class_onehot, eps)
+
+    session = onnxruntime.InferenceSession('sampler.onnx')
+    mask, = session.run(None, {'img': img, 'class_onehot': class_onehot, 'eps': eps})
+"""
+import time
+
+import torch
+
+from args import get_parser
+from models.cond_inn import CondINNWrapper
+from models.sampler import SamplerModule
+from utils import synchronize
+
+
+def export_torchscript(sampler, example, path):
+    """traces the sampler into a frozen TorchScript graph, weights inlined"""
+    sampler.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(sampler, example, check_trace=False)
+    traced = torch.jit.freeze(traced)
+    torch.jit.save(traced, path)
+    return traced
+
+
+def export_onnx(sampler, example, path, opset=17):
+    """ONNX graph of the sampler, the batch dimension left dynamic"""
+    sampler.eval()
+    names = ['img', 'class_onehot', 'eps']
+    with torch.no_grad():
+        torch.onnx.export(sampler, example, path, input_names=names,
+                          output_names=['mask'], opset_version=opset,
+                          dynamic_axes={n: {0: 'batch'} for n in names + ['mask']},
+                          dynamo=False)
+
+
+def load_onnx(path):
+    """
+    the exported ONNX sampler as a callable on torch tensors, run on the CPU
+    with onnxruntime (ImportError if onnxruntime is not installed)
+    """
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise ImportError('onnxruntime is needed to run the exported ONNX '
+                          'sampler: pip install onnxruntime') from e
+    session = onnxruntime.InferenceSession(
+        path, providers=['CPUExecutionProvider'])
+    names = [i.name for i in session.get_inputs()]
+
+    def run(*inputs):
+        feed = {n: x.detach().cpu().numpy() for n, x in zip(names, inputs)}
+        return torch.from_numpy(session.run(None, feed)[0])
+    return run
+
+
+def check_export(sampler, exported, example, repeat=10):
+    """max abs difference to the eager sampler and the latency of both"""
+    timings = {}
+    with torch.no_grad():
+        for name, fn in [('eager', sampler), ('exported', exported)]:
+            fn(*example)
+            synchronize()
+            start = time.time()
+            for _ in range(repeat):
+                out = fn(*example)
+            synchronize()
+            timings[name] = (time.time() - start) / repeat
+        reference = sampler(*example)
+
+    reference = reference.cpu()
+    error = (out.cpu() - reference).abs().max().item()
+    print("max |exported - eager| %.6f, relative %.2e" %
+          (error, error / max(reference.abs().max().item(), 1e-12)))
+    print("eager %.2f ms  exported %.2f ms  speedup x%.2f" %
+          (1000 * timings['eager'], 1000 * timings['exported'],
+           timings['eager'] / timings['exported']))
+    return error, timings
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument('--export_format', type=str, default='torchscript',
+                        choices=['torchscript', 'onnx'],
+                        help='Format of the exported sampler.')
+    parser.add_argument('--export_output', type=str, default='sampler.pt',
+                        help='Path of the exported sampler.')
+    parser.add_argument('--export_batch_size', type=int, default=1,
+                        help='Batch size of the example inputs used for the export.')
+    args = parser.parse_args()
+
+    model = CondINNWrapper(args, img_dims=(256, 256)).to(args.device)
+    if args.resume_checkpoint is not None:
+        model.resume(args.resume_checkpoint,
+                     strict=(not args.resume_non_strict))
+    model.eval()
+
+    sampler = SamplerModule(model)
+    example = sampler.example_inputs(args.export_batch_size)
+
+    if args.export_format == 'onnx':
+        export_onnx(sampler, example, args.export_output)
+        try:
+            exported = load_onnx(args.export_output)
+        except ImportError as e:
+            print('%s, skipping the ONNX parity check' % e)
+            exported = None
+    else:
+        export_torchscript(sampler, example, args.export_output)
+        exported = torch.jit.load(args.export_output)
+    print('exported to ' + args.export_output)
+
+    if exported is not None:
+        # a different batch size than the traced one
+        check_export(sampler, exported,
+                     sampler.example_inputs(args.export_batch_size + 1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+import cv2
+import numpy as np
+from functools import partial
+import torch
+from torch import nn
+
+from FrEIA.framework import *
+from FrEIA.modules import *
+from utils import standard_normal_logprob
+from models.cond_inn import Trainable, FlowModule, CondINNWrapper, subnet_fc
+import models.config as c
+import models.modules as modules
+
+
+def rasterize_boundary(points, size=128):
+    """
+    Filled polygons of ordered boundary points.
+    points [B, N, 2] normalized (x, y) in [0, 1] -> masks [B, 1, size, size]
+    in the 0-255 range of the dense masks.
+    """
+    polygons = (points.detach().clamp(0., 1.).cpu().numpy() * size).round().astype(np.int32)
+    masks = np.zeros((len(polygons), 1, size, size), dtype=np.float32)
+    for mask, polygon in zip(masks, polygons):
+        cv2.fillPoly(mask[0], [polygon], 255.)
+    return torch.from_numpy(masks).to(points.device)
+
+
+class BoundaryFlow(FlowModule):
+    """
+    Conditional flow over num_boundary_points ordered (x, y) boundary points,
+    conditioned on a pooled image / class vector.
+    """
+
+    def __init__(self, args, cond_length, extra_params=None):
+        self.cond_length = cond_length
+        super(BoundaryFlow, self).__init__(self.flow_constructor, args=args)
+        extra_params = extra_params or []
+
+        self.optimizer = self.make_optimizer(
+            'adam', {'lr': args.boundary_lr, 'beta1': args.beta1, 'beta2': args.beta2, 'weight_decay': args.weight_decay}, list(self.flow_model.parameters()) + extra_params)
+        self.scheduler = self.make_scheduler(args, self.optimizer)
+
+    def flow_constructor(self, args):
+
+        ndim_x = 2 * args.num_boundary_points
+        input_node = InputNode(ndim_x, name='inp_points')
+        conditions = [ConditionNode(self.cond_length, name='cond-0')]
+
+        nodes = []
+        nodes.append(input_node)
+        fc_subnet = partial(subnet_fc, autocast=True) if args.bf16 else subnet_fc
+
+        for k in range(8):
+            nodes.append(Node(nodes[-1],
+                              GLOWCouplingBlock,
+                              {'subnet_constructor': fc_subnet, 'clamp': 2.0},
+                              conditions=conditions[0],
+                              name=F'fully_connected_{k}'))
+            nodes.append(Node(nodes[-1],
+                              PermuteRandom,
+                              {'seed': k},
+                              name=F'permute_{k}'))
+        print(nodes[-1].out0[0].output_dims)
+
+        nodes.append(OutputNode(nodes[-1], name='output'))
+
+        inn = GraphINN(nodes + conditions, verbose=False)
+        inn = inn.to(args.device)
+
+        def init_model(model):
+            for key, param in model.named_parameters():
+                split = key.split('.')
+                if param.requires_grad:
+                    # c.init_scale = 0.03 (nearly xavier initialization)
+                    param.data = c.init_scale * \
+                        torch.randn(param.data.shape, device=param.device)
+                    # last linear layer in the coeff func
+                    if len(split) > 3 and split[3][-1] == '2':
+                        param.data.fill_(0.)
+            return model
+
+        return init_model(inn)
+
+    def forward(self, x, c=None, rev=False):
+        return self.flow_model(x, c=c, rev=rev)
+
+
+class BoundaryINNWrapper(Trainable):
+    """
+    Boundary model mode: instead of a dense 128x128 mask, a flow over the
+    ordered object boundary points (see dataset_coco.mask_to_boundary),
+    which are only rasterized to masks when a mask is needed. The condition
+    is the cond-1 level of the image condition pyramid of CondINNWrapper,
+    pooled to a vector, concatenated with the one-hot class condition.
+    """
+
+    def __init__(self, args, img_dims=None):
+        super(BoundaryINNWrapper, self).__init__()
+        self.args = args
+        self.num_points = args.num_boundary_points
+        self.mask_size = 128
+        self.device = torch.device(args.device)
+        self.iter = 0
+
+        self.image_encoder = nn.Sequential(nn.Conv2d(3 * 64, 128, 3, stride=2, padding=1), nn.LeakyReLU(),  # 128x16x16
+                                           nn.Conv2d(128, 256, 3, stride=2, padding=1), nn.LeakyReLU(),  # 256x8x8
+                                           nn.AdaptiveAvgPool2d(1), nn.Flatten())  # 256
+        cond_length = 256 + args.num_classes + 1
+
+        self.boundaryflow = BoundaryFlow(
+            args, cond_length, extra_params=list(self.image_encoder.parameters()))
+
+        self.optimizers.append(self.boundaryflow.optimizer)
+        self.schedulers.append(self.boundaryflow.scheduler)
+
+    def save(self, epoch, path):
+        d = {
+            'epoch': epoch,
+            'model': self.state_dict(),
+            'boundary-optimizer': self.optimizers[0].state_dict()
+        }
+        torch.save(d, path)
+
+    def resume(self, path, strict=True):
+        ckpt = torch.load(path)
+        self.load_state_dict(ckpt['model'], strict=strict)
+        start_epoch = ckpt['epoch']
+        if self.optimizers[0] is not None:
+            if 'boundary-optimizer' not in ckpt and not strict:
+                print('no boundary-optimizer state in the checkpoint, starting it fresh')
+            else:
+                self.optimizers[0].load_state_dict(ckpt['boundary-optimizer'])
+        return start_epoch
+
+    def make_condition(self, x, class_cond):
+        """image [B, 3, 256, 256] + one-hot class [B, num_classes + 1] -> [B, cond_length]"""
+        _, x = modules.squeeze_pyramid(x.float().to(self.device), (4, 2))
+        features = self.image_encoder(x / 255.)
+        return torch.cat([features, class_cond.float().to(self.device)], dim=1)
+
+    def forward(self, x, y, cond, writer=None, monitor=False, presence=None):
+        """
+        One optimization step on boundary points y [B, N, 2]. With
+        monitor=True the rasterized sample mean mask of the first example is
+        decoded as well, otherwise it is None. presence is not used (no
+        presence head).
+        """
+
+        self.iter += 1
+        self.boundaryflow.optimizer.zero_grad()
+
+        y = y.float().to(self.device)
+        y = y + 1.0/256 * torch.randn_like(y)
+        condition = self.make_condition(x, cond)
+
+        z, log_jac_det = self.boundaryflow(y.view(y.size(0), -1), c=[condition])
+        prior_prob = standard_normal_logprob(z).sum(dim=1)
+
+        loss_norm = z.size(1)
+        loss = -(prior_prob + log_jac_det).mean() / loss_norm
+        loss.backward()
+
+        torch.nn.utils.clip_grad_norm_(self.boundaryflow.parameters(), 8)
+        self.boundaryflow.optimizer.step()
+
+        sample_mean = None
+        if monitor:
+            with torch.no_grad():
+                sample_mean = self.decode_and_average(
+                    x[:1], cond[:1], self.args.batch_size)
+
+        losses = {
+            'train_loss': loss,
+            'logdet': log_jac_det.mean() / loss_norm,
+            'prior_prob': prior_prob.mean() / loss_norm,
+            'recons_error': abs(sample_mean - rasterize_boundary(y[:1], self.mask_size)[0]).mean() if monitor else None
+        }
+
+        return sample_mean, losses
+
+    def decode(self, x, class_cond, nr_sample, stddev=1.0):
+        """boundary points [B, nr_sample, N, 2] sampled for every image"""
+        B = x.size(0)
+        condition = self.make_condition(x, class_cond)
+        condition = condition.repeat_interleave(nr_sample, dim=0)
+
+        z = stddev * torch.randn(condition.size(0), 2 * self.num_points, device=self.device)
+        points, _ = self.boundaryflow(z, c=[condition], rev=True)
+        return points.view(B, nr_sample, self.num_points, 2)
+
+    def decode_masks(self, x, class_cond, nr_sample, stddev=1.0):
+        """mean of the rasterized samples [B, 1, 128, 128] for every image"""
+        points = self.decode(x, class_cond, nr_sample, stddev=stddev)
+        B = points.size(0)
+        masks = rasterize_boundary(points.view(-1, self.num_points, 2),
+                                   self.mask_size)
+        return masks.view(B, nr_sample, 1, self.mask_size, self.mask_size).mean(dim=1)
+
+    def decode_and_average(self, img, class_cond, nr_sample, pick=None):
+        """same interface as CondINNWrapper.decode_and_average"""
+        if pick is not None:
+            img, class_cond = img[pick:pick + 1], class_cond[pick:pick + 1]
+        return self.decode_masks(img, class_cond, nr_sample)[0]
+
+
+# model class per args.model_mode
+MODEL_MODES = {
+    'mask': CondINNWrapper,
+    'boundary': BoundaryINNWrapper,
+}
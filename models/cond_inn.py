@@ -2,6 +2,8 @@ import torch
 import numpy as np
 from torch import optim
 from torch import nn
+import torch.nn.functional as F
+from functools import partial
 from models.flow import get_latent_cnf
 from models.flow import get_hyper_cnf
 from utils import truncated_normal, standard_normal_logprob, standard_laplace_logprob
@@ -9,6 +11,7 @@ from torch.nn import init
 from torch.distributions.laplace import Laplace
 from torchvision.models.resnet import resnet50, resnet101
 from torchvision.models.detection.backbone_utils import resnet_fpn_backbone
+from torchvision.ops import roi_align
 import mmfp_utils
 
 from FrEIA.framework import *
@@ -17,6 +20,8 @@ from models.reshapes import haar_multiplex_layer
 import models.subnet_coupling as subnet_coupling
 import models.config as c
 import models.modules as modules
+from models.graph_plan import GraphPlan, fold_fixed_transforms
+import models.quantization as quantization
 
 from scipy.stats import laplace
 
@@ -35,29 +40,172 @@ def subnet_initialization(m):
         # m.bias.data.fill_(0.)
 
 
-def subnet_fc(c_in, c_out):
+class AutocastSubnet(nn.Sequential):
+    """
+    Coupling subnet run under bfloat16 autocast. The output is cast back to
+    float32, so the coupling around it (clamp, exp, log-det) stays in
+    float32. Same parameters and state dict keys as the nn.Sequential.
+    """
+
+    def forward(self, inputs):
+        x = inputs[0] if isinstance(inputs, tuple) else inputs
+        with torch.autocast(device_type=x.device.type, dtype=torch.bfloat16):
+            out = super(AutocastSubnet, self).forward(inputs)
+        return out.float()
+
+
+def subnet_fc(c_in, c_out, autocast=False):
     print('subnet_fc: ', c_in, c_out)
-    net = nn.Sequential(nn.Linear(c_in, 64), nn.LeakyReLU(),
-                        nn.Linear(64,  c_out))
+    net = (AutocastSubnet if autocast else nn.Sequential)(
+        nn.Linear(c_in, 64), nn.LeakyReLU(),
+        nn.Linear(64,  c_out))
     net.apply(subnet_initialization)
     return net
 
 
-def subnet_conv(c_in, c_out):
+def subnet_conv(c_in, c_out, autocast=False):
     print('subnet_cont: ', c_in, c_out)
-    net = nn.Sequential(nn.Conv2d(c_in, 128,   3, padding=1), nn.LeakyReLU(),
-                        nn.Conv2d(128,  c_out, 3, padding=1))
+    net = (AutocastSubnet if autocast else nn.Sequential)(
+        nn.Conv2d(c_in, 128,   3, padding=1), nn.LeakyReLU(),
+        nn.Conv2d(128,  c_out, 3, padding=1))
     net.apply(subnet_initialization)
     return net
 
-def subnet_conv_1x1(c_in, c_out):
+def subnet_conv_1x1(c_in, c_out, autocast=False):
     print('subnet_conv_1x1: ', c_in, c_out)
-    net = nn.Sequential(nn.Conv2d(c_in, 128,   1), nn.LeakyReLU(),
-                        nn.Conv2d(128,  c_out, 1))
+    net = (AutocastSubnet if autocast else nn.Sequential)(
+        nn.Conv2d(c_in, 128,   1), nn.LeakyReLU(),
+        nn.Conv2d(128,  c_out, 1))
+    net.apply(subnet_initialization)
+    return net
+
+
+class CondSplitSubnet(nn.Sequential):
+    """
+    Coupling subnet whose first conv only sees the data half. The condition
+    half of that conv is precomputed by ConditionProjection and added to the
+    pre-activation, which is the same as convolving [x, cond] in one go.
+    """
+
+    def forward(self, inputs):
+        x, h = inputs
+        return self[2](self[1](self[0](x) + h))
+
+
+class AutocastCondSplitSubnet(AutocastSubnet, CondSplitSubnet):
+    pass
+
+
+def subnet_conv_split(c_in, c_out, autocast=False):
+    print('subnet_conv_split: ', c_in, c_out)
+    net = (AutocastCondSplitSubnet if autocast else CondSplitSubnet)(
+        nn.Conv2d(c_in, 128,   3, padding=1), nn.LeakyReLU(),
+        nn.Conv2d(128,  c_out, 3, padding=1))
+    net.apply(subnet_initialization)
+    return net
+
+
+def subnet_conv_1x1_split(c_in, c_out, autocast=False):
+    print('subnet_conv_1x1_split: ', c_in, c_out)
+    net = (AutocastCondSplitSubnet if autocast else CondSplitSubnet)(
+        nn.Conv2d(c_in, 128,   1), nn.LeakyReLU(),
+        nn.Conv2d(128,  c_out, 1))
     net.apply(subnet_initialization)
     return net
 
 
+class ConditionProjection(nn.Module):
+    """
+    Condition part of the first subnet conv of every coupling block at one
+    SegFlow level, stacked into a single conv per kernel size.
+    Returns one [B, 2 * hidden, H, W] tensor per block (subnet1 | subnet2).
+    B may be 1 for a batch of samples of the same image, the projections are
+    broadcast against the data half inside CondSplitSubnet.
+    """
+
+    def __init__(self, c_in, kernel_sizes, hidden=128):
+        super(ConditionProjection, self).__init__()
+        self.kernel_sizes = list(kernel_sizes)
+        self.hidden = hidden
+
+        self.convs = nn.ModuleDict()
+        for k in sorted(set(self.kernel_sizes)):
+            n_blocks = self.kernel_sizes.count(k)
+            conv = nn.Conv2d(c_in, n_blocks * 2 * hidden,
+                             k, padding=k // 2, bias=False)
+            conv.weight.data = c.init_scale * torch.randn(conv.weight.shape)
+            self.convs[str(k)] = conv
+
+    def forward(self, cond):
+        projected = {}
+        for k, conv in self.convs.items():
+            n_blocks = self.kernel_sizes.count(int(k))
+            projected[k] = iter(torch.chunk(conv(cond), n_blocks, dim=1))
+        return [next(projected[str(k)]) for k in self.kernel_sizes]
+
+
+class SharedCondGLOWCouplingBlock(GLOWCouplingBlock):
+    """
+    GLOWCouplingBlock taking its condition as the output of a
+    ConditionProjection instead of the raw condition tensor, so the condition
+    convolution is shared by all blocks of a level instead of being redone by
+    every subnet.
+    """
+
+    def __init__(self, dims_in, dims_c=[], subnet_constructor=None,
+                 clamp=2., clamp_activation="ATAN"):
+        # skip GLOWCouplingBlock.__init__, the subnets only see the data half
+        super(GLOWCouplingBlock, self).__init__(
+            dims_in, dims_c, clamp, clamp_activation)
+        self.hidden = self.condition_length // 2
+
+        self.subnet1 = subnet_constructor(self.split_len1, self.split_len2 * 2)
+        self.subnet2 = subnet_constructor(self.split_len2, self.split_len1 * 2)
+
+    def coupling_halves(self, x, c, rev=False):
+        """the two output halves and the log det, before concatenation"""
+        x1, x2 = torch.split(x, [self.split_len1, self.split_len2], dim=1)
+        h1, h2 = torch.split(c[0], [self.hidden, self.hidden], dim=1)
+
+        if not rev:
+            y1, j1 = self._coupling1(x1, (x2, h2))
+            y2, j2 = self._coupling2(x2, (y1, h1))
+        else:
+            y2, j2 = self._coupling2(x2, (x1, h1), rev=True)
+            y1, j1 = self._coupling1(x1, (y2, h2), rev=True)
+        return y1, y2, j1 + j2
+
+    def forward(self, x, c=[], rev=False, jac=True):
+        y1, y2, log_jac = self.coupling_halves(x[0], c, rev=rev)
+        return (torch.cat((y1, y2), 1),), log_jac
+
+
+class ChannelsLastPermuteRandom(PermuteRandom):
+    """
+    PermuteRandom of channels-last activations (--channels_last). The channel
+    gather of PermuteRandom returns NCHW, the output is converted back so
+    the next coupling block gets channels-last input.
+    """
+
+    def forward(self, x, rev=False, jac=True):
+        perm = self.perm_inv if rev else self.perm
+        return [x[0][:, perm].contiguous(memory_format=torch.channels_last)], 0.
+
+
+class ChannelsLastFlatten(Flatten):
+    """
+    Flatten of channels-last activations (--channels_last): the flat vector
+    is in NCHW order as with Flatten, and the reverse gives channels-last
+    activations back.
+    """
+
+    def forward(self, x, c=None, jac=True, rev=False):
+        if not rev:
+            return (x[0].reshape(x[0].shape[0], -1),), 0.
+        out = x[0].view(x[0].shape[0], *self.input_shape)
+        return (out.contiguous(memory_format=torch.channels_last),), 0.
+
+
 class ListModule(nn.Module):
     def __init__(self, *args):
         super(ListModule, self).__init__()
@@ -133,16 +281,33 @@ class Trainable(nn.Module):
             'prior-optimizer': self.optimizers[0].state_dict(),
             'seg-optimizer': self.optimizers[1].state_dict()
         }
+        if len(self.optimizers) > 2:
+            d['presence-optimizer'] = self.optimizers[2].state_dict()
         torch.save(d, path)
 
     def resume(self, path, strict=True):
         ckpt = torch.load(path)
+        if ckpt.get('quantized') is not None:
+            # INT8 subnets (see models/quantization.py), inference only
+            quantization.quantize_subnets(self, backend=ckpt['quantized'])
+            self.load_state_dict(ckpt['model'], strict=strict)
+            return ckpt['epoch']
         self.load_state_dict(ckpt['model'], strict=strict)
         start_epoch = ckpt['epoch']
-        if self.optimizers[0] is not None:
-            self.optimizers[0].load_state_dict(ckpt['prior-optimizer'])
-        if self.optimizers[1] is not None:
-            self.optimizers[1].load_state_dict(ckpt['seg-optimizer'])
+        keys = ['prior-optimizer', 'seg-optimizer', 'presence-optimizer']
+        for optimizer, key in zip(self.optimizers, keys):
+            if optimizer is None:
+                continue
+            if key not in ckpt and not strict:
+                print('no %s state in the checkpoint, starting it fresh' % key)
+                continue
+            try:
+                optimizer.load_state_dict(ckpt[key])
+            except ValueError as e:
+                # parameter groups of a different model version
+                if strict:
+                    raise
+                print('skipping the %s state: %s' % (key, e))
         return start_epoch
 
     def scheduler_step(self, epoch):
@@ -155,10 +320,22 @@ class FlowModule(Trainable):
 
     def __init__(self, flow_contructor, args=None):
         super(FlowModule, self).__init__()
+        # see fold_for_inference
+        self.inference_plan = None
         self.inn = flow_contructor(args)
 
+    def fold_for_inference(self):
+        """
+        Folds the fixed permutations and Haar transforms of the flow into
+        the neighbouring layers (graph_plan.fold_fixed_transforms), used in
+        eval mode in place of the GraphINN. Call after moving the model.
+        """
+        self.inference_plan = fold_fixed_transforms(self.inn)
+
     @property
     def flow_model(self):
+        if self.inference_plan is not None and not self.training:
+            return self.inference_plan
         return self.inn
 
 
@@ -167,19 +344,58 @@ class SegFlow(FlowModule):
     def __init__(self, args, img_dims=None):
         super(SegFlow, self).__init__(self.flow_constructor, args=args)
         self.img_dims = img_dims
+        self.memory_format = modules.memory_format(args)
+        # stepwise execution of the flow, used by the coarse-to-fine decoding
+        self.plan = GraphPlan(self.flow_model)
 
+        # flow_model + the shared condition projections (if any)
         self.optimizer = self.make_optimizer(
-            'adam', {'lr': args.seg_lr, 'beta1': args.beta1, 'beta2': args.beta2, 'weight_decay': args.weight_decay}, list(self.flow_model.parameters()))
+            'adam', {'lr': args.seg_lr, 'beta1': args.beta1, 'beta2': args.beta2, 'weight_decay': args.weight_decay}, list(self.parameters()))
         self.scheduler = self.make_scheduler(args, self.optimizer)
 
     def flow_constructor(self, args, ndim_x=4*64*64):
 
+        self.shared_cond_proj = args.shared_cond_proj
+
         input_node = InputNode(4, 64, 64, name='inp_points')
         conditions = [ConditionNode(3 * 16, 256 // 4, 256 // 4, name='cond-0'),
                       ConditionNode(
             3 * 64, 256 // 8, 256 // 8, name='cond-1'),
             ConditionNode(1000, name='cond-2')]
 
+        high_res_subnets = [subnet_conv] * 8
+        low_res_subnets = [subnet_conv_1x1 if k % 2 == 0 else subnet_conv
+                           for k in range(8)]
+        high_res_conditions = [conditions[0]] * 8
+        self.high_res_blocks = [F'conv{k}::c1' for k in range(8)]
+        low_res_conditions = [conditions[1]] * 8
+
+        if self.shared_cond_proj:
+            # every block gets its own slice of a per-level projection of
+            # cond-0 / cond-1, computed once in self.project_conditions
+            self.cond_projections = nn.ModuleList([
+                ConditionProjection(3 * 16, [3] * 8),
+                ConditionProjection(3 * 64, [1 if k % 2 == 0 else 3
+                                             for k in range(8)])]).to(args.device)
+
+            high_res_subnets = [subnet_conv_split] * 8
+            low_res_subnets = [subnet_conv_1x1_split if k % 2 == 0 else subnet_conv_split
+                               for k in range(8)]
+            high_res_conditions = [ConditionNode(2 * 128, 256 // 4, 256 // 4, name=F'cond-0-{k}')
+                                   for k in range(8)]
+            low_res_conditions = [ConditionNode(2 * 128, 256 // 8, 256 // 8, name=F'cond-1-{k}')
+                                  for k in range(8)]
+            conditions = high_res_conditions + \
+                low_res_conditions + conditions[2:]
+
+        fc_subnet = subnet_fc
+        if args.bf16:
+            high_res_subnets = [partial(subnet, autocast=True)
+                                for subnet in high_res_subnets]
+            low_res_subnets = [partial(subnet, autocast=True)
+                               for subnet in low_res_subnets]
+            fc_subnet = partial(subnet_fc, autocast=True)
+
         nodes = []
 
         # input nodes
@@ -201,46 +417,45 @@ class SegFlow(FlowModule):
         """
 
         block = GLOWCouplingBlock
+        cond_block = SharedCondGLOWCouplingBlock if self.shared_cond_proj else GLOWCouplingBlock
+        # the 4D activations stay channels-last up to the flatten node
+        permute_block = ChannelsLastPermuteRandom if args.channels_last else PermuteRandom
+        flatten_block = ChannelsLastFlatten if args.channels_last else Flatten
 
         for k in range(8):
             print(k)
             conv = Node(nodes[-1],
-                        block,
-                        {'subnet_constructor': subnet_conv, 'clamp': 2.0},
-                        conditions=conditions[0],
+                        cond_block,
+                        {'subnet_constructor': high_res_subnets[k], 'clamp': 2.0},
+                        conditions=high_res_conditions[k],
                         name=F'conv{k}::c1')
             nodes.append(conv)
             print(nodes[-1].out0[0].output_dims)
-            permute = Node(nodes[-1], PermuteRandom,
+            permute = Node(nodes[-1], permute_block,
                            {'seed': k}, name=F'permute_{k}')
             nodes.append(permute)
             print(nodes[-1].out0[0].output_dims)
 
-        nodes.append(Node(nodes[-1], HaarDownsampling, {}))
+        nodes.append(Node(nodes[-1], HaarDownsampling, {}, name='haar'))
         print(nodes[-1].out0[0].output_dims)
 
         for k in range(8):
             print(k)
-            if k % 2 == 0:
-                subnet = subnet_conv_1x1
-            else:
-                subnet = subnet_conv
-
             linear = Node(nodes[-1],
-                            block,
-                            {'subnet_constructor': subnet, 'clamp': 1.2},
-                            conditions=conditions[1],
+                            cond_block,
+                            {'subnet_constructor': low_res_subnets[k], 'clamp': 1.2},
+                            conditions=low_res_conditions[k],
                             name=F'conv_low_res_{k}')
             nodes.append(linear)
             print(nodes[-1].out0[0].output_dims)
-            permute = Node(nodes[-1], PermuteRandom,
+            permute = Node(nodes[-1], permute_block,
                             {'seed': k}, name=F'permute_low_res_{k}')
             nodes.append(permute)
             print(nodes[-1].out0[0].output_dims)
         print(nodes[-1].out0[0].output_dims)
 
         nodes.append(
-            Node(nodes[-1], Flatten, {}, name='flatten'))
+            Node(nodes[-1], flatten_block, {}, name='flatten'))
         print(nodes[-1].out0[0].output_dims)
 
         split_node = Node(nodes[-1],
@@ -255,8 +470,8 @@ class SegFlow(FlowModule):
         for k in range(4):
             nodes.append(Node(nodes[-1],
                               block,
-                              {'subnet_constructor': subnet_fc, 'clamp': 2.0},
-                              conditions=conditions[2],
+                              {'subnet_constructor': fc_subnet, 'clamp': 2.0},
+                              conditions=conditions[-1],
                               name=F'fully_connected_{k}'))
             print(nodes[-1].out0[0].output_dims)
             nodes.append(Node(nodes[-1],
@@ -273,7 +488,7 @@ class SegFlow(FlowModule):
         nodes.append(OutputNode(nodes[-1], name='output'))
 
         inn = GraphINN(nodes + conditions, verbose=False)
-        inn = inn.cuda()
+        inn = inn.to(args.device)
 
         def init_model(model):
             for key, param in model.named_parameters():
@@ -282,7 +497,7 @@ class SegFlow(FlowModule):
                 if param.requires_grad:
                     # c.init_scale = 0.03 (nearly xavier initialization)
                     param.data = c.init_scale * \
-                        torch.randn(param.data.shape).cuda()
+                        torch.randn(param.data.shape, device=param.device)
                     # last convolution in the coeff func
                     if len(split) > 3 and split[3][-1] == '2':
                         param.data.fill_(0.)
@@ -291,12 +506,24 @@ class SegFlow(FlowModule):
 
         return init_model(inn)
 
+    def project_conditions(self, c):
+        """
+        [cond-0, cond-1, cond-2] -> per-block condition projections followed
+        by cond-2, in the order of the flow's condition nodes.
+        """
+        high_res = self.cond_projections[0](c[0])
+        low_res = self.cond_projections[1](c[1])
+        return high_res + low_res + list(c[2:])
+
     def forward(self, x, c=[], rev=False):
         # if load_inn_only:
         #    self.cinn.load_state_dict(torch.load(load_inn_only)['net'])
 
+        if self.shared_cond_proj:
+            c = self.project_conditions(c)
+
         if rev is False:
-            x = modules.squeeze2d(x, factor=2)
+            x = modules.squeeze2d(x, factor=2, memory_format=self.memory_format)
             z, log_jac_det = self.flow_model(x, c=c, rev=rev)
         else:
             z, log_jac_det = self.flow_model(x, c=c, rev=rev)
@@ -304,6 +531,37 @@ class SegFlow(FlowModule):
 
         return z, log_jac_det
 
+    def decode_coarse(self, z, c=[]):
+        """
+        Cheap approximate reverse pass: the low-res stage is run as usual,
+        the Haar upsampling gets a zero high-frequency residual and the
+        high-res coupling blocks are skipped (their permutations are kept).
+        Returns the coarse mask [B, 1, H, W] and the reverse state stopped
+        in front of the Haar node, which decode_refine resumes from.
+        """
+        if self.shared_cond_proj:
+            c = self.project_conditions(c)
+
+        state = self.plan.init_state(z, c=c, rev=True)
+        self.plan.run(state, until='haar', jac=False)
+
+        coarse_state = self.plan.copy(state)
+        key, = self.plan.steps[True][state['pos']][1]
+        coeffs = coarse_state['outs'][key]
+        # keep the Haar averages (channels 4 * i) only
+        averages = torch.zeros_like(coeffs)
+        averages[:, 0::4] = coeffs[:, 0::4]
+        coarse_state['outs'][key] = averages
+        self.plan.run(coarse_state, jac=False, skip=self.high_res_blocks)
+
+        coarse = modules.unsqueeze2d(self.plan.outputs(coarse_state), factor=2)
+        return coarse, state
+
+    def decode_refine(self, state):
+        """runs the rest of the reverse pass, mask [B, 1, H, W]"""
+        self.plan.run(state, jac=False)
+        return modules.unsqueeze2d(self.plan.outputs(state), factor=2)
+
 
 class PriorFlow(FlowModule):
     def __init__(self, args, extra_params=None):
@@ -321,6 +579,7 @@ class PriorFlow(FlowModule):
 
         nodes = []
         block = GLOWCouplingBlock
+        fc_subnet = partial(subnet_fc, autocast=True) if args.bf16 else subnet_fc
 
         # input nodes
         nodes.append(input_node)
@@ -337,7 +596,7 @@ class PriorFlow(FlowModule):
         for k in range(4):
             nodes.append(Node(nodes[-1],
                               block,
-                              {'subnet_constructor': subnet_fc, 'clamp': 2.0},
+                              {'subnet_constructor': fc_subnet, 'clamp': 2.0},
                               #conditions=conditions[0],
                               name=F'fully_connected_{k}'))
             print(nodes[-1].out0[0].output_dims)
@@ -355,7 +614,7 @@ class PriorFlow(FlowModule):
         nodes.append(OutputNode(nodes[-1], name='output'))
 
         inn = GraphINN(nodes + conditions, verbose=False)
-        inn = inn.cuda()
+        inn = inn.to(args.device)
 
         def init_model(model):
             for key, param in model.named_parameters():
@@ -364,7 +623,7 @@ class PriorFlow(FlowModule):
                 if param.requires_grad:
                     # c.init_scale = 0.03 (nearly xavier initialization)
                     param.data = c.init_scale * \
-                        torch.randn(param.data.shape).cuda()
+                        torch.randn(param.data.shape, device=param.device)
                     # last convolution in the coeff func
                     if len(split) > 3 and split[3][-1] == '2':
                         param.data.fill_(0.)
@@ -394,6 +653,10 @@ class CondINNWrapper(Trainable):
         """
 
         self.gpu = args.gpu
+        self.device = torch.device(args.device)
+        self.memory_format = modules.memory_format(args)
+        # buffers (and optional generators) of all the noise drawn below
+        self.noise = modules.NoiseBuffers()
         self.logprob_type = args.logprob_type
         self.bce_loss = nn.BCEWithLogitsLoss()
         self.fc_cond_length = 256
@@ -428,6 +691,12 @@ class CondINNWrapper(Trainable):
                         modules.Conv2dZeros(C * 2, C * 2)) 
         self.project_ycond = nn.Sequential(modules.LinearZeros(N, N), nn.LeakyReLU(), modules.LinearZeros(N, C*2), nn.LeakyReLU(), modules.LinearZeros(C*2, C*2))
         self.project_class = nn.Sequential(modules.LinearZeros(256, 512), nn.LeakyReLU(), modules.LinearZeros(512, 512), nn.LeakyReLU(), modules.LinearZeros(512, args.num_classes + 1))
+        # cheap class presence check on the cond-1 image condition (192x32x32),
+        # used to skip the mask decoding of absent classes
+        self.presence_head = nn.Sequential(nn.Conv2d(3 * 64, 128, 3, stride=2, padding=1), nn.LeakyReLU(),  # 128x16x16
+                                           nn.Conv2d(128, 128, 3, stride=2, padding=1), nn.LeakyReLU(),  # 128x8x8
+                                           nn.AdaptiveAvgPool2d(1), nn.Flatten(),
+                                           nn.Linear(128, args.num_classes + 1))
 
         self.register_parameter(
             "prior_h",
@@ -439,28 +708,43 @@ class CondINNWrapper(Trainable):
         self.segflow = SegFlow(args)
         self.priorflow = PriorFlow(
             args, extra_params=list(self.project_class.parameters()) + list(self.project_ycond.parameters()) + list(self.learn_top.parameters()))
+        # own optimizer, so that checkpoints from before the presence head
+        # still load into the prior optimizer
+        self.presence_optimizer = self.make_optimizer(
+            'adam', {'lr': args.prior_lr, 'beta1': args.beta1, 'beta2': args.beta2, 'weight_decay': args.weight_decay}, list(self.presence_head.parameters()))
 
         self.prior_optimizer = self.priorflow.optimizer
         self.seg_optimizer = self.segflow.optimizer
-        self.optimizers.extend([self.prior_optimizer, self.seg_optimizer])
+        self.optimizers.extend([self.prior_optimizer, self.seg_optimizer, self.presence_optimizer])
         self.schedulers.extend(
-            [self.priorflow.scheduler, self.segflow.scheduler])
+            [self.priorflow.scheduler, self.segflow.scheduler,
+             self.make_scheduler(args, self.presence_optimizer)])
+        # conv weights channels-last, the inputs are converted in squeeze2d
+        self.to(memory_format=self.memory_format)
+
+    def fold_for_inference(self):
+        """see FlowModule.fold_for_inference"""
+        self.segflow.fold_for_inference()
+        self.priorflow.fold_for_inference()
 
     def prior(self, y_onehot=None):
 
+        # the hidden prior state is all zeros, so a single row of it is
+        # broadcast over any number of class conditions
+        B = y_onehot.size(0)
         if self.training:
-            B, C = self.prior_h.size(0), self.prior_h.size(1)
-            hid = self.prior_h.detach().clone()
+            C = self.prior_h.size(1)
+            hid = self.prior_h[:1].detach().clone()
         else:
-            B, C = self.test_prior_h.size(0), self.test_prior_h.size(1)
-            hid = self.test_prior_h.detach().clone()
+            C = self.test_prior_h.size(1)
+            hid = self.test_prior_h[:1].detach().clone()
 
         assert torch.sum(hid) == 0.0
         # preserve # of input_channels == # of output_channels
         hid = self.learn_top(hid)
         # encode one-hot class-condition
         try:
-            hid += self.project_ycond(y_onehot).view(B, C, 1, 1)
+            hid = hid + self.project_ycond(y_onehot).view(B, C, 1, 1)
         except:
             import pdb
             pdb.post_mortem()
@@ -469,27 +753,31 @@ class CondINNWrapper(Trainable):
         logs = hid[:, C//2:, ...]
         return mean, logs
 
-    def forward(self, x, y, cond, writer=None):
+    def forward(self, x, y, cond, writer=None, monitor=False, presence=None):
+        """
+        One optimization step. With monitor=True the sample mean of the
+        first example is decoded as well (without grad tracking), otherwise
+        the returned sample mean and recons_error are None. presence is the
+        multi-hot [B, num_classes + 1] target of the presence head (all the
+        classes in the image, see dataset_coco.decode_mask), cond if None.
+        """
 
         self.iter += 1
 
         self.seg_optimizer.zero_grad()
         self.prior_optimizer.zero_grad()
+        self.presence_optimizer.zero_grad()
 
         batch_size = x.size(0)
 
-        x = x.float().cuda()
-        y = y.float().cuda() + 1.0/256 *torch.normal(mean=torch.zeros_like(y),
-                                            std=torch.ones_like(y)).cuda()
-        cond = cond.cuda()
-        class_labels = (cond == 1).nonzero(as_tuple=True)[1].reshape(cond.size(0), -1).repeat(1, 1000)
-        class_labels = class_labels.float().cuda()
+        x = x.float().to(self.device)
+        y = y.float().to(self.device)
+        # dequantization noise, drawn on the device into a reused buffer
+        y = y + self.noise.normal('dequantization', y.shape, std=1.0/256, device=self.device)
+        cond = cond.to(self.device)
+        class_labels = self.class_condition(cond)
 
-        conditions = []
-        x = modules.squeeze2d(x, factor=4)
-        conditions.append(x)
-        x = modules.squeeze2d(x, factor=2)
-        conditions.append(x)
+        conditions = modules.squeeze_pyramid(x, (4, 2), memory_format=self.memory_format)
         conditions.append(class_labels)
 
         y = y.unsqueeze(1)
@@ -521,16 +809,22 @@ class CondINNWrapper(Trainable):
             #prior_prob = prior_prob.sum(dim=[1, 2, 3])
 
         # classification loss
-        y_logits = self.project_class(z_shaped2.mean(2).reshape(16, -1))
+        y_logits = self.project_class(z_shaped2.mean(2).reshape(batch_size, -1))
         bce_loss = self.bce_loss(y_logits, cond)
         _, predicted = torch.max(y_logits, dim=1)
         labels = (cond == 1).nonzero(as_tuple=True)[1]
         accuracy = (predicted == labels).sum() / len(labels)
 
+        # class presence head, the image conditions carry no gradient so it
+        # is trained independently of the flows
+        presence = cond if presence is None else presence.float().to(self.device)
+        presence_loss = self.bce_loss(self.presence_logits(conditions[1]), presence)
+
         loss1 = -seg_log_jac_det # -prior_log_jac_det
         loss1 += -prior_prob
         loss1 = loss1.mean() / loss_norm
         loss1 += bce_loss
+        loss1 += presence_loss
         loss1.backward()
 
         """
@@ -549,6 +843,7 @@ class CondINNWrapper(Trainable):
 
         self.seg_optimizer.step()
         self.prior_optimizer.step()
+        self.presence_optimizer.step()
 
         # import pdb; pdb.set_trace()
         # print('z-min: ', z.min())
@@ -556,7 +851,11 @@ class CondINNWrapper(Trainable):
         # print('z-mean: ', z.mean())
 
         sample_to_take_mean = 0
-        sample_mean = self.decode_and_average2(conditions, self.args.batch_size, pick=sample_to_take_mean)
+        sample_mean = None
+        if monitor:
+            with torch.no_grad():
+                sample_mean = self.decode_and_average2(
+                    conditions, self.args.batch_size, pick=sample_to_take_mean)
 
         """ test example if for debugging
         z_perturb = z_before + \
@@ -574,7 +873,8 @@ class CondINNWrapper(Trainable):
             'logdet': seg_log_jac_det.mean() / loss_norm,
             'prior_prob': prior_prob.mean() / loss_norm,
             'bce_loss': bce_loss,
-            'recons_error': abs(sample_mean - y[sample_to_take_mean]).mean()
+            'presence_loss': presence_loss,
+            'recons_error': abs(sample_mean - y[sample_to_take_mean]).mean() if monitor else None
         }
 
         # z = z.view(z.size(0), 3, 64, 64)
@@ -582,32 +882,65 @@ class CondINNWrapper(Trainable):
         return sample_mean, losses
 
     @staticmethod
-    def sample_gaussian(size, truncate_std=None, gpu=None):
-        y = torch.randn(*size).float()
-        y = y if gpu is None else y.cuda(gpu)
-        if truncate_std is not None:
-            truncated_normal(y, mean=0, std=1, trunc_std=truncate_std)
-        return y
-
-    @staticmethod
-    def sample_gaussian(size, truncate_std=None, gpu=None):
-        y = torch.randn(*size).float()
-        y = y if gpu is None else y.cuda(gpu)
+    def sample_gaussian(size, truncate_std=None, device=None, generator=None):
+        y = torch.randn(*size, device=device, generator=generator)
         if truncate_std is not None:
             truncated_normal(y, mean=0, std=1, trunc_std=truncate_std)
         return y
 
     @staticmethod
-    def sample_laplace(size, gpu=None):
+    def sample_laplace(size, device=None):
         m = Laplace(torch.tensor([0.0]), torch.tensor([1.0]))
         y = m.sample(sample_shape=torch.Size(
             [size[0], size[1], size[2]])).float().squeeze(3)
-        y = y if gpu is None else y.cuda(gpu)
+        y = y if device is None else y.to(device)
         return y
 
-    def decode_and_average(self, img, class_cond, nr_sample, pick=None):
+    @staticmethod
+    def class_condition(cond):
+        """
+        one-hot class condition [B, num_classes + 1] -> class index repeated
+        into the 1000-d cond-2 vector used by both flows
+        """
+        class_labels = (cond == 1).nonzero(as_tuple=True)[1].reshape(cond.size(0), -1).repeat(1, 1000)
+        return class_labels.float()
+
+    def presence_logits(self, cond1):
+        return self.presence_head(cond1 / 255.)
+
+    def class_presence(self, cond1, class_cond):
+        """
+        Probability that the requested (one-hot) class is in the image, from
+        the presence head only (no flow evaluation).
+        """
+        prob = torch.sigmoid(self.presence_logits(cond1))
+        return (prob * class_cond).sum(dim=1)
 
-        x = self.decode(img, class_cond, nr_sample, pick=pick)
+    def decode_and_average_gated(self, img, class_cond, nr_sample, threshold=0.1):
+        """
+        decode_and_average for every image of the batch, skipping the
+        multi-sample SegFlow decode of images where the requested class is
+        confidently absent (presence < threshold). Rejected images get an
+        empty mask, as the dataset does for absent classes.
+        Returns the mean masks [B, 1, H, W] and the presence flags [B].
+        """
+        class_cond = class_cond.to(self.device)
+        conditions = self.make_conditions(img, class_cond)
+
+        presence = self.class_presence(conditions[1], class_cond)
+        # "unlabeled" (class 0) requests are never rejected
+        present = (presence >= threshold) | (class_cond[:, 0] == 1)
+
+        sample_means = torch.zeros(img.size(0), 1, img.size(2) // 2, img.size(3) // 2, device=self.device)
+        for pick in present.nonzero(as_tuple=True)[0].tolist():
+            x = self.decode_using_learned_sampler(conditions, nr_sample, pick=pick)
+            sample_means[pick] = x.mean(dim=0)
+
+        return sample_means, present
+
+    def decode_and_average(self, img, class_cond, nr_sample, pick=None, sampler='iid'):
+
+        x = self.decode(img, class_cond, nr_sample, pick=pick, sampler=sampler)
         sample_mean = x.mean(dim=0)
 
         return sample_mean
@@ -620,7 +953,12 @@ class CondINNWrapper(Trainable):
 
         return sample_mean
 
-    def decode_using_learned_sampler(self, conditions, nr_sample, pick=None, dist='gaussian'):
+    def decode_using_learned_sampler(self, conditions, nr_sample, pick=None, dist='gaussian', sampler='iid'):
+        """
+        sampler: how the latent noise of the samples is drawn, one of
+        modules.SAMPLERS ('iid', 'antithetic', 'sobol'). The variance reduced
+        samplers make the sample mean converge in fewer reverse passes.
+        """
 
         if nr_sample > 16:
             assert ValueError("Too many samples for batch execution")
@@ -630,46 +968,412 @@ class CondINNWrapper(Trainable):
             if dist == 'gaussian':
                 #z = torch.normal(mean=torch.zeros_like(
                 #    mean), std=torch.ones_like(mean) * stddev)
-                z = modules.GaussianDiag.sample(mean, logs, eps_std=stddev)
-                z = modules.unsqueeze2d(z, factor=2)
-                z = z.view(z.size(0), -1)
+                # the rows are the samples of the picked image, or one
+                # sample of every image
+                n = mean.size(0) if pick is not None else 1
+                eps = self.noise.sample(sampler, n, mean.shape[1:], device=mean.device,
+                                        images=mean.size(0) // n)
+                z = modules.GaussianDiag.sample(mean, logs, eps_std=stddev, eps=eps)
 
             return z
 
         if pick is not None:
-            cond0 = conditions[0][pick].unsqueeze(0).repeat(nr_sample, 1, 1, 1)
+            # projected image conditions broadcast over the samples, so they
+            # only need to be computed for the picked image
+            nr_repeat = 1 if self.segflow.shared_cond_proj else nr_sample
+            cond0 = conditions[0][pick].unsqueeze(0).repeat(nr_repeat, 1, 1, 1)
             conditions[0].detach()
-            cond1 = conditions[1][pick].unsqueeze(0).repeat(nr_sample, 1, 1, 1)
+            cond1 = conditions[1][pick].unsqueeze(0).repeat(nr_repeat, 1, 1, 1)
             conditions[1].detach()
             cond2 = conditions[2][pick].unsqueeze(0).repeat(nr_sample, 1)
             conditions[2].detach()
             conditions = [cond0, cond1, cond2]
 
-        mean, logs = self.prior(cond2)
+        mean, logs = self.prior(conditions[2])
         z = sample_from_dist(dist, mean, logs, stddev=0.1)
-        z_prime, _ = self.priorflow(z, c=cond2, rev=True)
+        return self.decode_latent(z, conditions)
+
+    def decode_latent(self, z, conditions):
+        """prior latent [B, 4, 64, 64] -> mask [B, 1, H, W]"""
+        z = modules.unsqueeze2d(z, factor=2)
+        z = z.view(z.size(0), -1)
+        z_prime, _ = self.priorflow(z, c=conditions[2], rev=True)
         x, _ = self.segflow(z_prime, c=conditions, rev=True)
         return x
 
-    def decode(self, x, class_cond, nr_sample, pick=None):
+    def decode_conditions(self, conditions, stddev=0.1, sampler='iid', nr_sample=1):
+        """
+        one sample of the learned sampler per row of conditions, the rows
+        being nr_sample consecutive samples of every image
+        """
+        mean, logs = self.prior(conditions[2])
+        eps = self.noise.sample(sampler, nr_sample, mean.shape[1:], device=mean.device,
+                                images=mean.size(0) // nr_sample)
+        z = modules.GaussianDiag.sample(mean, logs, eps_std=stddev, eps=eps)
+        return self.decode_latent(z, conditions)
+
+    @staticmethod
+    def sample_chunks(nr_sample, chunk_size, sampler='iid'):
+        """
+        (start, size) of the chunks of the nr_sample samples of an image.
+        For antithetic sampling the chunk size is rounded up to even, so
+        that no pair is split over two chunks. The Sobol points of the
+        chunks follow each other, see NoiseBuffers.sample.
+        """
+        if sampler == 'antithetic':
+            chunk_size += chunk_size % 2
+        for start in range(0, nr_sample, chunk_size):
+            yield start, min(chunk_size, nr_sample - start)
+
+    def decode_instances(self, img, class_cond, nr_sample, num_instances=2, iters=10,
+                         chunk_size=8, sampler='iid'):
+        """
+        Instance separation: instead of one mean mask, the nr_sample decoded
+        masks of every image are grouped with a batched k-means
+        (modules.batched_kmeans) on their 4x average pooled versions, and a
+        mean mask is taken per group. Samples are decoded chunk_size per
+        image at a time.
+        Returns the instance masks [B, K, 1, H, W] and the number of samples
+        per instance [B, K], with the instances sorted by sample count (empty
+        instances have count 0 and an all zero mask).
+        """
+        conditions = self.make_conditions(img, class_cond)
+        B = img.size(0)
+
+        samples = []
+        for _, n in self.sample_chunks(nr_sample, chunk_size, sampler):
+            chunk_conditions = [cond.repeat_interleave(n, dim=0)
+                                for cond in conditions]
+            x = self.decode_conditions(chunk_conditions, sampler=sampler, nr_sample=n)
+            samples.append(x.view(B, n, *x.shape[1:]))
+        samples = torch.cat(samples, dim=1)
+
+        features = F.avg_pool2d(samples.flatten(0, 1), 4) / 255.
+        assign, _ = modules.batched_kmeans(
+            features.view(B, nr_sample, -1), num_instances, iters=iters)
+
+        onehot = F.one_hot(assign, num_instances).type_as(samples)
+        counts = onehot.sum(dim=1)
+        masks = torch.bmm(onehot.transpose(1, 2), samples.flatten(2))
+        masks = masks / counts.clamp(min=1).unsqueeze(2)
+
+        counts, order = counts.sort(dim=1, descending=True)
+        masks = masks.gather(1, order.unsqueeze(2).expand_as(masks))
+        return masks.view(B, num_instances, *samples.shape[2:]), counts
+
+    def decode_classes(self, img, class_ids, nr_sample, sampler='iid'):
+        """
+        Masks of several classes of one image in a single batched
+        PriorFlow + SegFlow reverse pass. The image conditions are computed
+        once and broadcast over classes x samples instead of being rebuilt
+        per class.
+        img [1, 3, 256, 256], class_ids: list of K class ids.
+        Returns the per-class mean masks [K, 1, H, W].
+        """
+        K = len(class_ids)
+        class_cond = torch.zeros(K, self.args.num_classes + 1, device=self.device)
+        class_cond[torch.arange(K), torch.tensor(class_ids)] = 1
+
+        cond0, cond1, _ = self.make_conditions(img[:1], class_cond[:1])
+        if not self.segflow.shared_cond_proj:
+            # the shared condition projections broadcast by themselves
+            cond0 = cond0.expand(K * nr_sample, -1, -1, -1)
+            cond1 = cond1.expand(K * nr_sample, -1, -1, -1)
+        cond2 = self.class_condition(class_cond).repeat_interleave(nr_sample, dim=0)
+
+        x = self.decode_conditions([cond0, cond1, cond2], sampler=sampler,
+                                   nr_sample=nr_sample)
+        return x.view(K, nr_sample, *x.shape[1:]).mean(dim=1)
+
+    @staticmethod
+    def tile_blend_window(size, ramp):
+        """
+        [size, size] blending weights of a tile, ramping up linearly over
+        ramp pixels from each border, so overlapping tiles cross-fade
+        instead of leaving seams. Strictly positive, so pixels covered by a
+        single tile keep its value.
+        """
+        i = torch.arange(size).float() + 0.5
+        w = torch.min(i, size - i) / max(ramp, 1)
+        w = w.clamp(max=1.)
+        return w.view(-1, 1) * w.view(1, -1)
+
+    def decode_tiled(self, img, class_cond, nr_sample, tile_size=256, overlap=64,
+                     tile_batch=8, sampler='iid'):
+        """
+        Tiled inference for images larger than the 256x256 model input.
+        The image [1, 3, H, W] is cut into overlapping tile_size tiles, the
+        tiles are decoded tile_batch at a time with decode_streaming, and
+        the per-tile mean masks are blended back with tile_blend_window.
+        Returns the mean mask [1, 1, H', W'] at the mask resolution of the
+        model (H' = H / 2 for the 256 -> 128 model).
+        """
+        img = img.float().to(self.device)
+        class_cond = class_cond.to(self.device)
+        stride = tile_size - overlap
+        H, W = img.shape[2:]
+
+        # pad (replicate) so that the tiles cover the whole image
+        Hp = tile_size + max(0, -(-(H - tile_size) // stride)) * stride
+        Wp = tile_size + max(0, -(-(W - tile_size) // stride)) * stride
+        img = F.pad(img, (0, Wp - W, 0, Hp - H), mode='replicate')
+
+        tiles = F.unfold(img, tile_size, stride=stride)
+        nr_tiles = tiles.size(2)
+        tiles = tiles.transpose(1, 2).reshape(nr_tiles, 3, tile_size, tile_size)
+
+        masks = []
+        for start in range(0, nr_tiles, tile_batch):
+            batch = tiles[start:start + tile_batch]
+            masks.append(self.decode_streaming(
+                batch, class_cond.expand(batch.size(0), -1), nr_sample, sampler=sampler))
+        masks = torch.cat(masks, dim=0)
+
+        # tile geometry at the mask resolution
+        scale = tile_size // masks.size(-1)
+        mask_tile, mask_stride = tile_size // scale, stride // scale
+        window = self.tile_blend_window(mask_tile, overlap // scale).to(masks)
+
+        weighted = (masks * window).view(nr_tiles, -1).t().unsqueeze(0)
+        weights = window.view(-1, 1).expand(-1, nr_tiles).unsqueeze(0)
+        size = (Hp // scale, Wp // scale)
+        mask = F.fold(weighted, size, mask_tile, stride=mask_stride) / \
+            F.fold(weights, size, mask_tile, stride=mask_stride)
+
+        return mask[:, :, :H // scale, :W // scale]
+
+    def decode_streaming(self, img, class_cond, nr_sample, chunk_size=4, sampler='iid',
+                         return_uncertainty=False, threshold=127.5):
+        """
+        Mean mask of nr_sample samples for every image of the batch, decoded
+        chunk_size samples per image at a time, so memory does not grow with
+        nr_sample. With return_uncertainty, also returns per-pixel maps
+        accumulated over the same chunks:
+            variance: variance of the decoded mask values (Welford)
+            entropy:  binary entropy (nats) of the foreground frequency,
+                      i.e. the fraction of samples above threshold
+        Returns mean [B, 1, H, W], or (mean, variance, entropy).
+        """
+        conditions = self.make_conditions(img, class_cond)
+        B = img.size(0)
+
+        count = torch.zeros(B, device=self.device)
+        mean, m2, foreground = 0., 0., 0.
+        for _, n in self.sample_chunks(nr_sample, chunk_size, sampler):
+            chunk_conditions = [cond.repeat_interleave(n, dim=0)
+                                for cond in conditions]
+            x = self.decode_conditions(chunk_conditions, sampler=sampler, nr_sample=n)
+            x = x.view(B, n, *x.shape[1:])
+
+            count, mean, m2 = modules.welford_update(count, mean, m2, x)
+            foreground = foreground + (x > threshold).float().sum(dim=1)
+
+        if not return_uncertainty:
+            return mean
+
+        count = count.view(-1, 1, 1, 1)
+        variance = m2 / count
+        p = (foreground / count).clamp(1e-6, 1 - 1e-6)
+        entropy = -(p * torch.log(p) + (1 - p) * torch.log(1 - p))
+        return mean, variance, entropy
+
+    @staticmethod
+    def mask_bbox(masks, threshold=127.5):
+        """
+        Bounding boxes (x0, y0, x1, y1) [B, 4] in pixels of the mask values
+        above threshold, masks [B, 1, H, W], and whether a mask has any such
+        pixel [B].
+        """
+        fg = masks[:, 0] > threshold
+        cols, rows = fg.any(dim=1), fg.any(dim=2)
+        xs = torch.arange(cols.size(1), device=masks.device)
+        ys = torch.arange(rows.size(1), device=masks.device)
+        boxes = torch.stack([torch.where(cols, xs, cols.size(1)).min(dim=1)[0],
+                             torch.where(rows, ys, rows.size(1)).min(dim=1)[0],
+                             torch.where(cols, xs + 1, 0).max(dim=1)[0],
+                             torch.where(rows, ys + 1, 0).max(dim=1)[0]], dim=1)
+        return boxes.float(), cols.any(dim=1)
+
+    def decode_roi(self, img, class_cond, nr_sample, roi=None, margin=0.1, min_size=32,
+                   threshold=127.5, chunk_size=4, sampler='iid'):
+        """
+        ROI-cropped decoding. The region of interest of every image, roi
+        [B, 4] (x0, y0, x1, y1) in image pixels, comes from the caller or
+        from the bounding box of a decode_map first pass (full frame for
+        images where it finds nothing). A square box around it
+        (modules.square_boxes: enlarged by margin on every side, at least
+        min_size, reaching past the image where needed) is cropped and
+        resized to the native 256x256 input, zero outside the image, the
+        crop is decoded with decode_streaming and the mask is pasted back
+        (zero outside the box).
+        img [B, 3, H, W] of any size.
+        Returns the masks [B, 1, H/2, W/2] and the decoded boxes [B, 4].
+        """
+        img = img.float().to(self.device)
+        B, _, H, W = img.shape
+
+        if roi is None:
+            small = F.interpolate(img, size=(256, 256), mode='bilinear', align_corners=False)
+            first = self.decode_map(small, class_cond)
+            roi, found = self.mask_bbox(first, threshold=threshold)
+            roi = roi * torch.tensor([W, H, W, H], device=roi.device) / first.size(3)
+            full = torch.tensor([0., 0., W, H], device=roi.device)
+            roi = torch.where(found.unsqueeze(1), roi, full)
+        roi = roi.float().to(self.device)
+
+        boxes = modules.square_boxes(roi, H, W, margin=margin, min_size=min_size)
+        x0, y0, side = boxes[:, 0], boxes[:, 1], boxes[:, 2] - boxes[:, 0]
+
+        batch_index = torch.arange(B, device=boxes.device).float().unsqueeze(1)
+        crops = roi_align(img, torch.cat([batch_index, boxes], dim=1),
+                          output_size=(256, 256), sampling_ratio=2, aligned=True)
+        masks = self.decode_streaming(crops, class_cond, nr_sample,
+                                      chunk_size=chunk_size, sampler=sampler)
+
+        # output pixel -> crop coordinates, both normalized to [-1, 1]
+        theta = torch.zeros(B, 2, 3, device=boxes.device)
+        theta[:, 0, 0] = W / side
+        theta[:, 0, 2] = (W - 2 * x0) / side - 1
+        theta[:, 1, 1] = H / side
+        theta[:, 1, 2] = (H - 2 * y0) / side - 1
+        grid = F.affine_grid(theta, [B, 1, H // 2, W // 2], align_corners=False)
+        masks = F.grid_sample(masks, grid, mode='bilinear', padding_mode='zeros',
+                              align_corners=False)
+        return masks, boxes
+
+    def decode_map(self, img, class_cond):
+        """
+        Fast inference mode: decodes the prior mean latent (eps = 0) with a
+        single reverse pass per image, for the whole batch at once.
+        Returns masks [B, 1, H, W].
+        """
+        conditions = self.make_conditions(img, class_cond)
+
+        mean, _ = self.prior(conditions[2])
+        return self.decode_latent(mean, conditions)
+
+    def decode_progressive(self, img, class_cond, nr_sample=1, refine=None,
+                           band=(64., 192.), max_ambiguous=0.05, sampler='iid'):
+        """
+        Coarse-to-fine decoding. Every image first gets a coarse mean mask
+        from the low-res stage of the SegFlow (see SegFlow.decode_coarse),
+        which skips the 8 high-res coupling blocks. The high-res blocks are only run,
+        resuming from the stored low-res state, for the images that need it:
+        all of them if refine is True, none if it is False, and with
+        refine=None the images where more than max_ambiguous of the coarse
+        mask pixels lie inside band (mask range 0-255).
+        Returns masks [B, 1, H, W], coarse for the images that were not
+        refined, and the refined flags [B].
+        """
+        conditions = self.make_conditions(img, class_cond)
+        B = img.size(0)
+        conditions = [cond.repeat_interleave(nr_sample, dim=0)
+                      for cond in conditions]
+
+        mean, logs = self.prior(conditions[2])
+        eps = self.noise.sample(sampler, nr_sample, mean.shape[1:], device=mean.device,
+                                images=B)
+        z = modules.GaussianDiag.sample(mean, logs, eps_std=0.1, eps=eps)
+        z = modules.unsqueeze2d(z, factor=2)
+        z = z.view(z.size(0), -1)
+        z_prime, _ = self.priorflow(z, c=conditions[2], rev=True)
+
+        coarse, state = self.segflow.decode_coarse(z_prime, c=conditions)
+        coarse = coarse.view(B, nr_sample, *coarse.shape[1:]).mean(dim=1)
+
+        if refine is None:
+            ambiguous = ((coarse > band[0]) & (coarse < band[1])).float()
+            refined = ambiguous.view(B, -1).mean(dim=1) > max_ambiguous
+        else:
+            refined = torch.full((B,), bool(refine), dtype=torch.bool,
+                                 device=coarse.device)
+
+        if refined.any():
+            picked = refined.nonzero().view(-1)
+            rows = (picked.view(-1, 1) * nr_sample
+                    + torch.arange(nr_sample, device=picked.device)).view(-1)
+            x = self.segflow.decode_refine(self.segflow.plan.select(state, rows))
+            coarse[picked] = x.view(picked.numel(), nr_sample, *x.shape[1:]).mean(dim=1)
+
+        return coarse, refined
+
+    def decode_adaptive(self, img, class_cond, round_size=4, max_samples=32, tol=1.0):
+        """
+        Adaptive sample-count decoding. Samples are drawn in rounds of
+        round_size per image, and a running mean / variance of the decoded
+        masks is kept with Welford updates. An image stops sampling once a
+        round moves its mean mask by less than tol on average (mask range
+        0-255), or once it has max_samples samples. Images that are still
+        sampling are decoded together in one batch per round.
+        Returns the mean [B, 1, H, W], the variance [B, 1, H, W] and the
+        number of samples used per image [B].
+        """
+        conditions = self.make_conditions(img, class_cond)
+        B = img.size(0)
+
+        count = torch.zeros(B, device=self.device)
+        mean, m2 = None, None
+        active = torch.arange(B, device=self.device)
+        while active.numel() > 0:
+            round_conditions = [cond[active].repeat_interleave(round_size, dim=0)
+                                for cond in conditions]
+            x = self.decode_conditions(round_conditions, nr_sample=round_size)
+            x = x.view(active.numel(), round_size, *x.shape[1:])
+            if mean is None:
+                mean = torch.zeros(B, *x.shape[2:], device=self.device)
+                m2 = torch.zeros(B, *x.shape[2:], device=self.device)
+
+            prev_mean = mean[active]
+            count_a, mean_a, m2_a = modules.welford_update(
+                count[active], prev_mean, m2[active], x)
+            count[active], mean[active], m2[active] = count_a, mean_a, m2_a
+
+            # the first round has no previous mean to compare with
+            change = (mean_a - prev_mean).abs().flatten(1).mean(dim=1)
+            converged = ((change < tol) & (count_a > round_size)) | \
+                (count_a >= max_samples)
+            active = active[~converged]
+
+        return mean, m2 / count.view(-1, 1, 1, 1), count.long()
+
+    def make_conditions(self, x, class_cond):
+        """
+        image [B, 3, 256, 256] and one-hot class [B, num_classes + 1] ->
+        [cond-0, cond-1, cond-2] of SegFlow
+        """
+        x = x.float().to(self.device)
+        class_cond = class_cond.to(self.device)
+
+        conditions = modules.squeeze_pyramid(x, (4, 2), memory_format=self.memory_format)
+        conditions.append(self.class_condition(class_cond))
+        return conditions
+
+    def nll(self, x, y, class_cond):
+        """
+        Negative log-likelihood per mask pixel [B] of the masks y [B, H, W]
+        (0-255) under SegFlow and the learned prior, i.e. the flow part of
+        the training loss without the dequantization noise.
+        """
+        conditions = self.make_conditions(x, class_cond)
+        y = y.float().to(self.device).unsqueeze(1)
+
+        z, log_jac_det = self.segflow(y, c=conditions)
+        z = modules.squeeze2d(z.view(-1, 1, y.size(2), y.size(3)), factor=2)
+        mean, logs = self.prior(conditions[2])
+        prior_prob = modules.GaussianDiag.logp(mean, logs, z)
+        return -(log_jac_det + prior_prob) / (y.size(2) * y.size(3))
 
-        x = x.float().cuda()
-        class_cond = class_cond.cuda()
+    def decode(self, x, class_cond, nr_sample, pick=None, sampler='iid'):
 
-        conditions = []
-        x = modules.squeeze2d(x, factor=4)
-        conditions.append(x)
-        x = modules.squeeze2d(x, factor=2)
-        conditions.append(x)
-        conditions.append(class_cond)
+        conditions = self.make_conditions(x, class_cond)
 
-        x = self.decode_using_learned_sampler(conditions, nr_sample, pick=pick)
+        x = self.decode_using_learned_sampler(conditions, nr_sample, pick=pick, sampler=sampler)
 
         return x
 
     def get_logprob(self, x, y_in, class_conditional):
         batch_size = x.size(0)
-        class_conditional = class_conditional.cuda()
+        class_conditional = class_conditional.to(self.device)
         target_networks_weights = self.hyper(x, class_conditional)
         # 2*128 + 128 + 128 + 128 + 128
         # 128*2 + 2 + 2 + 2 + 2
@@ -81,28 +81,25 @@ class rev_multiplicative_layer(nn.Module):
         x1, x2 = (x[0].narrow(1, 0, self.split_len1),
                   x[0].narrow(1, self.split_len1, self.split_len2))
 
-        if not rev:
-            y1 = self.e(self.s2(x2)) * x1 + self.t2(x2)
-            y2 = self.e(self.s1(y1)) * x2 + self.t1(y1)
-        else:  # names of x and y are swapped!
-            y2 = (x2 - self.t1(x1)) / self.e(self.s1(x1))
-            y1 = (x1 - self.t2(y2)) / self.e(self.s2(y2))
-        return [torch.cat((y1, y2), 1)]
-
-    def jacobian(self, x, rev=False):
-        x1, x2 = (x[0].narrow(1, 0, self.split_len1),
-                  x[0].narrow(1, self.split_len1, self.split_len2))
-
         if not rev:
             s2 = self.s2(x2)
             y1 = self.e(s2) * x1 + self.t2(x2)
-            jac = self.log_e(self.s1(y1)) + self.log_e(s2)
-        else:
+            s1 = self.s1(y1)
+            y2 = self.e(s1) * x2 + self.t1(y1)
+            jac = self.log_e(s1) + self.log_e(s2)
+        else:  # names of x and y are swapped!
             s1 = self.s1(x1)
             y2 = (x2 - self.t1(x1)) / self.e(s1)
-            jac = -self.log_e(s1) - self.log_e(self.s2(y2))
+            s2 = self.s2(y2)
+            y1 = (x1 - self.t2(y2)) / self.e(s2)
+            jac = -self.log_e(s1) - self.log_e(s2)
 
-        return torch.sum(jac, dim=tuple(range(1, self.ndims+1)))
+        self.last_jac = torch.sum(jac, dim=tuple(range(1, self.ndims+1)))
+        return [torch.cat((y1, y2), 1)]
+
+    def jacobian(self, x, rev=False):
+        '''log det of the last forward call (in the same direction)'''
+        return self.last_jac
 
     def output_dims(self, input_dims):
         assert len(input_dims) == 1, "Can only use 1 input"
@@ -154,34 +151,17 @@ class glow_coupling_layer(nn.Module):
             s2, t2 = r2[:, :self.split_len1], r2[:, self.split_len1:]
             y1 = (x1 - t2) / self.e(s2)
 
-        return [torch.cat((y1, y2), 1)]
-
-    def jacobian(self, x, rev=False):
-        x1, x2 = (x[0].narrow(1, 0, self.split_len1),
-                  x[0].narrow(1, self.split_len1, self.split_len2))
-
-        if not rev:
-            r2 = self.s2(x2)
-            s2, t2 = r2[:, :self.split_len1], r2[:, self.split_len1:]
-            y1 = self.e(s2) * x1 + t2
-
-            r1 = self.s1(y1)
-            s1, t1 = r1[:, :self.split_len2], r1[:, self.split_len2:]
-
-        else:  # names of x and y are swapped!
-            r1 = self.s1(x1)
-            s1, t1 = r1[:, :self.split_len2], r1[:, self.split_len2:]
-            y2 = (x2 - t1) / self.e(s1)
-
-            r2 = self.s2(y2)
-            s2, t2 = r2[:, :self.split_len1], r2[:, self.split_len1:]
-
         jac = (torch.sum(self.log_e(s1), dim=1)
                + torch.sum(self.log_e(s2), dim=1))
         for i in range(self.ndims-1):
             jac = torch.sum(jac, dim=1)
+        self.last_jac = jac
+
+        return [torch.cat((y1, y2), 1)]
 
-        return jac
+    def jacobian(self, x, rev=False):
+        '''log det of the last forward call (in the same direction)'''
+        return self.last_jac
 
     def output_dims(self, input_dims):
         assert len(input_dims) == 1, "Can only use 1 input"
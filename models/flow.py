@@ -157,7 +157,7 @@ def build_hyper2D(args, num_blocks, conditional):
 def get_point_cnf(args):
     dims = tuple(map(int, args.dims.split("-")))
     model = build_model(args, args.input_dim, dims,
-                        args.zdim, args.num_blocks, True).cuda()
+                        args.zdim, args.num_blocks, True).to(args.device)
     print("Number of trainable parameters of Point CNF: {}".format(
         count_parameters(model)))
     return model
@@ -166,17 +166,17 @@ def get_point_cnf(args):
 def get_latent_cnf(args):
     dims = tuple(map(int, args.latent_dims.split("-")))
     model = build_model(args, args.zdim, dims, 0,
-                        args.latent_num_blocks, False).cuda()
+                        args.latent_num_blocks, False).to(args.device)
     print("Number of trainable parameters of Latent CNF: {}".format(
         count_parameters(model)))
     return model
 
 
 def get_hyper_cnf(args):
-    model = build_hyper(args, args.num_blocks, True).cuda()
+    model = build_hyper(args, args.num_blocks, True).to(args.device)
     return model
 
 
 def get_hyper_cnf2D(args):
-    model = build_hyper2D(args, args.num_blocks, True).cuda()
+    model = build_hyper2D(args, args.num_blocks, True).to(args.device)
     return model
@@ -0,0 +1,247 @@
+import torch
+from torch import nn
+
+from FrEIA.modules import GLOWCouplingBlock, HaarDownsampling, PermuteRandom
+
+import models.reshapes as reshapes
+
+
+class GraphPlan(object):
+    '''Execution plan of a FrEIA GraphINN. The node order and the input /
+    condition wiring of every node is worked out once at construction,
+    the plan then runs the graph either in one go (same results as calling
+    the GraphINN), or step by step through a state that can be stopped in
+    front of a named node and resumed later.
+    modules replaces the module of some nodes (node -> module), nodes in
+    passthrough[rev] pass their input on unchanged in that direction, see
+    fold_fixed_transforms.'''
+
+    def __init__(self, inn, modules=None, passthrough=None):
+        self.inn = inn
+        self.modules = modules or {}
+        self.passthrough = passthrough or {False: set(), True: set()}
+        self.steps = {False: self._make_steps(rev=False),
+                      True: self._make_steps(rev=True)}
+
+    def _make_steps(self, rev):
+        special = set(self.inn.in_nodes + self.inn.out_nodes
+                      + self.inn.condition_nodes)
+        steps = []
+        for node in self.inn.node_list[::-1 if rev else 1]:
+            if node in special:
+                continue
+            inputs = list(node.outputs if rev else node.inputs)
+            steps.append((node, inputs, list(node.conditions)))
+        return steps
+
+    def init_state(self, x_or_z, c=None, rev=False):
+        if torch.is_tensor(x_or_z):
+            x_or_z = x_or_z,
+        if torch.is_tensor(c):
+            c = c,
+        c = c or []
+
+        start_nodes = self.inn.out_nodes if rev else self.inn.in_nodes
+        if len(x_or_z) != len(start_nodes):
+            raise ValueError("Got {} inputs, but expected {}.".format(
+                len(x_or_z), len(start_nodes)))
+        if len(c) != len(self.inn.condition_nodes):
+            raise ValueError("Got {} conditions, but expected {}.".format(
+                len(c), len(self.inn.condition_nodes)))
+
+        outs = {}
+        for tensor, node in zip(x_or_z, start_nodes):
+            outs[node, 0] = tensor
+        for tensor, node in zip(c, self.inn.condition_nodes):
+            outs[node, 0] = tensor
+
+        return {'outs': outs, 'rev': rev, 'pos': 0,
+                'jac': torch.zeros(x_or_z[0].shape[0]).to(x_or_z[0])}
+
+    def run(self, state, until=None, jac=True, skip=()):
+        '''runs the remaining steps, or the ones before the node named until.
+        Nodes named in skip pass their input on unchanged (only meaningful
+        for single input, shape preserving nodes).'''
+        steps = self.steps[state['rev']]
+        outs = state['outs']
+        while state['pos'] < len(steps):
+            node, inputs, conditions = steps[state['pos']]
+            if until is not None and node.name == until:
+                break
+            if node.name in skip or node in self.passthrough[state['rev']]:
+                outs[node, 0] = outs[inputs[0]]
+                state['pos'] += 1
+                continue
+
+            module = self.modules.get(node, node.module)
+            mod_in = tuple(outs[key] for key in inputs)
+            if len(conditions) > 0:
+                mod_c = tuple(outs[cond, 0] for cond in conditions)
+                out, mod_jac = module(mod_in, c=mod_c, rev=state['rev'], jac=jac)
+            else:
+                out, mod_jac = module(mod_in, rev=state['rev'], jac=jac)
+
+            for idx, value in enumerate(out):
+                outs[node, idx] = value
+            if jac:
+                state['jac'] = state['jac'] + mod_jac
+            state['pos'] += 1
+        return state
+
+    def pending_inputs(self, state):
+        '''inputs of the next node to run'''
+        _, inputs, _ = self.steps[state['rev']][state['pos']]
+        return tuple(state['outs'][key] for key in inputs)
+
+    def copy(self, state):
+        '''shallow copy that can be run on without advancing state'''
+        return dict(state, outs=dict(state['outs']))
+
+    def select(self, state, index):
+        '''state restricted to the batch rows in index'''
+        outs = {key: value.index_select(0, index)
+                for key, value in state['outs'].items()}
+        jac = state['jac']
+        if torch.is_tensor(jac) and jac.dim() > 0:
+            jac = jac.index_select(0, index)
+        return {'outs': outs, 'rev': state['rev'], 'pos': state['pos'], 'jac': jac}
+
+    def outputs(self, state):
+        end_nodes = self.inn.in_nodes if state['rev'] else self.inn.out_nodes
+        out = []
+        for node in end_nodes:
+            # the end nodes just pass on their single input
+            out.append(state['outs'][(node.outputs if state['rev'] else node.inputs)[0]])
+        if len(out) == 1 and not self.inn.force_tuple_output:
+            return out[0]
+        return tuple(out)
+
+    def __call__(self, x_or_z, c=None, rev=False, jac=True):
+        state = self.run(self.init_state(x_or_z, c, rev=rev), jac=jac)
+        return self.outputs(state), state['jac']
+
+
+def coupling_halves(block, x, c=(), rev=False):
+    '''GLOWCouplingBlock.forward up to the concatenation of the two output
+    halves, (y1, y2, log_jac_det)'''
+    if hasattr(block, 'coupling_halves'):
+        return block.coupling_halves(x, c, rev=rev)
+
+    x1, x2 = torch.split(x, [block.split_len1, block.split_len2], dim=1)
+
+    def join(u):
+        return torch.cat([u, *c], 1) if block.conditional else u
+
+    if not rev:
+        y1, j1 = block._coupling1(x1, join(x2))
+        y2, j2 = block._coupling2(x2, join(y1))
+    else:
+        y2, j2 = block._coupling2(x2, join(x1), rev=True)
+        y1, j1 = block._coupling1(x1, join(y2), rev=True)
+    return y1, y2, j1 + j2
+
+
+class FoldedCoupling(nn.Module):
+    '''GLOW coupling block that writes its two output halves straight into
+    the channel order of an adjacent fixed permutation, one indexed copy
+    instead of the concatenation plus the gather of the permutation node.
+    Shares the subnets of the wrapped block.'''
+
+    def __init__(self, block):
+        super(FoldedCoupling, self).__init__()
+        self.block = block
+        self.index = {False: None, True: None}
+
+    def fold(self, perm, rev):
+        '''absorbs out = cat[:, perm] following the block (rev=False), or
+        the reverse of the permutation preceding it (rev=True), whose
+        output is out[:, perm] = cat'''
+        index = perm if rev else torch.argsort(perm)
+        self.index[rev] = torch.split(
+            index, [self.block.split_len1, self.block.split_len2])
+
+    def forward(self, x, c=[], rev=False, jac=True):
+        y1, y2, log_jac = coupling_halves(self.block, x[0], c, rev=rev)
+        index = self.index[rev]
+        if index is None:
+            return (torch.cat((y1, y2), 1),), log_jac
+
+        # in the layout of the input, NCHW or channels-last
+        out = reshapes.new_empty(x[0], (y1.shape[0], y1.shape[1] + y2.shape[1])
+                                 + tuple(y1.shape[2:]))
+        out.index_copy_(1, index[0], y1)
+        out.index_copy_(1, index[1], y2)
+        return (out,), log_jac
+
+
+class HaarReshape(nn.Module):
+    '''HaarDownsampling as reshape arithmetic instead of a grouped
+    convolution, see reshapes.haar_split / haar_merge'''
+
+    def __init__(self, haar):
+        super(HaarReshape, self).__init__()
+        self.haar = haar
+
+    def forward(self, x, c=None, rev=False, jac=True):
+        ndims = x[0][0].numel()
+        if not rev:
+            return ((reshapes.haar_split(x[0], self.haar.fac_fwd),),
+                    ndims * self.haar.jac_fwd)
+        return ((reshapes.haar_merge(x[0], self.haar.fac_rev),),
+                ndims * self.haar.jac_rev)
+
+
+def fold_fixed_transforms(inn):
+    '''
+    Inference plan of a FrEIA GraphINN with the fixed transforms folded into
+    their neighbours:
+    - every PermuteRandom node fed by a coupling block is absorbed into the
+      write of that block's output (forward), and into the reverse output
+      of the coupling block it feeds (reverse), also when a Haar transform
+      sits in between, since a channel permutation commutes with it
+    - HaarDownsampling (channel-grouped order) runs as reshape arithmetic
+    Same parameters, same results as the GraphINN. The permutation indices
+    are made on the device of the graph, fold after moving the model.
+    '''
+    plan = GraphPlan(inn)
+    consumers = {}
+    for node in inn.node_list:
+        for key in node.inputs:
+            consumers.setdefault(key, []).append(node)
+
+    def single_consumer(node):
+        users = consumers.get((node, 0), [])
+        return users[0] if len(users) == 1 else None
+
+    def is_haar(node):
+        module = getattr(node, 'module', None)
+        return isinstance(module, HaarDownsampling) and not module.permute
+
+    def folded(node):
+        if node not in plan.modules:
+            plan.modules[node] = FoldedCoupling(node.module)
+        return plan.modules[node]
+
+    for node in inn.node_list:
+        if is_haar(node):
+            plan.modules[node] = HaarReshape(node.module)
+        if not isinstance(getattr(node, 'module', None), PermuteRandom):
+            continue
+        perm = node.module.perm.data
+
+        (producer, _), = node.inputs
+        if isinstance(getattr(producer, 'module', None), GLOWCouplingBlock) \
+                and single_consumer(producer) is node:
+            folded(producer).fold(perm, rev=False)
+            plan.passthrough[False].add(node)
+
+        target = single_consumer(node)
+        if target is not None and is_haar(target):
+            # Haar(u[:, perm]) = Haar(u)[:, 4 * perm + wavelet]
+            perm = (4 * perm[:, None] + torch.arange(4, device=perm.device)).reshape(-1)
+            target = single_consumer(target)
+        if target is not None and isinstance(target.module, GLOWCouplingBlock):
+            folded(target).fold(perm, rev=True)
+            plan.passthrough[True].add(node)
+
+    return plan
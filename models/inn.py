@@ -1,4 +1,5 @@
 import warnings
+from functools import partial
 
 import torch.optim
 import torch.nn as nn
@@ -7,10 +8,9 @@ import numpy as np
 
 import FrEIA.framework as Ff
 import FrEIA.modules as Fm
-from reshapes import haar_multiplex_layer
-import subnet_coupling
-import config as c
-import data
+from models.graph_plan import GraphPlan
+import models.subnet_coupling as subnet_coupling
+import models.config as c
 
 # the reason the subnet init is needed, is that with uninitalized
 # weights, the numerical jacobian check gives inf, nan, etc,
@@ -25,20 +25,21 @@ def subnet_initialization(m):
         m.bias.data *= 0.1
 
 
-def F_conv(cin, cout):
+def F_conv(cin, cout, channels_hidden=32, kernel_size=3, leaky_slope=0.):
     '''Simple convolutional subnetwork'''
-    net = nn.Sequential(nn.Conv2d(cin, 32, 3, padding=1),
-                        nn.ReLU(),
-                        nn.Conv2d(32, cout, 3, padding=1))
+    pad = kernel_size // 2
+    net = nn.Sequential(nn.Conv2d(cin, channels_hidden, kernel_size, padding=pad),
+                        nn.LeakyReLU(leaky_slope),
+                        nn.Conv2d(channels_hidden, cout, kernel_size, padding=pad))
     net.apply(subnet_initialization)
     return net
 
 
-def F_fully_connected(cin, cout):
+def F_fully_connected(cin, cout, internal_size=128):
     '''Simple fully connected subnetwork'''
-    net = nn.Sequential(nn.Linear(cin, 128),
+    net = nn.Sequential(nn.Linear(cin, internal_size),
                         nn.ReLU(),
-                        nn.Linear(128, cout))
+                        nn.Linear(internal_size, cout))
     net.apply(subnet_initialization)
     return net
 
@@ -50,15 +51,26 @@ def random_orthog(n):
     return torch.FloatTensor(w)
 
 
+# the subnetworks of the coupling blocks, see CondINN._init_model
+COEFF_FUNCS = ('s1', 's2', 'subnet1', 'subnet2')
+
+
+def latent_norm(z):
+    '''squared norm of the latent, summed over all output nodes'''
+    return sum(torch.sum(o**2, dim=1) for o in z)
+
+
 class CondINN(nn.Module):
     def __init__(self, args, img_dims=None):
+        super().__init__()
         self.args = args
         self.model_dims = img_dims
         self.feature_channels = 256
         self.num_classes = 81
         self.fc_cond_length = 512 + self.num_classes
 
-        self.input_node = Ff.InputNode(2000, 2, name='inp_points')
+        # 2 x img_dims map, see the section sizes below
+        self.input_node = Ff.InputNode(2, self.model_dims[0], self.model_dims[1], name='inp_points')
         self.conditions = [Ff.ConditionNode(self.feature_channels, self.model_dims[0], self.model_dims[1], name='cond-0'),
                            Ff.ConditionNode(self.fc_cond_length, name='cond-1')]
 
@@ -100,6 +112,25 @@ class CondINN(nn.Module):
         # output nodes
         self.nodes.append(self.output_node)
 
+        # the graph is built and initialized once, the plan fixes the
+        # topological order and wiring of the nodes for every later call
+        self.cinn = Ff.GraphINN(self.nodes + self.conditions,
+                                force_tuple_output=True, verbose=False)
+        self._init_model(self.cinn)
+        self.plan = GraphPlan(self.cinn)
+
+    @staticmethod
+    def _init_model(model):
+        for key, param in model.named_parameters():
+            split = key.split('.')
+            if param.requires_grad:
+                param.data = c.init_scale * torch.randn_like(param.data)
+                # last layer of the coeff funcs (module_list.<node>.<s1|s2|
+                # subnet1|subnet2>.2.*), so that every block starts as the
+                # identity
+                if len(split) > 3 and split[2] in COEFF_FUNCS and split[3] == '2':
+                    param.data.fill_(0.)
+
     def _add_conditioned_section(self, nodes, depth, channels_in, channels, cond_level, condition=None):
 
         for k in range(depth):
@@ -115,28 +146,28 @@ class CondINN(nn.Module):
 
     def _add_split_downsample(self, nodes, split, downsample, channels_in, channels):
         if downsample == 'haar':
-            nodes.append(Ff.Node([nodes[-1].out0], haar_multiplex_layer,
+            nodes.append(Ff.Node([nodes[-1].out0], Fm.HaarDownsampling,
                                  {'rebalance': 0.5, 'order_by_wavelet': True}, name='haar'))
         if downsample == 'reshape':
             nodes.append(
-                Ff.Node([nodes[-1].out0], Fm.IRevNetDownSampling, {}, name='reshape'))
+                Ff.Node([nodes[-1].out0], Fm.IRevNetDownsampling, {}, name='reshape'))
 
         for i in range(2):
             nodes.append(Ff.Node([nodes[-1].out0], Fm.Fixed1x1Conv,
                                  {'M': random_orthog(channels_in*4)}))
             nodes.append(Ff.Node([nodes[-1].out0],
                                  Fm.GLOWCouplingBlock,
-                                 {'clamp': c.clamping, 'F_class': F_conv,
-                                  'F_args': {'kernel_size': 1, 'leaky_slope': 1e-2, 'channels_hidden': channels}},
-                                 conditions=[]))
+                                 {'clamp': c.clamping,
+                                  'subnet_constructor': partial(F_conv, kernel_size=1, leaky_slope=1e-2,
+                                                                channels_hidden=channels)}))
 
         if split:
             nodes.append(Ff.Node([nodes[-1].out0], Fm.Split,
-                                 {'split_size_or_sections': split, 'dim': 0}, name='split'))
+                                 {'section_sizes': split, 'dim': 0}, name='split'))
 
             output = Ff.Node([nodes[-1].out1], Fm.Flatten, {}, name='flatten')
             nodes.insert(-2, output)
-            nodes.insert(-2, Fm.OutputNode([output.out0], name='out'))
+            nodes.insert(-2, Ff.OutputNode([output.out0], name='out'))
 
     def _add_fc_section(self, nodes, fc_cond_length, n_blocks_fc=8, condition=None):
         nodes.append(Ff.Node([nodes[-1].out0], Fm.Flatten, {}, name='flatten'))
@@ -144,8 +175,8 @@ class CondINN(nn.Module):
             nodes.append(Ff.Node([nodes[-1].out0], Fm.PermuteRandom,
                                  {'seed': k}, name=F'permute_{k}'))
             nodes.append(Ff.Node([nodes[-1].out0], Fm.GLOWCouplingBlock,
-                                 {'clamp': c.clamping, 'F_class': F_fully_connected,
-                                  'F_args': {'internal_size': fc_cond_length}},
+                                 {'clamp': c.clamping,
+                                  'subnet_constructor': partial(F_fully_connected, internal_size=fc_cond_length)},
                                  conditions=[condition], name=F'fc_{k}'))
 
     def _cond_subnet(self, level, c_out, extra_conv=False):
@@ -179,32 +210,26 @@ class CondINN(nn.Module):
             nn.LeakyReLU(),
             nn.Conv2d(256, 256, 3, stride=2, padding=1),  # 8 x 8
             nn.LeakyReLU(),
-            nn.Conv2d(256, self.fc_cond_length, 3,
+            # the class condition is concatenated to the output
+            nn.Conv2d(256, self.fc_cond_length - self.num_classes, 3,
                       stride=2, padding=1),  # 4 x 4
             nn.AvgPool2d(4),
-            nn.BatchNorm2d(self.fc_cond_length),
+            nn.BatchNorm2d(self.fc_cond_length - self.num_classes),
         ])
 
     def forward(self, x, cond):
-        self.cinn = Ff.GraphINN(self.nodes + self.conditions, verbose=False)
-        self.cinn = self.net.cuda()
-
-        def init_model(model):
-            for key, param in model.named_parameters():
-                split = key.split('.')
-                if param.requires_grad:
-                    param.data = c.init_scale * \
-                        torch.randn(param.data.shape).cuda()
-                    # last convolution in the coeff func
-                    if len(split) > 3 and split[3][-1] == '3':
-                        param.data.fill_(0.)
+        '''x -> (z, log_jac_det), z the tuple of all output nodes'''
+        return self.plan(x, c=cond)
 
-        init_model(self.cinn)
+    def reverse(self, z, cond):
+        '''z (tuple in the order of the output nodes) -> x'''
+        x, _ = self.plan(z, c=cond, rev=True, jac=False)
+        return x[0]
 
-        # if load_inn_only:
-        #    self.cinn.load_state_dict(torch.load(load_inn_only)['net'])
-
-        return self.cinn(x, c=[cond])
+    def log_likelihood(self, x, cond):
+        '''log p(x | cond) per sample, up to the constant of the normal'''
+        z, jac = self.plan(x, c=cond)
+        return jac - 0.5 * latent_norm(z)
 
 
 class CondINNWrapper(nn.Module):
@@ -214,7 +239,7 @@ class CondINNWrapper(nn.Module):
         self.img_dims = img_dims
         self.inn = CondINN(args, img_dims=img_dims)
         self.feature_network = feature_network
-        self.fc_cond_network = self.inn._fc_cond_net
+        self.fc_cond_network = self.inn._fc_cond_net()
 
         self._make_optim()
 
@@ -223,27 +248,11 @@ class CondINNWrapper(nn.Module):
         self.optim.zero_grad()
         self.feature_optim.zero_grad()
 
-        x = F.interpolate(x, size=self.img_dims)
-        points += 5e-2 * torch.cuda.FloatTensor(points.shape).normal_()
+        points = points + 5e-2 * torch.randn_like(points)
+        cond = self.condition(x, class_cond)
 
-        self.feature_network = self.feature_network.cuda()
-        self.fc_cond_network = self.fc_cond_network.cuda()
-
-        if c.end_to_end:
-            features = self.feature_network.features(x)
-            features = features[:, :, 1:-1, 1:-1]
-        else:
-            with torch.no_grad():
-                features = self.feature_network.features(x)
-                features = features[:, :, 1:-1, 1:-1]
-
-        cond_with_class = torch.cat(
-            [self.fc_cond_network(features).squeeze(), class_cond], dim=1)
-        cond = [features, cond_with_class]
-
-        z = self.inn(points, cond)
-        zz = sum(torch.sum(o**2, dim=1) for o in z)
-        jac = self.inn.jacobian(run_forward=False)
+        z, jac = self.inn(points, cond)
+        zz = latent_norm(z)
 
         neglog_likelihood = 0.5 * zz - jac
         loss = torch.mean(neglog_likelihood)
@@ -256,8 +265,28 @@ class CondINNWrapper(nn.Module):
 
         return zz, jac
 
+    def condition(self, x, class_cond):
+        '''image [B, 3, H, W] and class one-hot -> conditions of the INN'''
+        x = F.interpolate(x, size=self.img_dims)
+
+        if c.end_to_end:
+            features = self.feature_network.features(x)
+            features = features[:, :, 1:-1, 1:-1]
+        else:
+            with torch.no_grad():
+                features = self.feature_network.features(x)
+                features = features[:, :, 1:-1, 1:-1]
+
+        cond_with_class = torch.cat(
+            [self.fc_cond_network(features).flatten(1), class_cond], dim=1)
+        return [features, cond_with_class]
+
+    def log_likelihood(self, x, points, class_cond):
+        '''log p(points | image, class) per sample, without a training step'''
+        return self.inn.log_likelihood(points, self.condition(x, class_cond))
+
     def reverse_sample(self, z, cond):
-        return self.inn(z, cond, rev=True)
+        return self.inn.reverse(z, cond)
 
     def _make_optim(self):
 
@@ -278,8 +307,7 @@ class CondINNWrapper(nn.Module):
                                                                            patience=sched_patience,
                                                                            threshold=sched_trehsh,
                                                                            min_lr=0, eps=1e-08,
-                                                                           cooldown=sched_cooldown,
-                                                                           verbose=True)
+                                                                           cooldown=sched_cooldown)
 
         self.feature_optim = torch.optim.Adam(
             feature_params, lr=c.lr_feature_net, betas=c.betas, eps=1e-4)
@@ -289,5 +317,4 @@ class CondINNWrapper(nn.Module):
                                                                             patience=sched_patience,
                                                                             threshold=sched_trehsh,
                                                                             min_lr=0, eps=1e-08,
-                                                                            cooldown=sched_cooldown,
-                                                                            verbose=True)
+                                                                            cooldown=sched_cooldown)
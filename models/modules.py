@@ -74,11 +74,211 @@ class GaussianDiag:
         return thops.sum(likelihood, dim=[1, 2, 3])
 
     @staticmethod
-    def sample(mean, logs, eps_std=None):
+    def sample(mean, logs, eps_std=None, eps=None, generator=None):
+        """
+        eps: optional standard normal noise to use instead of i.i.d. draws
+        (from generator, or the global default generator)
+        """
         eps_std = eps_std or 1
-        eps = torch.normal(mean=torch.zeros_like(mean),
-                           std=torch.ones_like(logs) * eps_std)
-        return mean + torch.exp(logs) * eps
+        if eps is None:
+            eps = torch.randn(mean.shape, dtype=mean.dtype, device=mean.device,
+                              generator=generator)
+        return torch.addcmul(mean, torch.exp(logs), eps, value=eps_std)
+
+
+def iid_normal(n, shape, device=None, generator=None, images=1):
+    """n i.i.d. standard normal draws of the given shape for each of images"""
+    return torch.randn(images * n, *shape, device=device, generator=generator)
+
+
+def antithetic_normal(n, shape, device=None, generator=None, images=1):
+    """
+    n standard normal draws of the given shape for each of images, in
+    antithetic pairs [e0, -e0, e1, -e1, ...] built within the n rows of
+    every image (an odd n leaves the last draw of an image unpaired)
+    """
+    eps = torch.randn(images, (n + 1) // 2, *shape, device=device, generator=generator)
+    eps = torch.stack([eps, -eps], dim=2).view(images, -1, *shape)
+    return eps[:, :n].reshape(images * n, *shape)
+
+
+def sobol_engine(shape, seed=None):
+    """
+    scrambled SobolEngine for draws of the given shape. The dimension is
+    limited to SobolEngine.MAXDIM (21201), enough for the 4x64x64 prior
+    latent. Building one is slow at that size (~1 s), keep it and continue
+    drawing from it.
+    """
+    return torch.quasirandom.SobolEngine(int(np.prod(shape)), scramble=True, seed=seed)
+
+
+def sobol_normal(n, shape, device=None, generator=None, images=1, engine=None):
+    """
+    the next n points of a scrambled Sobol sequence mapped through the
+    inverse normal CDF (randomized quasi Monte-Carlo), the same points for
+    each of images. Without an engine, a new sequence is started, with its
+    scrambling seeded from generator if given.
+    """
+    if engine is None:
+        seed = None
+        if generator is not None:
+            seed = int(torch.randint(2 ** 31, (1,), generator=generator,
+                                     device=generator.device))
+        engine = sobol_engine(shape, seed=seed)
+    u = engine.draw(n).clamp(1e-6, 1 - 1e-6)
+    eps = torch.special.ndtri(u).view(n, *shape).to(device)
+    return eps.repeat(images, *([1] * len(shape)))
+
+
+SAMPLERS = {
+    'iid': iid_normal,
+    'antithetic': antithetic_normal,
+    'sobol': sobol_normal,
+}
+
+
+def _concrete_device(device):
+    """torch.device with the index of the current cuda device filled in"""
+    device = torch.device(device if device is not None else 'cpu')
+    if device.type == 'cuda' and device.index is None:
+        device = torch.device('cuda', torch.cuda.current_device())
+    return device
+
+
+class NoiseBuffers(object):
+    """
+    Noise of the sampling sites of a model, drawn in place into buffers kept
+    per (name, dtype, device), so repeated draws allocate nothing. A buffer
+    grows to the largest draw made under its name, smaller draws use a view
+    of its front.
+    Draws come from the global default generator, or after manual_seed from
+    an own torch.Generator per device. A returned tensor is overwritten by
+    the next draw under the same name: consume it right away, and not in an
+    op that autograd saves it for.
+    """
+
+    def __init__(self):
+        self.seed = None
+        self.generators = {}
+        self.buffers = {}
+        self.engines = {}
+
+    def manual_seed(self, seed):
+        """draw from per-device generators seeded with seed from now on"""
+        self.seed = seed
+        self.generators = {}
+        self.engines = {}
+        return self
+
+    def generator(self, device):
+        if self.seed is None:
+            return None
+        device = _concrete_device(device)
+        if device not in self.generators:
+            self.generators[device] = torch.Generator(device=device).manual_seed(self.seed)
+        return self.generators[device]
+
+    def normal(self, name, shape, std=1., device=None, dtype=torch.float32):
+        """normal noise N(0, std^2) of shape, in the buffer name"""
+        key = (name, dtype, _concrete_device(device))
+        numel = int(np.prod(shape))
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.numel() < numel:
+            buffer = self.buffers[key] = torch.empty(numel, dtype=dtype, device=device)
+        noise = buffer.narrow(0, 0, numel).view(shape)
+        return noise.normal_(0., std, generator=self.generator(buffer.device))
+
+    def engine(self, shape):
+        """the Sobol engine of shape, kept per (dimension, seed)"""
+        key = (int(np.prod(shape)), self.seed)
+        if key not in self.engines:
+            self.engines[key] = sobol_engine(shape, seed=self.seed)
+        return self.engines[key]
+
+    def sample(self, sampler, n, shape, device=None, images=1):
+        """
+        n standard normal draws of shape for each of images from the
+        SAMPLERS entry sampler, [images * n, *shape] with the rows of an
+        image next to each other. The i.i.d. ones go into a buffer, the
+        Sobol points continue the sequence of the previous call.
+        """
+        if sampler == 'iid':
+            return self.normal(sampler, (images * n,) + tuple(shape), device=device)
+        if sampler == 'sobol':
+            return sobol_normal(n, shape, device=device, images=images,
+                                engine=self.engine(shape))
+        return SAMPLERS[sampler](n, shape, device=device, images=images,
+                                 generator=self.generator(device))
+
+
+def welford_update(count, mean, m2, samples):
+    """
+    Merges a chunk of samples [B, S, ...] into running per-row statistics
+    (count [B], mean and m2 [B, ...]) with the chunked form of Welford's
+    update. mean and m2 may start as 0. Returns the updated
+    (count, mean, m2), variance = m2 / count.
+    """
+    n = samples.size(1)
+    chunk_mean = samples.mean(dim=1)
+    chunk_m2 = ((samples - chunk_mean.unsqueeze(1)) ** 2).sum(dim=1)
+
+    new_count = count + n
+    shape = [-1] + [1] * (chunk_mean.dim() - 1)
+    delta = chunk_mean - mean
+    mean = mean + delta * (n / new_count).view(shape)
+    m2 = m2 + chunk_m2 + delta ** 2 * (count * n / new_count).view(shape)
+    return new_count, mean, m2
+
+
+def batched_kmeans(x, k, iters=10):
+    """
+    k-means of the S points of every row of x [B, S, D], run for all rows at
+    once. The centers are seeded deterministically with farthest point
+    seeding (the first point, then repeatedly the point farthest from the
+    chosen centers); a center that loses all its points stays where it is.
+    Returns the assignments [B, S] and the centers [B, k, D].
+    """
+    B, S, _ = x.shape
+    k = min(k, S)
+    rows = torch.arange(B, device=x.device)
+
+    centers = [x[:, 0]]
+    dist = ((x - centers[0].unsqueeze(1)) ** 2).sum(dim=2)
+    for _ in range(1, k):
+        centers.append(x[rows, dist.argmax(dim=1)])
+        dist = torch.min(dist, ((x - centers[-1].unsqueeze(1)) ** 2).sum(dim=2))
+    centers = torch.stack(centers, dim=1)
+
+    for _ in range(iters):
+        assign = torch.cdist(x, centers).argmin(dim=2)
+        onehot = F.one_hot(assign, k).type_as(x)
+        counts = onehot.sum(dim=1).unsqueeze(2)
+        new_centers = torch.bmm(onehot.transpose(1, 2), x) / counts.clamp(min=1)
+        centers = torch.where(counts > 0, new_centers, centers)
+
+    assign = torch.cdist(x, centers).argmin(dim=2)
+    return assign, centers
+
+
+def square_boxes(roi, height, width, margin=0.1, min_size=32):
+    """
+    Square boxes [B, 4] (x0, y0, x1, y1) around the regions roi [B, 4] of
+    height x width images, enlarged by margin on every side, at least
+    min_size and at most the long image side. A box is moved inside the
+    image along the sides it fits in and centered on the others, so on a
+    non-square image it reaches past the short side instead of cutting the
+    region (e.g. the full frame) down to a square.
+    """
+    center = (roi[:, :2] + roi[:, 2:]) / 2
+    side = (roi[:, 2:] - roi[:, :2]).max(dim=1)[0] * (1 + 2 * margin)
+    side = side.clamp(min=min(min_size, max(height, width)), max=max(height, width))
+
+    corner = []
+    for i, size in enumerate([width, height]):
+        start = torch.min((center[:, i] - side / 2).clamp(min=0), size - side)
+        corner.append(torch.where(side <= size, start, (size - side) / 2))
+    x0, y0 = corner
+    return torch.stack([x0, y0, x0 + side, y0 + side], dim=1)
 
 
 class Split2d(nn.Module):
@@ -104,37 +304,53 @@ class Split2d(nn.Module):
             return z, logdet
 
 
-def squeeze2d(input, factor=2):
+def memory_format(args):
+    """memory format of the 4D activations and conv weights (--channels_last)"""
+    return torch.channels_last if args.channels_last else torch.contiguous_format
+
+
+def squeeze2d(input, factor=2, memory_format=torch.contiguous_format):
+    """
+    [B, C, H, W] -> [B, C * factor**2, H / factor, W / factor], channel
+    c * factor**2 + i * factor + j holds pixel (i, j) of the factor x factor
+    blocks of channel c, i.e. pixel_unshuffle. The result is in
+    memory_format, the input is converted to it first since pixel_unshuffle
+    keeps the layout of its input.
+    """
     assert factor >= 1 and isinstance(factor, int)
+    input = input.contiguous(memory_format=memory_format)
     if factor == 1:
         return input
-    size = input.size()
-    B = size[0]
-    C = size[1]
-    H = size[2]
-    W = size[3]
+    H, W = input.size(2), input.size(3)
     assert H % factor == 0 and W % factor == 0, "{}".format((H, W))
-    x = input.view(B, C, H // factor, factor, W // factor, factor)
-    x = x.permute(0, 1, 3, 5, 2, 4).contiguous()
-    x = x.view(B, C * factor * factor, H // factor, W // factor)
-    return x
+    # a no-op unless the layout of input was ambiguous (single channel)
+    return F.pixel_unshuffle(input, factor).contiguous(memory_format=memory_format)
 
 
-def unsqueeze2d(input, factor=2):
+def unsqueeze2d(input, factor=2, memory_format=torch.contiguous_format):
+    """inverse of squeeze2d (pixel_shuffle), memory_format as there"""
     assert factor >= 1 and isinstance(factor, int)
-    factor2 = factor ** 2
+    input = input.contiguous(memory_format=memory_format)
     if factor == 1:
         return input
-    size = input.size()
-    B = size[0]
-    C = size[1]
-    H = size[2]
-    W = size[3]
-    assert C % (factor2) == 0, "{}".format(C)
-    x = input.view(B, C // factor2, factor, factor, H, W)
-    x = x.permute(0, 1, 4, 2, 5, 3).contiguous()
-    x = x.view(B, C // (factor2), H * factor, W * factor)
-    return x
+    C = input.size(1)
+    assert C % (factor ** 2) == 0, "{}".format(C)
+    return F.pixel_shuffle(input, factor).contiguous(memory_format=memory_format)
+
+
+def squeeze_pyramid(input, factors=(4, 2), memory_format=torch.contiguous_format):
+    """
+    [squeeze2d(input, f1), squeeze2d(squeeze2d(input, f1), f2), ...], e.g.
+    the cond-0 / cond-1 image conditions. A convenience over chained
+    squeeze2d calls, not a fused kernel: every level is its own
+    pixel_unshuffle of the level before, in memory_format.
+    """
+    levels = []
+    x = input.contiguous(memory_format=memory_format)
+    for factor in factors:
+        x = squeeze2d(x, factor, memory_format=memory_format)
+        levels.append(x)
+    return levels
 
 
 class SqueezeLayer(nn.Module):
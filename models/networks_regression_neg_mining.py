@@ -119,6 +119,7 @@ class HyperRegression(nn.Module):
         self.args = args
         self.point_cnf = get_hyper_cnf(self.args)
         self.gpu = args.gpu
+        self.device = torch.device(args.device)
         self.logprob_type = args.logprob_type
 
     def make_optimizer(self, args):
@@ -155,7 +156,7 @@ class HyperRegression(nn.Module):
         # log_px = log_py - delta_log_py
 
         gt_labels = x[:, 3:5, 0, 0]
-        onehot_tensor = torch.eye(2).cuda()
+        onehot_tensor = torch.eye(2, device=x.device)
         bg_onehot = onehot_tensor[0]  # background
         person_onehot = onehot_tensor[1]  # person
         # bg_indices = np.where((gt_labels == (1, 0)).all(axis=1))
@@ -194,27 +195,27 @@ class HyperRegression(nn.Module):
         return recon_nats
 
     @staticmethod
-    def sample_gaussian(size, truncate_std=None, gpu=None):
+    def sample_gaussian(size, truncate_std=None, device=None):
         y = torch.randn(*size).float()
-        y = y if gpu is None else y.cuda(gpu)
+        y = y if device is None else y.to(device)
         if truncate_std is not None:
             truncated_normal(y, mean=0, std=1, trunc_std=truncate_std)
         return y
 
     @staticmethod
-    def sample_gaussian(size, truncate_std=None, gpu=None):
+    def sample_gaussian(size, truncate_std=None, device=None):
         y = torch.randn(*size).float()
-        y = y if gpu is None else y.cuda(gpu)
+        y = y if device is None else y.to(device)
         if truncate_std is not None:
             truncated_normal(y, mean=0, std=1, trunc_std=truncate_std)
         return y
 
     @staticmethod
-    def sample_laplace(size, gpu=None):
+    def sample_laplace(size, device=None):
         m = Laplace(torch.tensor([0.0]), torch.tensor([1.0]))
         y = m.sample(sample_shape=torch.Size(
             [size[0], size[1], size[2]])).float().squeeze(3)
-        y = y if gpu is None else y.cuda(gpu)
+        y = y if device is None else y.to(device)
         return y
 
     def decode(self, z, num_points):
@@ -222,10 +223,10 @@ class HyperRegression(nn.Module):
         target_networks_weights = self.hyper(z)
         if self.logprob_type == "Laplace":
             y = self.sample_laplace(
-                (z.size(0), num_points, self.input_dim), self.gpu)
+                (z.size(0), num_points, self.input_dim), self.device)
         if self.logprob_type == "Normal":
             y = self.sample_gaussian(
-                (z.size(0), num_points, self.input_dim), trucated_std=0.5, gpu=self.gpu)
+                (z.size(0), num_points, self.input_dim), trucated_std=0.5, device=self.device)
         x = self.point_cnf(y, target_networks_weights,
                            reverse=True).view(*y.size())
         return y, x
@@ -0,0 +1,86 @@
+import torch
+from torch import nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from FrEIA.modules import GLOWCouplingBlock
+
+
+def coupling_subnets(model):
+    """
+    (block, name, subnet) of every plain nn.Sequential subnet of the GLOW
+    coupling blocks in model, and the number of subnets of other types
+    (bf16 autocast, shared condition split subnets), which are left out
+    and stay float.
+    """
+    subnets, skipped = [], 0
+    for block in model.modules():
+        if not isinstance(block, GLOWCouplingBlock):
+            continue
+        for name in ('subnet1', 'subnet2'):
+            subnet = getattr(block, name)
+            if type(subnet) is nn.Sequential:
+                subnets.append((block, name, subnet))
+            else:
+                skipped += 1
+    return subnets, skipped
+
+
+def example_input(subnet):
+    first = subnet[0]
+    if isinstance(first, nn.Conv2d):
+        return torch.zeros(1, first.in_channels, 8, 8)
+    return torch.zeros(1, first.in_features)
+
+
+def quantize_subnets(model, calibrate=None, backend='x86'):
+    """
+    INT8 post-training static quantization (torch FX) of the coupling
+    subnets of model, in place. Only the subnets are quantized, they take
+    and return float tensors, so the affine couplings, permutations and the
+    Haar downsampling around them stay in float.
+    calibrate(model) runs representative inference while the observers are
+    in place; without it the subnets are only converted structurally, to
+    load the state dict of a quantized model into.
+    The quantized model runs on the CPU only. The number of quantized and
+    skipped (float) subnets is kept in model.quantized_subnets.
+    A --bf16 model can not be quantized, its autocast subnets would all be
+    skipped.
+    """
+    if getattr(getattr(model, 'args', None), 'bf16', False):
+        raise ValueError("INT8 quantization of a --bf16 model: the bfloat16 "
+                         "autocast subnets can not be quantized, build the "
+                         "model without --bf16.")
+    model.cpu().eval()
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+
+    subnets, skipped = coupling_subnets(model)
+    for block, name, subnet in subnets:
+        setattr(block, name, prepare_fx(
+            subnet, qconfig_mapping, (example_input(subnet),)))
+
+    if calibrate is not None:
+        with torch.no_grad():
+            calibrate(model)
+
+    for block, name, _ in subnets:
+        setattr(block, name, convert_fx(getattr(block, name)))
+
+    model.quantized = backend
+    model.quantized_subnets = (len(subnets), skipped)
+    if hasattr(model, 'device'):
+        model.device = torch.device('cpu')
+    print('quantized %d of %d coupling subnets (%s), %d stay float' %
+          (len(subnets), len(subnets) + skipped, backend, skipped))
+    return model
+
+
+def save_quantized(model, epoch, path):
+    """checkpoint of a quantized model, Trainable.resume rebuilds it"""
+    d = {
+        'epoch': epoch,
+        'model': model.state_dict(),
+        'quantized': model.quantized
+    }
+    torch.save(d, path)
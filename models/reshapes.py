@@ -1,7 +1,113 @@
 import numpy as np
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
+
+
+# signs of the 2nd to 4th term of the four Haar wavelets (average, vertical,
+# horizontal, diagonal) of the polyphase components p00, p01, p10, p11 of a
+# 2x2 block. The matrix is symmetric, the same signs give the polyphase
+# components back from the wavelets.
+HAAR_SIGNS = ((1, 1, 1), (-1, 1, -1), (1, -1, -1), (-1, -1, 1))
+
+
+def _haar_sums(terms):
+    '''the four signed sums of terms, as new tensors (differentiable)'''
+    first, rest = terms[0], terms[1:]
+    sums = []
+    for signs in HAAR_SIGNS:
+        out = first
+        for term, sign in zip(rest, signs):
+            out = out + term if sign > 0 else out - term
+        sums.append(out)
+    return sums
+
+
+def _haar_sums_into(terms, outs):
+    '''the four signed sums of terms written into the views outs, adding
+    left to right like _haar_sums, without temporaries'''
+    first, rest = terms[0], terms[1:]
+    for out, signs in zip(outs, HAAR_SIGNS):
+        (torch.add if signs[0] > 0 else torch.sub)(first, rest[0], out=out)
+        for term, sign in zip(rest[1:], signs[1:]):
+            if sign > 0:
+                out.add_(term)
+            else:
+                out.sub_(term)
+
+
+def _polyphase(x):
+    '''strided views p00, p01, p10, p11 of the 2x2 blocks of x'''
+    B, C, H, W = x.shape
+    x = x.reshape(B, C, H // 2, 2, W // 2, 2)
+    return [x[:, :, :, i, :, j] for i in range(2) for j in range(2)]
+
+
+def _wavelets(y, order_by_wavelet):
+    '''views of the four wavelet bands of y [B, 4C, H, W]'''
+    B, C4, H, W = y.shape
+    if order_by_wavelet:
+        return y.reshape(B, 4, C4 // 4, H, W).unbind(1)
+    return y.reshape(B, C4 // 4, 4, H, W).unbind(2)
+
+
+def new_empty(x, shape):
+    '''uninitialized tensor of shape in the memory format of the 4D x,
+    channels-last if x is (and is not also contiguous)'''
+    channels_last = (x.dim() == 4 and not x.is_contiguous()
+                     and x.is_contiguous(memory_format=torch.channels_last))
+    return torch.empty(shape, dtype=x.dtype, device=x.device,
+                       memory_format=torch.channels_last if channels_last
+                       else torch.contiguous_format)
+
+
+def _differentiable(x):
+    # out= writes do not support autograd
+    return torch.is_grad_enabled() and x.requires_grad
+
+
+def haar_split(x, fac=0.5, order_by_wavelet=False):
+    '''Haar wavelet transform of every 2x2 block from the strided polyphase
+    components, [B, C, H, W] -> [B, 4C, H/2, W/2] scaled by fac. Channel
+    4i + j is the j-th wavelet (average, vertical, horizontal, diagonal) of
+    channel i, or with order_by_wavelet channel jC + i. Same values as the
+    grouped +-1 convolution of FrEIA's HaarDownsampling, outside of
+    autograd written straight into the only allocated tensor.'''
+    B, C, H, W = x.shape
+    terms = _polyphase(x)
+    if _differentiable(x):
+        out = torch.stack(_haar_sums(terms), 1 if order_by_wavelet else 2)
+        return out.reshape(B, 4 * C, H // 2, W // 2) * fac
+    out = new_empty(x, (B, 4 * C, H // 2, W // 2))
+    _haar_sums_into(terms, _wavelets(out, order_by_wavelet))
+    return out.mul_(fac)
+
+
+def haar_merge(y, fac=0.5, order_by_wavelet=False):
+    '''inverse of haar_split(x, 1 / (4 * fac), order_by_wavelet)'''
+    B, C4, H, W = y.shape
+    terms = _wavelets(y, order_by_wavelet)
+    if _differentiable(y):
+        out = torch.stack(_haar_sums(terms), -1).view(B, C4 // 4, H, W, 2, 2)
+        return out.permute(0, 1, 2, 4, 3, 5).reshape(B, C4 // 4, 2 * H, 2 * W) * fac
+    out = new_empty(y, (B, C4 // 4, 2 * H, 2 * W))
+    _haar_sums_into(terms, _polyphase(out))
+    return out.mul_(fac)
+
+
+def i_revnet_split(x):
+    '''i-RevNet space-to-depth, [B, C, H, W] -> [B, 4C, H/2, W/2] with
+    channel (2i + j)C + c pixel (i, j) of the 2x2 blocks of channel c. One
+    copy of the strided polyphase components.'''
+    B, C, H, W = x.shape
+    x = x.reshape(B, C, H // 2, 2, W // 2, 2).permute(0, 3, 5, 1, 2, 4)
+    return x.reshape(B, 4 * C, H // 2, W // 2)
+
+
+def i_revnet_merge(y):
+    '''inverse of i_revnet_split'''
+    B, C4, H, W = y.shape
+    y = y.reshape(B, 2, 2, C4 // 4, H, W).permute(0, 3, 4, 1, 5, 2)
+    return y.reshape(B, C4 // 4, 2 * H, 2 * W)
 
 
 class i_revnet_downsampling(nn.Module):
@@ -14,42 +120,10 @@ class i_revnet_downsampling(nn.Module):
         self.block_size_sq = self.block_size**2
 
     def forward(self, x, rev=False):
-        input = x[0]
         if not rev:
-            output = input.permute(0, 2, 3, 1)
-            (batch_size, s_height, s_width, s_depth) = output.size()
-            d_depth = s_depth * self.block_size_sq
-            d_height = int(s_height / self.block_size)
-            t_1 = output.split(self.block_size, 2)
-            stack = [t_t.contiguous().view(batch_size, d_height, d_depth)
-                     for t_t in t_1]
-            output = torch.stack(stack, 1)
-            output = output.permute(0, 2, 1, 3)
-            output = output.permute(0, 3, 1, 2)
-            return [output.contiguous()]
-            # (own attempt)
-            # return torch.cat([
-            #         x[:, :,  ::2,  ::2],
-            #         x[:, :, 1::2,  ::2],
-            #         x[:, :,  ::2, 1::2],
-            #         x[:, :, 1::2, 1::2]
-            #     ], dim=1)
+            return [i_revnet_split(x[0])]
         else:
-            output = input.permute(0, 2, 3, 1)
-            (batch_size, d_height, d_width, d_depth) = output.size()
-            s_depth = int(d_depth / self.block_size_sq)
-            s_width = int(d_width * self.block_size)
-            s_height = int(d_height * self.block_size)
-            t_1 = output.contiguous().view(batch_size, d_height, d_width,
-                                           self.block_size_sq, s_depth)
-            spl = t_1.split(self.block_size, 3)
-            stack = [t_t.contiguous().view(batch_size, d_height, s_width,
-                                           s_depth) for t_t in spl]
-            output = torch.stack(stack, 0).transpose(0, 1)
-            output = output.permute(0, 2, 1, 3, 4).contiguous()
-            output = output.view(batch_size, s_height, s_width, s_depth)
-            output = output.permute(0, 3, 1, 2)
-            return [output.contiguous()]
+            return [i_revnet_merge(x[0])]
 
     def jacobian(self, x, rev=False):
         # TODO respect batch dimension and .cuda()
@@ -105,40 +179,18 @@ class haar_multiplex_layer(nn.Module):
 
         self.haar_weights *= 0.5
         self.haar_weights = torch.cat([self.haar_weights]*self.in_channels, 0)
+        # the transform is computed in closed form (haar_split / haar_merge),
+        # the weights only stay so that existing state dicts load
         self.haar_weights = nn.Parameter(self.haar_weights)
         self.haar_weights.requires_grad = False
 
         self.permute = order_by_wavelet
 
-        if self.permute:
-            permutation = []
-            for i in range(4):
-                permutation += [i+4*j for j in range(self.in_channels)]
-
-            self.perm = torch.LongTensor(permutation)
-            self.perm_inv = torch.LongTensor(permutation)
-
-            for i, p in enumerate(self.perm):
-                self.perm_inv[p] = i
-
     def forward(self, x, rev=False):
         if not rev:
-            out = F.conv2d(x[0], self.haar_weights,
-                           bias=None, stride=2, groups=self.in_channels)
-            if self.permute:
-                return [out[:, self.perm]]
-            else:
-                return [out]
-
+            return [haar_split(x[0], 0.5, order_by_wavelet=self.permute)]
         else:
-            if self.permute:
-                x_perm = x[0][:, self.perm_inv]
-            else:
-                x_perm = x[0]
-
-            return [F.conv_transpose2d(x_perm, self.haar_weights,
-                                       bias=None, stride=2,
-                                       groups=self.in_channels)]
+            return [haar_merge(x[0], 0.5, order_by_wavelet=self.permute)]
 
     def jacobian(self, x, rev=False):
         # TODO respect batch dimension and .cuda()
@@ -173,17 +225,15 @@ class haar_restore_layer(nn.Module):
 
         self.haar_weights *= 0.5
         self.haar_weights = torch.cat([self.haar_weights]*self.in_channels, 0)
+        # see haar_multiplex_layer
         self.haar_weights = nn.Parameter(self.haar_weights)
         self.haar_weights.requires_grad = False
 
     def forward(self, x, rev=False):
         if rev:
-            return [F.conv2d(x[0], self.haar_weights,
-                             bias=None, stride=2, groups=self.in_channels)]
+            return [haar_split(x[0], 0.5)]
         else:
-            return [F.conv_transpose2d(x[0], self.haar_weights,
-                                       bias=None, stride=2,
-                                       groups=self.in_channels)]
+            return [haar_merge(x[0], 0.5)]
 
     def jacobian(self, x, rev=False):
         # TODO respect batch dimension and .cuda()
@@ -0,0 +1,41 @@
+import torch
+from torch import nn
+
+import models.modules as modules
+
+
+class SamplerModule(nn.Module):
+    """
+    Reverse sampling path of a CondINNWrapper as a single module with the
+    latent noise as an explicit input, for export:
+        (image [B, 3, 256, 256], one-hot class [B, num_classes + 1],
+         eps [B, 4, 64, 64]) -> mask [B, 1, 128, 128]
+    i.e. condition pyramid, learned prior, PriorFlow reverse, unsqueeze2d and
+    SegFlow reverse, the same computation as decode_conditions with the
+    noise given.
+    """
+
+    def __init__(self, model, stddev=0.1):
+        super(SamplerModule, self).__init__()
+        self.model = model.eval()
+        self.stddev = stddev
+
+    def forward(self, img, class_onehot, eps):
+        cond0, cond1 = modules.squeeze_pyramid(
+            img, (4, 2), memory_format=self.model.memory_format)
+        # CondINNWrapper.class_condition without the data dependent nonzero
+        cond2 = class_onehot.argmax(dim=1, keepdim=True).float().repeat(1, 1000)
+        conditions = [cond0, cond1, cond2]
+
+        mean, logs = self.model.prior(cond2)
+        z = modules.GaussianDiag.sample(mean, logs, eps_std=self.stddev, eps=eps)
+        return self.model.decode_latent(z, conditions)
+
+    def example_inputs(self, batch_size=1):
+        args = self.model.args
+        device = self.model.device
+        img = torch.rand(batch_size, 3, 256, 256, device=device) * 255
+        class_onehot = torch.zeros(batch_size, args.num_classes + 1, device=device)
+        class_onehot[:, 1] = 1
+        eps = torch.randn(batch_size, 4, 64, 64, device=device)
+        return img, class_onehot, eps
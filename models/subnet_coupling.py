@@ -2,10 +2,12 @@ from math import exp
 import torch
 import torch.nn as nn
 
+from FrEIA.modules import InvertibleModule
 
-class subnet_coupling_layer(nn.Module):
+
+class subnet_coupling_layer(InvertibleModule):
     def __init__(self, dims_in, dims_c, F_class, subnet, sub_len, F_args={}, clamp=5.):
-        super().__init__()
+        super().__init__(dims_in, dims_c)
 
         channels = dims_in[0][0]
         self.ndims = len(dims_in[0])
@@ -31,7 +33,7 @@ class subnet_coupling_layer(nn.Module):
     def log_e(self, s):
         return self.clamp * 0.636 * torch.atan(s / self.clamp)
 
-    def forward(self, x, c=[], rev=False):
+    def forward(self, x, c=[], rev=False, jac=True):
         x1, x2 = (x[0].narrow(1, 0, self.split_len1),
                   x[0].narrow(1, self.split_len1, self.split_len2))
         c_star = self.subnet(torch.cat(c, 1))
@@ -60,7 +62,7 @@ class subnet_coupling_layer(nn.Module):
             y1 = (x1 - t2) / self.e(s2)
             self.last_jac = - self.log_e(s1) - self.log_e(s2)
 
-        return [torch.cat((y1, y2), 1)]
+        return (torch.cat((y1, y2), 1),), self.jacobian(x, c, rev=rev)
 
     def jacobian(self, x, c=[], rev=False):
         return torch.sum(self.last_jac, dim=tuple(range(1, self.ndims+1)))
@@ -0,0 +1,40 @@
+import pytest
+import torch
+
+cond_inn = pytest.importorskip('models.cond_inn', exc_type=ImportError)
+
+from args import get_parser
+
+
+@pytest.mark.parametrize('constructor, shape', [(cond_inn.subnet_conv, (2, 4, 16, 16)),
+                                                (cond_inn.subnet_fc, (2, 12))])
+def test_autocast_subnet(constructor, shape):
+    torch.manual_seed(0)
+    reference = constructor(shape[1], 8)
+    subnet = constructor(shape[1], 8, autocast=True)
+    assert isinstance(subnet, cond_inn.AutocastSubnet)
+    # same parameters and state dict keys as the float subnet
+    subnet.load_state_dict(reference.state_dict())
+
+    x = torch.randn(*shape)
+    with torch.no_grad():
+        out, expected = subnet(x), reference(x)
+    assert out.dtype == torch.float32
+    torch.testing.assert_close(out, expected, rtol=0.05, atol=0.05)
+
+
+def test_bf16_model_loads_float_weights():
+    def make_model(extra=()):
+        torch.manual_seed(0)
+        args = get_parser().parse_args(
+            ['--device', 'cpu', '--batch_size', '2', '--num_classes', '80'] + list(extra))
+        return cond_inn.CondINNWrapper(args, img_dims=(256, 256)).eval()
+
+    model = make_model(['--bf16'])
+    model.load_state_dict(make_model().state_dict())
+    img = torch.rand(1, 3, 256, 256) * 255
+    class_cond = torch.zeros(1, 81)
+    class_cond[0, 3] = 1
+    with torch.no_grad():
+        mask = model.decode_and_average(img, class_cond, 2, pick=0)
+    assert mask.dtype == torch.float32 and torch.isfinite(mask).all()
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+import torch
+
+boundary_inn = pytest.importorskip('models.boundary_inn', exc_type=ImportError)
+
+from args import get_parser
+from dataset_coco import mask_to_boundary
+
+
+def make_model():
+    torch.manual_seed(0)
+    args = get_parser().parse_args(
+        ['--device', 'cpu', '--batch_size', '2', '--num_classes', '80',
+         '--model_mode', 'boundary', '--num_boundary_points', '32'])
+    return boundary_inn.BoundaryINNWrapper(args)
+
+
+def batch():
+    torch.manual_seed(1)
+    img = torch.rand(2, 3, 256, 256) * 255
+    mask = np.zeros((128, 128), dtype=np.float32)
+    mask[32:96, 40:100] = 255
+    points = torch.from_numpy(mask_to_boundary(mask, 32)).expand(2, -1, -1)
+    class_cond = torch.zeros(2, 81)
+    class_cond[:, 3] = 1
+    return img, points, class_cond
+
+
+def test_boundary_round_trip():
+    mask = np.zeros((128, 128), dtype=np.float32)
+    mask[32:96, 40:100] = 255
+    points = mask_to_boundary(mask, 64)
+    assert points.shape == (64, 2) and (points >= 0).all() and (points <= 1).all()
+
+    raster = boundary_inn.rasterize_boundary(torch.from_numpy(points)[None], 128)[0, 0]
+    target = torch.from_numpy(mask) > 127
+    iou = ((raster > 127) & target).sum() / ((raster > 127) | target).sum()
+    assert iou > 0.95
+
+
+def test_train_step_and_decode():
+    model = make_model()
+    img, points, class_cond = batch()
+    sample_mean, losses = model(img, points, class_cond, monitor=True)
+    assert torch.isfinite(losses['train_loss'])
+    assert sample_mean.shape == (1, 128, 128)
+
+    with torch.no_grad():
+        assert model.decode(img, class_cond, 3).shape == (2, 3, 32, 2)
+        assert model.decode_masks(img, class_cond, 3).shape == (2, 1, 128, 128)
+
+
+def test_save_and_resume(tmp_path):
+    model = make_model()
+    model(*batch())
+    path = str(tmp_path / 'boundary.pt')
+    model.save(5, path)
+
+    resumed = make_model()
+    assert resumed.resume(path) == 5
+    state = resumed.state_dict()
+    assert all(torch.equal(v, state[k]) for k, v in model.state_dict().items())
+    resumed_state = resumed.optimizers[0].state_dict()['state']
+    expected = model.optimizers[0].state_dict()['state']
+    assert resumed_state.keys() == expected.keys()
+    assert all(torch.equal(resumed_state[k]['exp_avg'], expected[k]['exp_avg'])
+               for k in expected)
+
+    # the resumed model decodes the same points from the same noise
+    img, _, class_cond = batch()
+    with torch.no_grad():
+        torch.manual_seed(2)
+        expected_points = model.decode(img, class_cond, 2)
+        torch.manual_seed(2)
+        assert torch.equal(resumed.decode(img, class_cond, 2), expected_points)
+
+    # a checkpoint without the optimizer state resumes non-strict only
+    ckpt = torch.load(path)
+    del ckpt['boundary-optimizer']
+    torch.save(ckpt, path)
+    with pytest.raises(KeyError):
+        make_model().resume(path)
+    assert make_model().resume(path, strict=False) == 5
@@ -0,0 +1,95 @@
+import pytest
+import torch
+from FrEIA.modules import GLOWCouplingBlock
+
+cond_inn = pytest.importorskip('models.cond_inn', exc_type=ImportError)
+
+from args import get_parser
+from models.graph_plan import FoldedCoupling
+from models.modules import squeeze2d
+from models.reshapes import haar_merge, haar_split
+
+CHANNELS_LAST = torch.channels_last
+
+
+def make_model(extra=()):
+    torch.manual_seed(0)
+    args = get_parser().parse_args(
+        ['--device', 'cpu', '--batch_size', '2', '--num_classes', '80'] + list(extra))
+    model = cond_inn.CondINNWrapper(args, img_dims=(256, 256)).eval()
+    # small enough for the latents of the untrained flow to stay moderate,
+    # so that the layouts can be compared at a tight tolerance
+    with torch.no_grad():
+        for name, p in model.named_parameters():
+            if p.requires_grad and not name.endswith('prior_h'):
+                p.mul_(0.1).add_(1e-3 * torch.randn_like(p))
+    return model
+
+
+def record_layouts(modules, types):
+    '''channels-last flags of the 4D inputs of the modules of types'''
+    layouts = []
+
+    def hook(module, inputs):
+        x = inputs[0][0]
+        if x.dim() == 4:
+            layouts.append(x.is_contiguous(memory_format=CHANNELS_LAST))
+    for module in modules:
+        if isinstance(module, types):
+            module.register_forward_pre_hook(hook)
+    return layouts
+
+
+def run_segflow(model):
+    torch.manual_seed(1)
+    img = torch.rand(2, 3, 256, 256) * 255
+    class_cond = torch.zeros(2, 81)
+    class_cond[:, 3] = 1
+    conditions = model.make_conditions(img, class_cond)
+    y = torch.rand(2, 1, 128, 128) * 255
+    with torch.no_grad():
+        z, jac = model.segflow(y, c=conditions)
+        x = model.segflow(z, c=conditions, rev=True)[0]
+    return z, jac, x
+
+
+@pytest.mark.parametrize('extra', [[], ['--shared_cond_proj']])
+@pytest.mark.parametrize('fold', [False, True])
+def test_couplings_get_channels_last_input(extra, fold):
+    model = make_model(['--channels_last'] + extra)
+    if fold:
+        model.fold_for_inference()
+        modules = model.segflow.inference_plan.modules.values()
+        types = FoldedCoupling
+    else:
+        modules = model.segflow.inn.modules()
+        types = GLOWCouplingBlock
+    layouts = record_layouts(modules, types)
+
+    z, jac, x = run_segflow(model)
+    # 16 conv coupling blocks, forward and reverse
+    assert len(layouts) == 32 and all(layouts)
+    # converted at the flatten node and the output
+    assert z.is_contiguous() and x.is_contiguous()
+
+    reference = make_model(extra)
+    reference.load_state_dict(model.state_dict())
+    z_ref, jac_ref, x_ref = run_segflow(reference)
+    # same values up to the summation order of the convolutions
+    torch.testing.assert_close(z, z_ref, rtol=1e-3, atol=1e-2)
+    torch.testing.assert_close(jac, jac_ref, rtol=1e-4, atol=1e-1)
+    torch.testing.assert_close(x, x_ref, rtol=1e-3, atol=1e-2)
+
+
+@pytest.mark.parametrize('order_by_wavelet', [False, True])
+def test_haar_reshapes_keep_channels_last(order_by_wavelet):
+    x = squeeze2d(torch.randn(2, 2, 32, 32), 2)
+    x_cl = x.contiguous(memory_format=CHANNELS_LAST)
+    y = haar_split(x, 0.5, order_by_wavelet)
+    y_cl = haar_split(x_cl, 0.5, order_by_wavelet)
+    assert y_cl.is_contiguous(memory_format=CHANNELS_LAST)
+    assert torch.equal(y_cl, y)
+
+    x_back = haar_merge(y_cl, 0.5, order_by_wavelet)
+    assert x_back.is_contiguous(memory_format=CHANNELS_LAST)
+    assert torch.equal(x_back, haar_merge(y, 0.5, order_by_wavelet))
@@ -0,0 +1,265 @@
+import copy
+
+import pytest
+import torch
+
+cond_inn = pytest.importorskip('models.cond_inn', exc_type=ImportError)
+
+import models.modules as modules
+from args import get_parser
+
+CondINNWrapper = cond_inn.CondINNWrapper
+
+
+def make_model(extra=()):
+    torch.manual_seed(0)
+    args = get_parser().parse_args(
+        ['--device', 'cpu', '--batch_size', '2', '--num_classes', '80'] + list(extra))
+    model = CondINNWrapper(args, img_dims=(256, 256)).eval()
+    # small non-zero weights, so that the untrained flows stay finite and no
+    # block is the identity (the hidden prior state has to stay zero)
+    with torch.no_grad():
+        for name, p in model.named_parameters():
+            if p.requires_grad and not name.endswith('prior_h'):
+                p.mul_(0.3).add_(1e-3 * torch.randn_like(p))
+    return model
+
+
+@pytest.fixture(scope='module')
+def model():
+    return make_model()
+
+
+def inputs(batch_size=2):
+    torch.manual_seed(1)
+    img = torch.rand(batch_size, 3, 256, 256) * 255
+    class_cond = torch.zeros(batch_size, 81)
+    class_cond[torch.arange(batch_size), torch.arange(batch_size) + 3] = 1
+    return img, class_cond
+
+
+def record_samples(model, monkeypatch):
+    '''the decoded samples [B, S, ...] of every decode_conditions call'''
+    calls = []
+    decode_conditions = model.decode_conditions
+
+    def recording(conditions, *args, nr_sample=1, **kwargs):
+        x = decode_conditions(conditions, *args, nr_sample=nr_sample, **kwargs)
+        calls.append(x.view(-1, nr_sample, *x.shape[1:]))
+        return x
+    monkeypatch.setattr(model, 'decode_conditions', recording)
+    return calls
+
+
+def test_sample_chunks():
+    assert list(CondINNWrapper.sample_chunks(7, 3)) == [(0, 3), (3, 3), (6, 1)]
+    assert list(CondINNWrapper.sample_chunks(7, 3, 'antithetic')) == [(0, 4), (4, 3)]
+
+
+def test_streaming_statistics(model, monkeypatch):
+    img, class_cond = inputs()
+    calls = record_samples(model, monkeypatch)
+    with torch.no_grad():
+        mean, variance, entropy = model.decode_streaming(
+            img, class_cond, 7, chunk_size=3, return_uncertainty=True)
+    assert [c.size(1) for c in calls] == [3, 3, 1]
+
+    samples = torch.cat(calls, dim=1)
+    torch.testing.assert_close(mean, samples.mean(dim=1))
+    torch.testing.assert_close(variance, samples.var(dim=1, unbiased=False),
+                               rtol=1e-4, atol=1e-2)
+    p = (samples > 127.5).float().mean(dim=1).clamp(1e-6, 1 - 1e-6)
+    torch.testing.assert_close(entropy, -(p * p.log() + (1 - p) * (1 - p).log()))
+
+
+def record_noise(model, monkeypatch):
+    '''the latent noise [B, S, ...] of every NoiseBuffers.sample call'''
+    calls = []
+    sample = model.noise.sample
+
+    def recording(sampler, n, shape, images=1, **kwargs):
+        eps = sample(sampler, n, shape, images=images, **kwargs)
+        calls.append(eps.view(images, n, *shape).clone())
+        return eps
+    monkeypatch.setattr(model.noise, 'sample', recording)
+    return calls
+
+
+def test_chunked_sobol_continues_the_sequence(model, monkeypatch):
+    img, class_cond = inputs()
+    calls = record_noise(model, monkeypatch)
+    with torch.no_grad():
+        model.noise.manual_seed(0)
+        model.decode_streaming(img, class_cond, 8, chunk_size=8, sampler='sobol')
+        model.noise.manual_seed(0)
+        model.decode_streaming(img, class_cond, 8, chunk_size=3, sampler='sobol')
+    assert len(calls) == 4
+    assert torch.equal(torch.cat(calls[1:], dim=1), calls[0])
+
+
+def test_chunked_antithetic_pairs_stay_within_an_image(model, monkeypatch):
+    img, class_cond = inputs()
+    calls = record_noise(model, monkeypatch)
+    with torch.no_grad():
+        model.decode_streaming(img, class_cond, 7, chunk_size=3, sampler='antithetic')
+    assert [eps.size(1) for eps in calls] == [4, 3]
+    for eps in calls:
+        pairs = eps.size(1) // 2
+        assert torch.equal(eps[:, 1:2 * pairs:2], -eps[:, 0:2 * pairs:2])
+
+
+def test_map_decode_is_the_zero_noise_sample(model):
+    img, class_cond = inputs()
+    with torch.no_grad():
+        masks = model.decode_map(img, class_cond)
+        conditions = model.make_conditions(img, class_cond)
+        mean, logs = model.prior(conditions[2])
+        z = modules.GaussianDiag.sample(mean, logs, eps=torch.zeros_like(mean))
+        expected = model.decode_latent(z, conditions)
+        single = model.decode_map(img[1:], class_cond[1:])
+    assert masks.shape == (2, 1, 128, 128)
+    assert torch.equal(masks, expected)
+    torch.testing.assert_close(masks[1:], single, rtol=1e-4, atol=1e-3)
+
+
+def test_adaptive_decode(model, monkeypatch):
+    img, class_cond = inputs()
+    calls = record_samples(model, monkeypatch)
+    with torch.no_grad():
+        # never converges: every image gets max_samples
+        mean, variance, count = model.decode_adaptive(
+            img, class_cond, round_size=3, max_samples=6, tol=-1.)
+    assert count.tolist() == [6, 6] and len(calls) == 2
+    samples = torch.cat(calls, dim=1)
+    torch.testing.assert_close(mean, samples.mean(dim=1))
+    torch.testing.assert_close(variance, samples.var(dim=1, unbiased=False),
+                               rtol=1e-4, atol=1e-2)
+
+    with torch.no_grad():
+        # converges as soon as there is a previous mean to compare with
+        _, _, count = model.decode_adaptive(
+            img, class_cond, round_size=3, max_samples=30, tol=float('inf'))
+    assert count.tolist() == [6, 6]
+
+
+@pytest.mark.parametrize('extra', [[], ['--shared_cond_proj']])
+def test_decode_classes_matches_per_class_decodes(model, monkeypatch, extra):
+    if extra:
+        model = make_model(extra)
+    img, _ = inputs(1)
+    class_ids, nr_sample = [0, 3, 17], 2
+    noise = record_noise(model, monkeypatch)
+    with torch.no_grad():
+        masks = model.decode_classes(img, class_ids, nr_sample)
+    eps, = noise
+    assert masks.shape == (3, 1, 128, 128)
+    assert not torch.allclose(masks[1], masks[2])
+
+    for k, class_id in enumerate(class_ids):
+        class_cond = torch.zeros(1, 81)
+        class_cond[0, class_id] = 1
+        with torch.no_grad():
+            conditions = [cond.repeat_interleave(nr_sample, dim=0)
+                          for cond in model.make_conditions(img, class_cond)]
+            mean, logs = model.prior(conditions[2])
+            z = modules.GaussianDiag.sample(mean, logs, eps_std=0.1, eps=eps[k])
+            expected = model.decode_latent(z, conditions).mean(dim=0)
+        torch.testing.assert_close(masks[k], expected, rtol=1e-4, atol=1e-2)
+
+
+def test_tile_blend_window():
+    window = CondINNWrapper.tile_blend_window(16, 4)
+    assert window.shape == (16, 16) and (window > 0).all()
+    assert torch.equal(window, window.t()) and torch.equal(window, window.flip(0))
+    assert (window[4:12, 4:12] == 1).all() and window[0, 0] < window[1, 1] < 1
+
+
+def test_tiles_are_put_back_in_place(model, monkeypatch):
+    '''with a stand-in decode that downsamples the tile, the blended tiles
+    give the downsampled image back'''
+    def decode(tiles, class_cond, nr_sample, sampler='iid'):
+        return torch.nn.functional.avg_pool2d(tiles[:, :1], 2)
+    monkeypatch.setattr(model, 'decode_streaming', decode)
+
+    img = torch.rand(1, 3, 300, 420) * 255
+    class_cond = torch.zeros(1, 81)
+    mask = model.decode_tiled(img, class_cond, 4, tile_size=256, overlap=64, tile_batch=2)
+    assert mask.shape == (1, 1, 150, 210)
+    torch.testing.assert_close(mask, torch.nn.functional.avg_pool2d(img[:, :1], 2))
+
+
+def test_single_tile_is_the_streaming_decode(model):
+    img, class_cond = inputs(1)
+    with torch.no_grad():
+        model.noise.manual_seed(0)
+        mask = model.decode_tiled(img, class_cond, 4)
+        model.noise.manual_seed(0)
+        expected = model.decode_streaming(img, class_cond, 4)
+    torch.testing.assert_close(mask, expected)
+
+
+@pytest.mark.parametrize('extra', [[], ['--shared_cond_proj']])
+def test_refined_progressive_decode_is_the_full_decode(model, monkeypatch, extra):
+    if extra:
+        model = make_model(extra)
+    img, class_cond = inputs()
+    nr_sample = 3
+    noise = record_noise(model, monkeypatch)
+    with torch.no_grad():
+        masks, refined = model.decode_progressive(img, class_cond, nr_sample, refine=True)
+        coarse, not_refined = model.decode_progressive(img, class_cond, nr_sample, refine=False)
+    assert refined.tolist() == [True, True] and not_refined.tolist() == [False, False]
+
+    eps = noise[0].flatten(0, 1)
+    with torch.no_grad():
+        conditions = [cond.repeat_interleave(nr_sample, dim=0)
+                      for cond in model.make_conditions(img, class_cond)]
+        mean, logs = model.prior(conditions[2])
+        z = modules.GaussianDiag.sample(mean, logs, eps_std=0.1, eps=eps)
+        expected = model.decode_latent(z, conditions)
+    expected = expected.view(2, nr_sample, *expected.shape[1:]).mean(dim=1)
+    torch.testing.assert_close(masks, expected, rtol=1e-4, atol=1e-2)
+    # the coarse masks skip the high-res blocks
+    assert not torch.allclose(coarse, masks, atol=1.)
+
+
+def test_progressive_decode_refines_ambiguous_images(model):
+    img, class_cond = inputs()
+    with torch.no_grad():
+        _, refined = model.decode_progressive(img, class_cond, band=(-1e9, 1e9))
+        _, not_refined = model.decode_progressive(img, class_cond, band=(0., 0.))
+    assert refined.tolist() == [True, True]
+    assert not_refined.tolist() == [False, False]
+
+
+def test_instances_group_the_samples(model, monkeypatch):
+    '''with a stand-in decode giving a full mask for the first sample of
+    every chunk and an empty one otherwise'''
+    def decode(conditions, sampler='iid', nr_sample=1):
+        x = torch.zeros(conditions[2].size(0), 1, 128, 128)
+        x.view(-1, nr_sample, 1, 128, 128)[:, 0] = 255.
+        return x
+    monkeypatch.setattr(model, 'decode_conditions', decode)
+
+    img, class_cond = inputs()
+    masks, counts = model.decode_instances(img, class_cond, 6, num_instances=3, chunk_size=4)
+    assert masks.shape == (2, 3, 1, 128, 128)
+    # chunks of 4 and 2 samples: 2 full and 4 empty masks, no third instance
+    assert counts.tolist() == [[4, 2, 0]] * 2
+    assert (masks[:, 0] == 0).all() and (masks[:, 1] == 255).all() and (masks[:, 2] == 0).all()
+
+
+@pytest.mark.parametrize('extra', [[], ['--shared_cond_proj']])
+def test_folded_decode_is_the_graph_decode(extra):
+    model = make_model(extra)
+    folded = copy.deepcopy(model)
+    folded.fold_for_inference()
+    img, class_cond = inputs()
+    with torch.no_grad():
+        outputs = []
+        for m in [model, folded]:
+            m.noise.manual_seed(0)
+            outputs.append((m.decode_map(img, class_cond),
+                            m.decode_streaming(img, class_cond, 3, chunk_size=2)))
+    for graph, plan in zip(*outputs):
+        assert torch.equal(graph, plan)
@@ -0,0 +1,35 @@
+import pytest
+import torch
+
+from utils import set_cpu_inference_profile
+
+
+def test_cpu_inference_profile():
+    threads = torch.get_num_threads()
+    try:
+        assert set_cpu_inference_profile(threads=1)[0] == 1
+        # sized if the inter-op pool is still unused, kept otherwise, but
+        # never an error
+        assert set_cpu_inference_profile(interop_threads=2) == \
+            (1, torch.get_num_interop_threads())
+    finally:
+        torch.set_num_threads(threads)
+
+
+@pytest.mark.parametrize('mode', ['mask', 'boundary'])
+def test_models_build_on_the_cpu(mode):
+    boundary_inn = pytest.importorskip('models.boundary_inn', exc_type=ImportError)
+    from args import get_parser
+
+    args = get_parser().parse_args(['--device', 'cpu', '--batch_size', '2',
+                                    '--num_classes', '80', '--model_mode', mode])
+    model = boundary_inn.MODEL_MODES[mode](args, img_dims=(256, 256))
+    assert model.device == torch.device('cpu')
+    assert all(t.device.type == 'cpu' for t in model.state_dict().values())
+
+    img = torch.rand(1, 3, 256, 256) * 255
+    class_cond = torch.zeros(1, 81)
+    class_cond[0, 3] = 1
+    with torch.no_grad():
+        mask = model.eval().decode_and_average(img, class_cond, 2, pick=0)
+    assert mask.shape == (1, 128, 128) and mask.device.type == 'cpu'
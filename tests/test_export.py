@@ -0,0 +1,65 @@
+import pytest
+import torch
+
+cond_inn = pytest.importorskip('models.cond_inn', exc_type=ImportError)
+
+import models.modules as modules
+from args import get_parser
+from export import export_onnx, export_torchscript, load_onnx
+from models.sampler import SamplerModule
+
+
+def make_sampler():
+    torch.manual_seed(0)
+    args = get_parser().parse_args(
+        ['--device', 'cpu', '--batch_size', '2', '--num_classes', '80'])
+    model = cond_inn.CondINNWrapper(args, img_dims=(256, 256)).eval()
+    # no zero initialized layer, so that every block takes part in the check
+    # (the hidden prior state has to stay zero)
+    with torch.no_grad():
+        for name, p in model.named_parameters():
+            if p.requires_grad and not name.endswith('prior_h'):
+                p.mul_(0.3).add_(1e-3 * torch.randn_like(p))
+    return SamplerModule(model)
+
+
+@pytest.fixture(scope='module')
+def sampler():
+    return make_sampler()
+
+
+def reference(sampler, img, class_onehot, eps):
+    '''the eager decode_latent on the same noise'''
+    model = sampler.model
+    with torch.no_grad():
+        conditions = model.make_conditions(img, class_onehot)
+        mean, logs = model.prior(conditions[2])
+        z = modules.GaussianDiag.sample(mean, logs, eps_std=sampler.stddev, eps=eps)
+        return model.decode_latent(z, conditions)
+
+
+def check_exported(sampler, exported):
+    # a different batch size than the traced one
+    img, class_onehot, eps = sampler.example_inputs(3)
+    class_onehot[:, 1] = 0
+    class_onehot[torch.arange(3), torch.tensor([2, 5, 17])] = 1
+    expected = reference(sampler, img, class_onehot, eps)
+    with torch.no_grad():
+        out = exported(img, class_onehot, eps)
+    assert out.shape == expected.shape == (3, 1, 128, 128)
+    assert expected.std() > 0
+    torch.testing.assert_close(out, expected, rtol=1e-3, atol=1e-2)
+
+
+def test_torchscript_matches_eager(sampler, tmp_path):
+    path = str(tmp_path / 'sampler.pt')
+    export_torchscript(sampler, sampler.example_inputs(2), path)
+    check_exported(sampler, torch.jit.load(path))
+
+
+def test_onnx_matches_eager(sampler, tmp_path):
+    pytest.importorskip('onnxruntime')
+    pytest.importorskip('onnx')
+    path = str(tmp_path / 'sampler.onnx')
+    export_onnx(sampler, sampler.example_inputs(2), path)
+    check_exported(sampler, load_onnx(path))
@@ -0,0 +1,110 @@
+import pytest
+import torch
+from torch import nn
+
+from FrEIA.framework import ConditionNode, GraphINN, InputNode, Node, OutputNode
+from FrEIA.modules import Flatten, GLOWCouplingBlock, HaarDownsampling, PermuteRandom
+
+from models.graph_plan import GraphPlan, fold_fixed_transforms
+from models.modules import squeeze2d
+
+
+def subnet_conv(c_in, c_out):
+    return nn.Sequential(nn.Conv2d(c_in, 16, 3, padding=1), nn.ReLU(),
+                         nn.Conv2d(16, c_out, 3, padding=1))
+
+
+def subnet_fc(c_in, c_out):
+    return nn.Sequential(nn.Linear(c_in, 32), nn.ReLU(), nn.Linear(32, c_out))
+
+
+def make_inn():
+    '''the layouts of SegFlow and PriorFlow in small: conv couplings with
+    permutations around a Haar downsampling, then conditioned fc couplings'''
+    nodes = [InputNode(4, 16, 16, name='input')]
+    condition = ConditionNode(8, name='cond')
+    for k in range(2):
+        nodes.append(Node(nodes[-1], GLOWCouplingBlock,
+                          {'subnet_constructor': subnet_conv, 'clamp': 1.5}))
+        nodes.append(Node(nodes[-1], PermuteRandom, {'seed': k}))
+    nodes.append(Node(nodes[-1], HaarDownsampling, {}, name='haar'))
+    for k in range(2):
+        nodes.append(Node(nodes[-1], GLOWCouplingBlock,
+                          {'subnet_constructor': subnet_conv, 'clamp': 1.5}))
+        nodes.append(Node(nodes[-1], PermuteRandom, {'seed': 2 + k}))
+    nodes.append(Node(nodes[-1], Flatten, {}))
+    for k in range(3):
+        nodes.append(Node(nodes[-1], PermuteRandom, {'seed': 4 + k}))
+        nodes.append(Node(nodes[-1], GLOWCouplingBlock,
+                          {'subnet_constructor': subnet_fc, 'clamp': 1.5},
+                          conditions=condition))
+    nodes.append(OutputNode(nodes[-1], name='output'))
+    return GraphINN(nodes + [condition])
+
+
+def check_fold(flow, x, c):
+    plan = fold_fixed_transforms(flow)
+    assert len(plan.passthrough[False]) > 0 and len(plan.passthrough[True]) > 0
+
+    with torch.no_grad():
+        z, jac = flow(x, c=c)
+        z_plan, jac_plan = plan(x, c=c)
+        assert torch.equal(z, z_plan)
+        assert torch.equal(jac, jac_plan)
+
+        x_rev, jac_rev = flow(z, c=c, rev=True)
+        x_plan, jac_rev_plan = plan(z, c=c, rev=True)
+        assert torch.equal(x_rev, x_plan)
+        assert torch.equal(jac_rev, jac_rev_plan)
+    return plan
+
+
+def test_plan_matches_graph():
+    torch.manual_seed(0)
+    flow = make_inn().eval()
+    x, c = torch.randn(3, 4, 16, 16), [torch.randn(3, 8)]
+    with torch.no_grad():
+        z, jac = flow(x, c=c)
+        z_plan, jac_plan = GraphPlan(flow)(x, c=c)
+    assert torch.equal(z, z_plan) and torch.equal(jac, jac_plan)
+
+
+def test_folded_transforms_are_exact():
+    torch.manual_seed(0)
+    flow = make_inn().eval()
+    x, c = torch.randn(3, 4, 16, 16), [torch.randn(3, 8)]
+    plan = check_fold(flow, x, c)
+    # all but the permutation after Flatten follow a coupling block, all but
+    # the one before Flatten precede one (one of them through the Haar
+    # transform)
+    assert len(plan.passthrough[False]) == 6
+    assert len(plan.passthrough[True]) == 6
+
+
+@pytest.mark.parametrize('extra', [[], ['--shared_cond_proj']])
+def test_folded_flows_are_exact(extra):
+    cond_inn = pytest.importorskip('models.cond_inn', exc_type=ImportError)
+    from args import get_parser
+
+    torch.manual_seed(0)
+    args = get_parser().parse_args(
+        ['--device', 'cpu', '--batch_size', '2', '--num_classes', '80'] + extra)
+    model = cond_inn.CondINNWrapper(args, img_dims=(256, 256)).eval()
+    # smaller weights keep the untrained flows finite
+    with torch.no_grad():
+        for p in model.parameters():
+            if p.requires_grad:
+                p.mul_(0.3)
+
+    img = torch.rand(2, 3, 256, 256) * 255
+    class_cond = torch.zeros(2, 81)
+    class_cond[:, 3] = 1
+    conditions = model.make_conditions(img, class_cond)
+    if model.segflow.shared_cond_proj:
+        seg_conditions = model.segflow.project_conditions(conditions)
+    else:
+        seg_conditions = conditions
+    y = squeeze2d((torch.rand(2, 1, 128, 128) > 0.5).float() * 255, factor=2)
+
+    check_fold(model.segflow.inn, y, seg_conditions)
+    check_fold(model.priorflow.inn, torch.randn(2, 4 * 64 * 64), [conditions[2]])
@@ -0,0 +1,86 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from models.inn import CondINN, CondINNWrapper, latent_norm
+
+
+def make_inn():
+    torch.manual_seed(0)
+    np.random.seed(0)
+    inn = CondINN(None, img_dims=(32, 32)).eval()
+    # perturb the zero initialized last layers, so that no block is the identity
+    with torch.no_grad():
+        for p in inn.parameters():
+            if p.requires_grad:
+                p.add_(1e-3 * torch.randn_like(p))
+    return inn
+
+
+def inputs(batch_size=2):
+    x = torch.randn(batch_size, 2, 32, 32)
+    cond = [torch.randn(batch_size, 256, 32, 32), torch.randn(batch_size, 512 + 81)]
+    return x, cond
+
+
+def test_forward_matches_graph():
+    inn = make_inn()
+    x, cond = inputs()
+    with torch.no_grad():
+        z, jac = inn(x, cond)
+        z_graph, jac_graph = inn.cinn(x, c=cond)
+    assert len(z) == len(inn.cinn.out_nodes)
+    assert all(torch.equal(a, b) for a, b in zip(z, z_graph))
+    assert torch.equal(jac, jac_graph)
+
+
+def test_graph_is_built_once():
+    inn = make_inn()
+    graph = inn.cinn
+    state = {k: v.clone() for k, v in inn.state_dict().items()}
+    x, cond = inputs()
+    with torch.no_grad():
+        first, _ = inn(x, cond)
+        second, _ = inn(x, cond)
+    assert inn.cinn is graph
+    assert all(torch.equal(v, inn.state_dict()[k]) for k, v in state.items())
+    assert all(torch.equal(a, b) for a, b in zip(first, second))
+
+
+def test_reverse_and_log_likelihood():
+    inn = make_inn()
+    x, cond = inputs()
+    with torch.no_grad():
+        z, jac = inn(x, cond)
+        assert torch.allclose(inn.reverse(z, cond), x, atol=1e-4)
+        assert torch.allclose(inn.log_likelihood(x, cond), jac - 0.5 * latent_norm(z))
+
+
+class FeatureStandIn(nn.Module):
+    '''[B, 3, H, W] -> [B, 256, H + 2, W + 2], like the padded VGG features'''
+
+    def __init__(self):
+        super().__init__()
+        self.conv = nn.Conv2d(3, 256, 3, padding=2)
+
+    def features(self, x):
+        return self.conv(x)
+
+
+def test_wrapper_log_likelihood():
+    torch.manual_seed(0)
+    np.random.seed(0)
+    wrapper = CondINNWrapper(None, FeatureStandIn(), img_dims=(64, 64)).eval()
+    img = torch.randn(2, 3, 96, 96)
+    points = torch.randn(2, 2, 64, 64)
+    class_cond = torch.zeros(2, 81)
+    class_cond[:, 3] = 1
+    state = {k: v.clone() for k, v in wrapper.state_dict().items()}
+
+    with torch.no_grad():
+        log_p = wrapper.log_likelihood(img, points, class_cond)
+        expected = wrapper.inn.log_likelihood(points, wrapper.condition(img, class_cond))
+    assert log_p.shape == (2,)
+    assert torch.equal(log_p, expected)
+    # no optimizer step
+    assert all(torch.equal(v, wrapper.state_dict()[k]) for k, v in state.items())
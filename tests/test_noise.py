@@ -0,0 +1,71 @@
+import pytest
+import torch
+
+from models.modules import (SAMPLERS, NoiseBuffers, antithetic_normal, sobol_engine,
+                            sobol_normal)
+from utils import AllocationCounter
+
+
+def test_one_buffer_per_name():
+    noise = NoiseBuffers()
+    for shape in [(4, 8), (2, 3, 5), (16, 8), (3,), (4, 8)]:
+        assert noise.normal('eps', shape).shape == shape
+    noise.normal('dequantization', (2, 2))
+    noise.normal('eps', (2,), dtype=torch.float64)
+    assert len(noise.buffers) == 3
+    # grown to the largest draw
+    assert noise.buffers['eps', torch.float32, torch.device('cpu')].numel() == 128
+
+
+def test_smaller_draws_reuse_the_buffer():
+    noise = NoiseBuffers()
+    large = noise.normal('eps', (8, 16))
+    with AllocationCounter() as counter:
+        small = noise.normal('eps', (3, 5))
+        again = noise.normal('eps', (8, 16))
+    assert counter.count == 0
+    assert small.data_ptr() == large.data_ptr() == again.data_ptr()
+
+
+def test_seeded_draws_are_reproducible():
+    first = NoiseBuffers().manual_seed(3)
+    second = NoiseBuffers().manual_seed(3)
+    # a larger draw in between does not change the stream of the generator
+    a = first.normal('eps', (4, 8), std=0.5).clone()
+    first.normal('eps', (64,))
+    b = first.normal('eps', (2, 8)).clone()
+
+    expected = torch.Generator().manual_seed(3)
+    assert torch.equal(a, torch.empty(4, 8).normal_(0., 0.5, generator=expected))
+    second.normal('eps', (4, 8))
+    second.normal('eps', (64,))
+    assert torch.equal(b, second.normal('eps', (2, 8)))
+
+
+def test_antithetic_pairs_stay_within_an_image():
+    eps = antithetic_normal(3, (4, 2), generator=torch.Generator().manual_seed(0), images=5)
+    assert eps.shape == (15, 4, 2)
+    eps = eps.view(5, 3, 4, 2)
+    assert torch.equal(eps[:, 1], -eps[:, 0])
+    # the unpaired last draws are independent across images
+    assert not torch.equal(eps[1:, 2], -eps[:-1, 2])
+    assert not torch.equal(eps[1:, 0], -eps[:-1, 2])
+
+
+def test_sobol_engine_is_kept():
+    noise = NoiseBuffers().manual_seed(0)
+    first = noise.sample('sobol', 4, (3, 8))
+    second = noise.sample('sobol', 4, (3, 8), images=2)
+    assert len(noise.engines) == 1
+    # the second call continues the sequence, the same points for every image
+    expected = sobol_normal(8, (3, 8), engine=sobol_engine((3, 8), seed=0))
+    assert torch.equal(torch.cat([first, second[:4]]), expected)
+    assert torch.equal(second[:4], second[4:])
+
+
+@pytest.mark.parametrize('sampler', sorted(SAMPLERS))
+def test_sample_shapes(sampler):
+    noise = NoiseBuffers().manual_seed(0)
+    eps = noise.sample(sampler, 3, (4, 2), images=2)
+    assert eps.shape == (6, 4, 2)
+    assert torch.isfinite(eps).all()
@@ -0,0 +1,26 @@
+import pytest
+import torch
+
+cond_inn = pytest.importorskip('models.cond_inn', exc_type=ImportError)
+
+from args import get_parser
+from models.quantization import quantize_subnets
+
+
+def make_model(extra=()):
+    torch.manual_seed(0)
+    args = get_parser().parse_args(
+        ['--device', 'cpu', '--batch_size', '2', '--num_classes', '80'] + list(extra))
+    return cond_inn.CondINNWrapper(args, img_dims=(256, 256))
+
+
+@pytest.mark.parametrize('extra, counts', [([], (48, 0)),
+                                           (['--shared_cond_proj'], (16, 32))])
+def test_quantized_subnet_counts(extra, counts):
+    model = quantize_subnets(make_model(extra))
+    assert model.quantized_subnets == counts
+
+
+def test_bf16_is_rejected():
+    with pytest.raises(ValueError, match='bf16'):
+        quantize_subnets(make_model(['--bf16']))
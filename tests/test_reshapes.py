@@ -0,0 +1,77 @@
+import torch
+import torch.nn.functional as F
+
+from models.reshapes import (haar_merge, haar_multiplex_layer, haar_restore_layer,
+                             haar_split, i_revnet_downsampling, i_revnet_merge,
+                             i_revnet_split)
+
+
+def wavelet_order(channels):
+    '''channel order of order_by_wavelet, all averages first and so on'''
+    return torch.arange(4 * channels).view(channels, 4).t().reshape(-1)
+
+
+def conv_haar(x, weights, order_by_wavelet=False):
+    '''the previous haar_multiplex_layer forward, grouped +-1 convolution'''
+    out = F.conv2d(x, weights, stride=2, groups=x.size(1))
+    return out[:, wavelet_order(x.size(1))] if order_by_wavelet else out
+
+
+def conv_haar_inverse(y, weights, order_by_wavelet=False):
+    if order_by_wavelet:
+        y = y[:, torch.argsort(wavelet_order(y.size(1) // 4))]
+    return F.conv_transpose2d(y, weights, stride=2, groups=y.size(1) // 4)
+
+
+def test_haar_matches_convolution():
+    torch.manual_seed(0)
+    for channels in [1, 4, 12]:
+        x = torch.randn(3, channels, 16, 24)
+        for order_by_wavelet in [False, True]:
+            layer = haar_multiplex_layer([(channels, 16, 24)], order_by_wavelet=order_by_wavelet)
+            weights = layer.haar_weights
+            y, = layer([x])
+            assert torch.equal(y, conv_haar(x, weights, order_by_wavelet))
+            x_rev, = layer([y], rev=True)
+            assert torch.equal(x_rev, conv_haar_inverse(y, weights, order_by_wavelet))
+            assert torch.allclose(x_rev, x, atol=1e-6)
+
+
+def test_haar_restore_is_the_inverse_layer():
+    torch.manual_seed(0)
+    y = torch.randn(2, 8, 8, 8)
+    layer = haar_restore_layer([(8, 8, 8)])
+    x, = layer([y])
+    assert torch.equal(x, conv_haar_inverse(y, layer.haar_weights))
+    assert torch.allclose(layer([x], rev=True)[0], y, atol=1e-6)
+
+
+def test_haar_autograd_path_matches():
+    torch.manual_seed(0)
+    x = torch.randn(2, 4, 8, 8, requires_grad=True)
+    for order_by_wavelet in [False, True]:
+        y = haar_split(x, 0.5, order_by_wavelet=order_by_wavelet)
+        with torch.no_grad():
+            assert torch.equal(y, haar_split(x, 0.5, order_by_wavelet=order_by_wavelet))
+        x_rev = haar_merge(y, 0.5, order_by_wavelet=order_by_wavelet)
+        with torch.no_grad():
+            assert torch.equal(x_rev, haar_merge(y, 0.5, order_by_wavelet=order_by_wavelet))
+        # orthogonal transform, the gradient of the summed output is the
+        # inverse transform of ones
+        grad, = torch.autograd.grad(y.sum(), x)
+        expected = haar_merge(torch.ones_like(y), 0.5, order_by_wavelet=order_by_wavelet)
+        assert torch.allclose(grad, expected)
+
+
+def test_i_revnet_is_space_to_depth():
+    torch.manual_seed(0)
+    x = torch.randn(2, 3, 8, 12)
+    # channel (2i + j)C + c is pixel (i, j) of the 2x2 blocks of channel c
+    expected = torch.cat([x[:, :, i::2, j::2] for i in range(2) for j in range(2)], dim=1)
+    y = i_revnet_split(x)
+    assert torch.equal(y, expected)
+    assert torch.equal(i_revnet_merge(y), x)
+
+    layer = i_revnet_downsampling([(3, 8, 12)])
+    assert torch.equal(layer([x])[0], expected)
+    assert torch.equal(layer([y], rev=True)[0], x)
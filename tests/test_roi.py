@@ -0,0 +1,31 @@
+import torch
+
+from models.modules import square_boxes
+
+
+def covers(boxes, height, width):
+    return bool(((boxes[:, :2] <= 0) & (boxes[:, 2:] >= torch.tensor([width, height]))).all())
+
+
+def test_full_frame_covers_non_square_images():
+    for height, width in [(300, 420), (480, 640), (500, 200), (256, 256)]:
+        full = torch.tensor([[0., 0., width, height]])
+        boxes = square_boxes(full, height, width, margin=0.1)
+        assert covers(boxes, height, width)
+        side = boxes[:, 2] - boxes[:, 0]
+        assert torch.equal(side, boxes[:, 3] - boxes[:, 1])
+        assert side.item() == max(height, width)
+
+
+def test_wide_roi_is_not_cut_to_the_short_side():
+    roi = torch.tensor([[0., 100., 420., 200.]])
+    boxes = square_boxes(roi, 300, 420, margin=0.)
+    assert boxes[0, 0] <= 0 and boxes[0, 2] >= 420
+
+
+def test_small_roi_stays_inside_the_image():
+    roi = torch.tensor([[400., 5., 420., 25.], [10., 10., 12., 12.]])
+    boxes = square_boxes(roi, 300, 420, margin=0.1, min_size=32)
+    assert (boxes[:, :2] >= 0).all()
+    assert (boxes[:, 2] <= 420).all() and (boxes[:, 3] <= 300).all()
+    assert torch.allclose(boxes[:, 2] - boxes[:, 0], torch.tensor([32., 32.]))
@@ -0,0 +1,49 @@
+import pytest
+import torch
+from torch import nn
+
+cond_inn = pytest.importorskip('models.cond_inn', exc_type=ImportError)
+
+
+@pytest.mark.parametrize('kernel_sizes', [[3, 3], [1, 3, 1]])
+def test_projection_matches_the_full_condition_conv(kernel_sizes):
+    '''a split subnet fed by the shared projection computes the same as a
+    subnet convolving [x, cond] in one go'''
+    torch.manual_seed(0)
+    c_x, c_cond, c_out = 4, 6, 8
+    projection = cond_inn.ConditionProjection(c_cond, kernel_sizes, hidden=128)
+    x = torch.randn(2, c_x, 16, 16)
+    cond = torch.randn(2, c_cond, 16, 16)
+
+    projected = projection(cond)
+    assert len(projected) == len(kernel_sizes)
+    for block, k in enumerate(kernel_sizes):
+        split = (cond_inn.subnet_conv_1x1_split if k == 1 else
+                 cond_inn.subnet_conv_split)(c_x, c_out)
+        h1, h2 = projected[block].split(128, dim=1)
+
+        # the slice of the shared conv this block gets, first subnet half
+        n_before = kernel_sizes[:block].count(k)
+        weight = projection.convs[str(k)].weight[2 * 128 * n_before:][:128]
+        full = nn.Conv2d(c_x + c_cond, 128, k, padding=k // 2)
+        with torch.no_grad():
+            full.weight.copy_(torch.cat([split[0].weight, weight], dim=1))
+            full.bias.copy_(split[0].bias)
+        reference = nn.Sequential(full, split[1], split[2])
+
+        with torch.no_grad():
+            torch.testing.assert_close(split((x, h1)), reference(torch.cat([x, cond], 1)),
+                                       rtol=1e-4, atol=1e-5)
+            assert split((x, h2)).shape == (2, c_out, 16, 16)
+
+
+def test_projections_broadcast_over_samples():
+    '''projections of a single image broadcast against a batch of samples'''
+    torch.manual_seed(0)
+    projection = cond_inn.ConditionProjection(6, [3])
+    split = cond_inn.subnet_conv_split(4, 8)
+    x = torch.randn(5, 4, 16, 16)
+    cond = torch.randn(1, 6, 16, 16)
+    h, _ = projection(cond)[0].split(128, dim=1)
+    with torch.no_grad():
+        torch.testing.assert_close(split((x, h)), split((x, h.expand(5, -1, -1, -1))))
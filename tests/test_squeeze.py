@@ -0,0 +1,56 @@
+import pytest
+import torch
+
+from models.modules import squeeze2d, squeeze_pyramid, unsqueeze2d
+
+MEMORY_FORMATS = [torch.contiguous_format, torch.channels_last]
+
+
+def squeeze2d_reference(input, factor):
+    '''the view / permute squeeze2d before pixel_unshuffle'''
+    B, C, H, W = input.size()
+    x = input.view(B, C, H // factor, factor, W // factor, factor)
+    x = x.permute(0, 1, 3, 5, 2, 4).contiguous()
+    return x.view(B, C * factor * factor, H // factor, W // factor)
+
+
+def unsqueeze2d_reference(input, factor):
+    '''the view / permute unsqueeze2d before pixel_shuffle'''
+    B, C, H, W = input.size()
+    x = input.view(B, C // factor ** 2, factor, factor, H, W)
+    x = x.permute(0, 1, 4, 2, 5, 3).contiguous()
+    return x.view(B, C // factor ** 2, H * factor, W * factor)
+
+
+@pytest.mark.parametrize('memory_format', MEMORY_FORMATS)
+@pytest.mark.parametrize('channels', [1, 3, 16])
+@pytest.mark.parametrize('factor', [2, 4])
+def test_squeeze_matches_reference(factor, channels, memory_format):
+    x = torch.randn(2, channels, 16, 24)
+    y = squeeze2d(x, factor, memory_format=memory_format)
+    assert torch.equal(y, squeeze2d_reference(x, factor))
+    assert y.is_contiguous(memory_format=memory_format)
+
+    x_back = unsqueeze2d(y, factor, memory_format=memory_format)
+    assert torch.equal(x_back, unsqueeze2d_reference(squeeze2d_reference(x, factor), factor))
+    assert torch.equal(x_back, x)
+    assert x_back.is_contiguous(memory_format=memory_format)
+
+
+@pytest.mark.parametrize('memory_format', MEMORY_FORMATS)
+@pytest.mark.parametrize('factor', [2, 4])
+def test_unsqueeze_matches_reference(factor, memory_format):
+    z = torch.randn(2, 3 * factor ** 2, 8, 4).contiguous(memory_format=memory_format)
+    x = unsqueeze2d(z, factor, memory_format=memory_format)
+    assert torch.equal(x, unsqueeze2d_reference(z.contiguous(), factor))
+    assert torch.equal(squeeze2d(x, factor, memory_format=memory_format), z)
+
+
+@pytest.mark.parametrize('memory_format', MEMORY_FORMATS)
+def test_squeeze_pyramid(memory_format):
+    x = torch.randn(2, 3, 32, 32)
+    levels = squeeze_pyramid(x, (4, 2), memory_format=memory_format)
+    expected = squeeze2d_reference(x, 4)
+    assert torch.equal(levels[0], expected)
+    assert torch.equal(levels[1], squeeze2d_reference(expected, 2))
+    assert all(level.is_contiguous(memory_format=memory_format) for level in levels)
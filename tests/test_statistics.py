@@ -0,0 +1,50 @@
+import torch
+
+from models.modules import batched_kmeans, welford_update
+
+
+def test_welford_matches_the_full_statistics():
+    torch.manual_seed(0)
+    samples = torch.randn(3, 11, 2, 5) * 40 + 100
+    count, mean, m2 = torch.zeros(3), 0., 0.
+    for chunk in samples.split([4, 1, 6], dim=1):
+        count, mean, m2 = welford_update(count, mean, m2, chunk)
+    assert count.tolist() == [11] * 3
+    torch.testing.assert_close(mean, samples.mean(dim=1))
+    torch.testing.assert_close(m2 / count.view(-1, 1, 1), samples.var(dim=1, unbiased=False))
+
+
+def test_welford_rows_with_different_counts():
+    torch.manual_seed(0)
+    first, second = torch.randn(2, 3, 4), torch.randn(2, 5, 4)
+    count, mean, m2 = welford_update(torch.tensor([0., 2.]), torch.zeros(2, 4),
+                                     torch.zeros(2, 4), first)
+    count, mean, m2 = welford_update(count, mean, m2, second)
+    assert count.tolist() == [8, 10]
+    row = torch.cat([first[0], second[0]])
+    torch.testing.assert_close(mean[0], row.mean(dim=0))
+    torch.testing.assert_close(m2[0] / 8, row.var(dim=0, unbiased=False))
+
+
+def test_batched_kmeans_separates_clusters():
+    torch.manual_seed(0)
+    centers = torch.tensor([[[0., 0.], [10., 10.]], [[-5., 3.], [5., -3.]]])
+    labels = torch.randint(2, (2, 40))
+    labels[:, :2] = torch.tensor([0, 1])
+    x = centers.gather(1, labels.unsqueeze(2).expand(-1, -1, 2)) + 0.1 * torch.randn(2, 40, 2)
+
+    assign, found = batched_kmeans(x, 2)
+    for row in range(2):
+        # the same partition, up to the order of the clusters
+        same = assign[row] == labels[row]
+        assert same.all() or (~same).all()
+        order = found[row, :, 0].argsort()
+        torch.testing.assert_close(found[row][order], centers[row][centers[row, :, 0].argsort()],
+                                   atol=0.1, rtol=0)
+
+
+def test_batched_kmeans_with_more_clusters_than_points():
+    x = torch.randn(3, 2, 4)
+    assign, centers = batched_kmeans(x, 5)
+    assert centers.shape == (3, 2, 4)
+    assert torch.equal(assign, torch.arange(2).expand(3, -1))
@@ -0,0 +1,133 @@
+import cv2
+import numpy as np
+import pytest
+import torch
+
+cond_inn = pytest.importorskip('models.cond_inn', exc_type=ImportError)
+
+from args import get_parser
+
+
+def make_model(extra=()):
+    torch.manual_seed(0)
+    args = get_parser().parse_args(
+        ['--device', 'cpu', '--batch_size', '2', '--num_classes', '80'] + list(extra))
+    return cond_inn.CondINNWrapper(args, img_dims=(256, 256))
+
+
+def batch(batch_size=2):
+    torch.manual_seed(1)
+    img = torch.rand(batch_size, 3, 256, 256) * 255
+    mask = (torch.rand(batch_size, 128, 128) > 0.5).float() * 255
+    class_cond = torch.zeros(batch_size, 81)
+    class_cond[torch.arange(batch_size), torch.arange(batch_size) + 3] = 1
+    return img, mask, class_cond
+
+
+def test_step_without_monitoring_skips_the_decode(monkeypatch):
+    model = make_model()
+
+    def decode(*args, **kwargs):
+        raise AssertionError('decoded without monitoring')
+    monkeypatch.setattr(model, 'decode_and_average2', decode)
+
+    sample_mean, losses = model(*batch(), monitor=False)
+    assert sample_mean is None and losses['recons_error'] is None
+    assert torch.isfinite(losses['train_loss'])
+
+
+def test_step_with_monitoring_decodes_without_grad(monkeypatch):
+    model = make_model()
+    calls = []
+    decode_and_average2 = model.decode_and_average2
+
+    def decode(*args, **kwargs):
+        calls.append(torch.is_grad_enabled())
+        return decode_and_average2(*args, **kwargs)
+    monkeypatch.setattr(model, 'decode_and_average2', decode)
+
+    sample_mean, losses = model(*batch(), monitor=True)
+    assert calls == [False]
+    assert sample_mean.shape == (1, 128, 128)
+    assert losses['recons_error'] is not None
+
+
+def test_presence_target_is_multi_hot(tmp_path):
+    dataset_coco = pytest.importorskip('dataset_coco', exc_type=ImportError)
+    segim = np.full((256, 256, 3), 255, dtype=np.uint8)
+    segim[:128, :128] = 5     # 16384 px, present
+    segim[128:, 128:] = 9     # 16384 px, present
+    segim[200:, :40] = 7      # 2240 px, too small
+    path = str(tmp_path / 'mask.png')
+    cv2.imwrite(path, segim)
+
+    _, _, presence = dataset_coco.decode_mask(path)
+    assert presence.shape == (81,)
+    assert presence.nonzero()[0].tolist() == [6, 10]
+
+    cv2.imwrite(path, np.full((256, 256, 3), 255, dtype=np.uint8))
+    _, class_label_id, presence = dataset_coco.decode_mask(path)
+    assert class_label_id == 0 and presence.nonzero()[0].tolist() == [0]
+
+
+def test_step_trains_the_presence_head():
+    model = make_model()
+    img, mask, class_cond = batch()
+    presence = class_cond.clone()
+    presence[:, 20] = 1
+    head = [p.detach().clone() for p in model.presence_head.parameters()]
+    with torch.no_grad():
+        conditions = model.make_conditions(img, class_cond)
+        expected = model.bce_loss(model.presence_logits(conditions[1]), presence)
+
+    _, losses = model(img, mask, class_cond, presence=presence)
+    # trained on the multi-hot target, not on the requested class
+    assert losses['presence_loss'].item() == pytest.approx(expected.item(), rel=1e-5)
+    assert all(not torch.equal(a, b) for a, b in zip(head, model.presence_head.parameters()))
+
+
+def test_gated_decode_skips_absent_classes(monkeypatch):
+    model = make_model().eval()
+    img, _, class_cond = batch()
+    class_cond[1] = 0
+    class_cond[1, 0] = 1
+    with torch.no_grad():
+        model.presence_head[-1].bias.fill_(-20.)
+    picks = []
+    decode = model.decode_using_learned_sampler
+
+    def recording(conditions, nr_sample, pick=None, **kwargs):
+        picks.append(pick)
+        return decode(conditions, nr_sample, pick=pick, **kwargs)
+    monkeypatch.setattr(model, 'decode_using_learned_sampler', recording)
+
+    with torch.no_grad():
+        means, present = model.decode_and_average_gated(img, class_cond, 2)
+    # the absent class is rejected, "unlabeled" never is
+    assert present.tolist() == [False, True] and picks == [1]
+    assert means.shape == (2, 1, 128, 128) and not means[0].any()
+
+
+def test_save_and_resume_the_presence_optimizer(tmp_path):
+    model = make_model()
+    model(*batch())
+    path = str(tmp_path / 'ckpt.pt')
+    model.save(3, path)
+
+    resumed = make_model()
+    assert resumed.resume(path) == 3
+    state = resumed.presence_optimizer.state_dict()['state']
+    expected = model.presence_optimizer.state_dict()['state']
+    assert state.keys() == expected.keys()
+    assert all(torch.equal(state[k]['exp_avg'], expected[k]['exp_avg']) for k in state)
+
+    # checkpoints from before the presence head
+    ckpt = torch.load(path)
+    del ckpt['presence-optimizer']
+    for key in list(ckpt['model']):
+        if key.startswith('presence_head.'):
+            del ckpt['model'][key]
+    torch.save(ckpt, path)
+    with pytest.raises(RuntimeError):
+        make_model().resume(path)
+    assert make_model().resume(path, strict=False) == 3
@@ -18,11 +18,11 @@ import torch.multiprocessing as mp
 
 from utils import draw_hyps, draw_heatmap
 # from models.networks_regression import HyperRegression
-from models.cond_inn import CondINNWrapper
+from models.boundary_inn import MODEL_MODES, rasterize_boundary
 from models import feature_net
 
 from args import get_args
-from utils import AverageValueMeter, set_random_seed
+from utils import AverageValueMeter, set_random_seed, synchronize
 from dataset_coco import SamplePointData
 
 import mmfp_utils
@@ -48,6 +48,13 @@ def get_grid_logprob(args,
     return (X, Y), (log_px_grid.detach().cpu().numpy(), log_py_grid.detach().cpu().numpy())
 
 
+def gt_to_mask(args, gt_tensor):
+    # the boundary mode ground truth is rasterized for visualization only
+    if args.model_mode == 'boundary':
+        return rasterize_boundary(gt_tensor, 128)[:, 0]
+    return gt_tensor
+
+
 def parse_first_example_to_npy(input_tensor, gt_mask_tensor, pred_mask_tensor, class_label):
 
     rgb_im = input_tensor[0].cpu(
@@ -79,11 +86,15 @@ def main_worker(gpu, save_dir, ngpus_per_node, args):
     args.gpu = gpu
     if args.gpu is not None:
         print("Use GPU: {} for training".format(args.gpu))
+        if args.device == 'cuda':
+            args.device = 'cuda:%d' % args.gpu
 
-    img_dims = (256, 256)
-    model = CondINNWrapper(args, img_dims=img_dims).cuda(args.gpu)
+    device = torch.device(args.device)
+    if device.type == 'cuda' and device.index is not None:
+        torch.cuda.set_device(device)
 
-    torch.cuda.set_device(args.gpu)
+    img_dims = (256, 256)
+    model = MODEL_MODES[args.model_mode](args, img_dims=img_dims).to(args.device)
 
     start_epoch = 1
     if args.resume_checkpoint is None and os.path.exists(os.path.join(save_dir, 'checkpoint-latest.pt')):
@@ -103,6 +114,8 @@ def main_worker(gpu, save_dir, ngpus_per_node, args):
     start_time = time.time()
     loss_avg_meter = AverageValueMeter()
     acc_avg_meter = AverageValueMeter()
+    # forward/backward time of the steps without sample monitoring
+    step_time_meter = AverageValueMeter()
     if args.distributed:
         print("[Rank %d] World size : %d" % (args.rank, dist.get_world_size()))
 
@@ -132,22 +145,34 @@ def main_worker(gpu, save_dir, ngpus_per_node, args):
         # train for one epoch
         print("Epoch starts:")
         model.train()
-        for bidx, (input_tensor, gt_mask_tensor, class_condition, class_label) in enumerate(train_loader):
+        for bidx, (input_tensor, gt_mask_tensor, class_condition, class_label, presence) in enumerate(train_loader):
+            # gt_mask_tensor holds boundary points [B, N, 2] in the boundary mode
             # x : [args.batch_size, 5, W, H]
             # y : [args.batch_size, 30, 2]s
             step = bidx + len(train_loader) * (epoch - 1)
+            monitor = args.monitor_freq > 0 and step % args.monitor_freq == 0
 
             # backpropagate
+            step_start_time = time.time()
             reverse_sample, losses = model(input_tensor, gt_mask_tensor,
-                                           class_condition)
-
-            if bidx % 5 == 0:
+                                           class_condition, monitor=monitor,
+                                           presence=presence)
+            if not monitor:
+                synchronize(args.device)
+                step_time_meter.update(time.time() - step_start_time)
+
+            if bidx % 5 == 0 and args.model_mode == 'boundary':
+                tensorboard_writer.add_scalar("loss/train", losses['train_loss'], step)
+                tensorboard_writer.add_scalar(
+                    "boundaryflow/logdet", losses['logdet'], step)
+                tensorboard_writer.add_scalar(
+                    "prior_prob", losses['prior_prob'], step)
+            elif bidx % 5 == 0:
                 train_loss = losses['train_loss']
                 prior_logdet = losses['prior_logdet']
                 prior_prob = losses['prior_prob']
                 logdet = losses['logdet']
                 bce_loss = losses['bce_loss']
-                recons_error = losses['recons_error']
                 accuracy = losses['accuracy']
 
                 acc_avg_meter.update(accuracy.item())
@@ -162,32 +187,39 @@ def main_worker(gpu, save_dir, ngpus_per_node, args):
                 tensorboard_writer.add_scalar("segflow/logdet", logdet, step)
                 tensorboard_writer.add_scalar("loss/bce", bce_loss, step)
                 tensorboard_writer.add_scalar(
-                    "loss/recons", recons_error, step)
+                    "loss/presence", losses['presence_loss'], step)
+
+            if monitor:
+                tensorboard_writer.add_scalar(
+                    "loss/recons", losses['recons_error'], step)
                 tensorboard_writer.add_image(
                     "sample_mean", reverse_sample, step)
 
-            # torch.tensor -> np.array
-            rgb_im, gt_seg_im, pred_seg_im, label_str = parse_first_example_to_npy(
-                input_tensor, gt_mask_tensor, reverse_sample, class_label)
+                # torch.tensor -> np.array
+                rgb_im, gt_seg_im, pred_seg_im, label_str = parse_first_example_to_npy(
+                    input_tensor, gt_to_mask(args, gt_mask_tensor), reverse_sample, class_label)
 
-            # print('current label class: ', label_str)
+                # print('current label class: ', label_str)
 
-            cv2.imshow('test', np.hstack([rgb_im, gt_seg_im, pred_seg_im]))
-            key = cv2.waitKey(1)
+                cv2.imshow('test', np.hstack([rgb_im, gt_seg_im, pred_seg_im]))
+                key = cv2.waitKey(1)
 
-            loss_avg_meter.update(train_loss.item())
+            loss_avg_meter.update(losses['train_loss'].item())
             # multi_ce_loss_avg_meter.update(ce_loss)
             if step % args.log_freq == 0:
                 duration = time.time() - start_time
                 start_time = time.time()
-                print("[Rank %d] Epoch %d Batch [%2d/%2d] Time [%3.2fs] Loss %2.5f"
-                      % (args.rank, epoch, bidx, len(train_loader), duration, loss_avg_meter.avg))
+                throughput = args.batch_size / step_time_meter.avg if step_time_meter.count else 0.
+                tensorboard_writer.add_scalar(
+                    "throughput/train", throughput, step)
+                print("[Rank %d] Epoch %d Batch [%2d/%2d] Time [%3.2fs] Loss %2.5f Throughput [%3.2f img/s]"
+                      % (args.rank, epoch, bidx, len(train_loader), duration, loss_avg_meter.avg, throughput))
 
         if epoch % args.viz_freq == 0:
             # reconstructions
             print('test start')
             model.eval()
-            for bidx, (input_tensor, gt_mask_tensor, class_condition, class_label) in tqdm.tqdm(enumerate(test_loader), total=len(test_loader)):
+            for bidx, (input_tensor, gt_mask_tensor, class_condition, class_label, _) in tqdm.tqdm(enumerate(test_loader), total=len(test_loader)):
                 if args.timeit:
                     t1 = time.time()
                 pred_seg_mask = model.decode_and_average(
@@ -200,7 +232,7 @@ def main_worker(gpu, save_dir, ngpus_per_node, args):
                 # import pdb; pdb.set_trace()
 
                 rgb_im, gt_seg_im, pred_seg_im, label_str = parse_first_example_to_npy(
-                    input_tensor, gt_mask_tensor, pred_seg_mask, class_label)
+                    input_tensor, gt_to_mask(args, gt_mask_tensor), pred_seg_mask, class_label)
 
                 save_img = np.hstack([rgb_im, gt_seg_im, pred_seg_im])
                 cv2.putText(save_img, label_str, (save_img.shape[1]//2, save_img.shape[0]//2),
@@ -9,11 +9,16 @@ from math import log, pi
 import os
 import torch
 import torch.distributed as dist
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_leaves
 import random
 import numpy as np
 import matplotlib
-# matplotlib.use('Agg')
-matplotlib.use('TkAgg')
+try:
+    matplotlib.use('TkAgg')
+except ImportError:
+    # headless host (CPU serving, tests)
+    matplotlib.use('Agg')
 # from wemd import computeWEMD
 
 
@@ -120,6 +125,75 @@ def set_random_seed(seed):
     torch.cuda.manual_seed_all(seed)
 
 
+def synchronize(device=None):
+    """waits for the queued kernels of a cuda device, no-op on the cpu"""
+    if device is not None and torch.device(device).type != 'cuda':
+        return
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        torch.cuda.synchronize(device)
+
+
+class AllocationCounter(TorchDispatchMode):
+    """
+    Counts the tensors (and bytes) that the torch ops run inside the
+    context allocate, i.e. outputs that share their storage with none of
+    the op's inputs (views, in-place and out= results do):
+
+        with AllocationCounter() as counter:
+            ...
+        print(counter.count, counter.bytes)
+    """
+
+    def __init__(self):
+        super(AllocationCounter, self).__init__()
+        self.count = 0
+        self.bytes = 0
+
+    @staticmethod
+    def _storages(tree):
+        return {t.untyped_storage().data_ptr() for t in tree_leaves(tree)
+                if isinstance(t, torch.Tensor)}
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        inputs = self._storages((args, kwargs))
+        out = func(*args, **kwargs)
+        for tensor in tree_leaves(out):
+            if isinstance(tensor, torch.Tensor) and \
+                    tensor.untyped_storage().data_ptr() not in inputs:
+                self.count += 1
+                self.bytes += tensor.numel() * tensor.element_size()
+        return out
+
+
+def set_cpu_inference_profile(threads=None, interop_threads=None):
+    """
+    Thread settings for CPU inference: intra-op threads (one op split over
+    cores) and inter-op threads (independent ops run concurrently). None
+    keeps the torch default. The inter-op pool can only be sized before its
+    first use, it keeps its size otherwise.
+    Returns the (intra-op, inter-op) thread counts in effect.
+    """
+    if threads is not None:
+        torch.set_num_threads(threads)
+    if interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            print('inter-op threads already in use, keeping %d' %
+                  torch.get_num_interop_threads())
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+
+def mask_iou(pred, gt, threshold=127.5):
+    """IoU of [B, ...] masks in the dataset's 0/255 range, 1 where both are empty"""
+    pred = (pred > threshold).flatten(1)
+    gt = (gt > threshold).flatten(1)
+    inter = (pred & gt).sum(dim=1).float()
+    union = (pred | gt).sum(dim=1).float()
+    return torch.where(union > 0, inter / union.clamp(min=1), torch.ones_like(union))
+
+
 # Visualization
 def visualize_point_clouds(pts, gtr, idx, pert_order=[0, 1, 2]):
     pts = pts.cpu().detach().numpy()[:, pert_order]